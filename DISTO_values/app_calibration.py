@@ -235,6 +235,62 @@ def find_wlevel_onprofile(profile, hw, reverse=False):
     return np.array((profile[0, 0], ypos, zpos))
 
 
+def read_data(path="."):
+    """
+    Field data dict for apply_transformations from GCPs.txt, cross_section.txt,
+    shoreline.txt and the optional watercolumn.txt and cross_section_offset.txt in path.
+    """
+    data = dict()
+    markers_file = os.path.join(path, 'GCPs.txt')
+    profile_file = os.path.join(path, 'cross_section.txt')
+    shoreline_file = os.path.join(path, 'shoreline.txt')
+    watercolumn_file = os.path.join(path, 'watercolumn.txt')
+    profileoffset_file = os.path.join(path, 'cross_section_offset.txt')
+    if not os.path.isfile(markers_file):
+        exitError("File "+markers_file+" doesn't exist!")
+    if not os.path.isfile(profile_file):
+        exitError("File "+profile_file+" doesn't exist!")
+    if not os.path.isfile(shoreline_file):
+        exitError("File "+shoreline_file+" doesn't exist!")
+
+    data['shoreline'] = {}
+    data['markers_world_coordinates'] = {}
+    data['profile'] = {}
+    mat = np.loadtxt(shoreline_file)
+    # -  shore line has to be sorted from min X to max X -
+    mat = mat[mat[:, 0].argsort()]
+    mat = mat.transpose()
+    data['shoreline']['x'] = mat[0][:].tolist()
+    data['shoreline']['y'] = mat[1][:].tolist()
+    data['shoreline']['z'] = mat[2][:].tolist()
+
+    mat = np.loadtxt(markers_file)
+    mat = mat.transpose()
+    data['markers_world_coordinates']['x'] = mat[0][:].tolist()
+    data['markers_world_coordinates']['y'] = mat[1][:].tolist()
+    data['markers_world_coordinates']['z'] = mat[2][:].tolist()
+
+    mat = np.loadtxt(profile_file)
+    mat = mat.transpose()
+    if mat.shape[0] == 2:
+        data['profile']['x'] = []
+        data['profile']['y'] = mat[0][:].tolist()
+        data['profile']['z'] = mat[1][:].tolist()
+    if mat.shape[0] == 3:
+        data['profile']['x'] = mat[0][:].tolist()
+        data['profile']['y'] = mat[1][:].tolist()
+        data['profile']['z'] = mat[2][:].tolist()
+    data['watercolumn'] = None
+    if os.path.isfile(watercolumn_file):
+        mat = np.loadtxt(watercolumn_file)
+        data['watercolumn'] = mat
+    data['profile_offset'] = None
+    if os.path.isfile(profileoffset_file):
+        mat = np.loadtxt(profileoffset_file)
+        data['profile_offset'] = mat
+    return data
+
+
 def apply_transformations(data, fig=None):
     # check if 2d profile:
     has2dprofile = False
@@ -471,10 +527,6 @@ if __name__ == '__main__':
 
     data = []
     data_file = ""
-    markers_file = None
-    profile_file = None
-    shoreline_file = None
-    watercolumn_file = None
 
     if args.data is not None:
         data_file = args.data
@@ -483,55 +535,7 @@ if __name__ == '__main__':
             data = json.load(file)
         data['watercolumn'] = None
     else:
-        # data_file = 'data.json'
-        data = dict()
-        markers_file = 'GCPs.txt'
-        profile_file = 'cross_section.txt'
-        shoreline_file = 'shoreline.txt'
-        watercolumn_file = 'watercolumn.txt'
-        profileoffset_file = 'cross_section_offset.txt'
-        if not os.path.isfile(markers_file):
-            exitError("File "+markers_file+" doesn't exist!")
-        if not os.path.isfile(profile_file):
-            exitError("File "+profile_file+" doesn't exist!")
-        if not os.path.isfile(shoreline_file):
-            exitError("File "+shoreline_file+" doesn't exist!")
-
-        data['shoreline'] = {}
-        data['markers_world_coordinates'] = {}
-        data['profile'] = {}
-        mat = np.loadtxt(shoreline_file)
-        # -  shore line has to be sorted from min X to max X -
-        mat = mat[mat[:, 0].argsort()]
-        mat = mat.transpose()
-        data['shoreline']['x'] = mat[0][:].tolist()
-        data['shoreline']['y'] = mat[1][:].tolist()
-        data['shoreline']['z'] = mat[2][:].tolist()
-
-        mat = np.loadtxt(markers_file)
-        mat = mat.transpose()
-        data['markers_world_coordinates']['x'] = mat[0][:].tolist()
-        data['markers_world_coordinates']['y'] = mat[1][:].tolist()
-        data['markers_world_coordinates']['z'] = mat[2][:].tolist()
-
-        mat = np.loadtxt(profile_file)
-        mat = mat.transpose()
-        if mat.shape[0] == 2:
-            data['profile']['x'] = []
-            data['profile']['y'] = mat[0][:].tolist()
-            data['profile']['z'] = mat[1][:].tolist()
-        if mat.shape[0] == 3:
-            data['profile']['x'] = mat[0][:].tolist()
-            data['profile']['y'] = mat[1][:].tolist()
-            data['profile']['z'] = mat[2][:].tolist()
-        data['watercolumn'] = None
-        if os.path.isfile(watercolumn_file):
-            mat = np.loadtxt(watercolumn_file)
-            data['watercolumn'] = mat
-        data['profile_offset'] = None
-        if os.path.isfile(profileoffset_file):
-            mat = np.loadtxt(profileoffset_file)
-            data['profile_offset'] = mat
+        data = read_data(".")
 
     riveraxis, markers_worldcoordinates, profile = apply_transformations(data)
     write_data(currentpath + os.sep + "discharge_freehelper",
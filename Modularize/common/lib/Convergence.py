@@ -0,0 +1,119 @@
+import warnings
+
+import numpy as np
+from scipy import stats
+
+from common.lib.Streaming import DEFAULT_MASKS, StreamingDischarge, apply_masks
+
+
+def mean_bounds(x, confidence=0.95):
+    """
+    Mean of a series of time steps and the half width of its confidence interval.
+
+    Consecutive velocity fields are correlated, so the standard error uses the effective number of independent
+    samples n (1 - r) / (1 + r), with r the lag-1 autocorrelation (only when positive), and Student's t.
+    Returns (mean, half width), the half width is inf with fewer than 3 samples.
+    """
+    x = np.asarray(x, dtype=float)
+    x = x[np.isfinite(x)]
+    n = len(x)
+    if n == 0:
+        return np.nan, np.inf
+    mean = x.mean()
+    if n < 3:
+        return mean, np.inf
+    d = x - mean
+    var = (d ** 2).sum() / (n - 1)
+    r = (d[:-1] * d[1:]).sum() / (d ** 2).sum() if var > 0 else 0.
+    n_eff = max(n * (1 - r) / (1 + r), 2.) if r > 0 else n
+    return mean, stats.t.ppf(0.5 + confidence / 2, n_eff - 1) * np.sqrt(var / n_eff)
+
+
+class ConvergenceMonitor:
+    """
+    Running mean velocity, and river flow over cross-sections, of velocimetry that arrives in time chunks, with
+    confidence bounds, to stop processing a clip once the estimates are stable.
+
+    Every chunk is masked with chunk-local statistics as in Streaming. Per time step the mean speed of the
+    field [m s-1] and, per cross-section, the mean speed at its points are kept. The river flow is the median
+    of Streaming.StreamingDischarge, its bounds scale with those of the cross-section's mean speed, to which
+    the discharge is proportional. The estimates have converged when, after at least min_frames time steps,
+    the confidence interval (at confidence) of every estimate is within tolerance (a fraction) of it, and no
+    estimate changed by more than tolerance with the last chunk.
+
+    cross_sections ((x, y, z) per cross-section, in crs) are optional, kwargs go to StreamingDischarge.
+    """
+
+    def __init__(self, tolerance=0.05, confidence=0.95, min_frames=20, cross_sections=None, names=None, crs=None,
+                 masks=DEFAULT_MASKS, **kwargs):
+        self.tolerance = tolerance
+        self.confidence = confidence
+        self.min_frames = min_frames
+        self.masks = masks
+        self.names = None
+        self.discharge = None
+        if cross_sections:
+            self.names = names or [f"transect_{n + 1}" for n in range(len(cross_sections))]
+            # chunks are masked here already
+            self.discharge = StreamingDischarge(cross_sections, names=self.names, crs=crs, masks=[],
+                                                quantiles=[0.5], **kwargs)
+        self.speed = []
+        self.transect_speed = {name: [] for name in self.names or []}
+        self.n_time = 0
+        self.converged = False
+        self._estimates = None
+
+    def update(self, ds_chunk):
+        """
+        Add a chunk of velocimetry (time, y, x) and return the summary, see ``summary``.
+        """
+        ds_chunk = apply_masks(ds_chunk.copy(deep=True), self.masks)
+        speed = np.hypot(ds_chunk["v_x"].values, ds_chunk["v_y"].values)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            self.speed.extend(np.nanmean(speed.reshape(len(speed), -1), axis=1))
+            if self.discharge is not None:
+                self.discharge.update(ds_chunk)
+                for name, samples in zip(self.names, self.discharge.transect_samples()):
+                    s = np.hypot(samples["v_x"].values, samples["v_y"].values)
+                    self.transect_speed[name].extend(np.nanmean(s, axis=1))
+        self.n_time += len(ds_chunk.time)
+        previous, self._estimates = self._estimates, self._compute_estimates()
+        self.converged = self.n_time >= self.min_frames and previous is not None and all(
+            e["relative_width"] <= self.tolerance and abs(e["mean"] - p["mean"]) <= self.tolerance * abs(e["mean"])
+            for e, p in zip(self._flat(self._estimates), self._flat(previous))
+        )
+        return self.summary()
+
+    @staticmethod
+    def _flat(estimates):
+        return [estimates["velocity"]] + list(estimates.get("river_flow", {}).values())
+
+    def _bounds(self, x, scale=1.):
+        mean, half = mean_bounds(x, self.confidence)
+        rel = half / abs(mean) if mean else np.inf
+        value = scale * mean
+        return {"mean": float(value), "lower": float(value * (1 - rel)), "upper": float(value * (1 + rel)),
+                "relative_width": float(rel)}
+
+    def estimates(self):
+        """
+        {"velocity": {...}, "river_flow": {name: {...}}} with mean, lower and upper bound and relative half
+        width of the interval, velocity in [m s-1] and river flow in [m3 s-1].
+        """
+        return self._estimates
+
+    def _compute_estimates(self):
+        result = {"velocity": self._bounds(self.speed)}
+        if self.discharge is not None:
+            river_flow = self.discharge.river_flow.isel(quantile=0)
+            result["river_flow"] = {}
+            for name in self.names:
+                mean, _ = mean_bounds(self.transect_speed[name], self.confidence)
+                q = float(river_flow.sel(transect=name))
+                result["river_flow"][name] = self._bounds(self.transect_speed[name], scale=q / mean if mean else 0.)
+        return result
+
+    def summary(self):
+        return {"time_steps": self.n_time, "converged": self.converged, "tolerance": self.tolerance,
+                "confidence": self.confidence, **self.estimates()}
@@ -0,0 +1,168 @@
+import contextlib
+import inspect
+
+import dask
+import xarray as xr
+from ffpiv import window
+from pyorc.velocimetry.ffpiv import get_ffpiv
+
+from common.lib.Streaming import iter_piv_chunks
+
+SCHEDULERS = ["threads", "processes", "synchronous", "distributed"]
+# pyorc's default memory_factor: a FF-PIV batch takes at most 1 / PYORC_MEMORY_FACTOR of the available memory
+PYORC_MEMORY_FACTOR = inspect.signature(get_ffpiv).parameters["memory_factor"].default
+
+
+def _parse_bytes(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return dask.utils.parse_bytes(value)
+
+
+class ExecutionSettings:
+    """
+    How the lazy frame arrays of the pipeline are chunked and computed.
+
+    time_chunk : frames per dask chunk along time, for decoded, normalized and projected frames and for
+        NetCDF writes (pyorc's default is 20)
+    scheduler : "threads", "processes", "synchronous" or "distributed" (a local dask.distributed cluster,
+        needs the distributed package). None keeps the dask default (threads).
+    n_workers : threads or processes to compute with, None for all cores
+    threads_per_worker : threads per worker of the distributed cluster
+    memory_limit : memory budget ("8GB" or bytes), per worker for the distributed cluster. Also sizes the
+        batches of frames that FF-PIV correlates at once, instead of a share of the available memory.
+    piv_chunk : frames per PIV batch, overrides the batch size derived from memory
+    prefetch : decode the clip once in a background thread, ahead of the computation (Prefetch.PrefetchVideo)
+    decode_threads : FFmpeg decoding threads of the prefetcher, 0 for all cores
+
+    The defaults reproduce pyorc's defaults. Use ``with settings.compute():`` around the pipeline to apply the
+    scheduler, and chunk(), piv() and to_netcdf() for the arrays.
+    """
+
+    def __init__(self, time_chunk=20, scheduler=None, n_workers=None, threads_per_worker=1, memory_limit=None,
+                 piv_chunk=None, prefetch=True, decode_threads=0):
+        if scheduler is not None and scheduler not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler {scheduler}, choose from {SCHEDULERS}")
+        if int(time_chunk) < 2:
+            raise ValueError("time_chunk must be at least 2 frames")
+        self.time_chunk = int(time_chunk)
+        self.scheduler = scheduler
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.memory_limit = _parse_bytes(memory_limit)
+        self.piv_chunk = piv_chunk
+        self.prefetch = bool(prefetch)
+        self.decode_threads = int(decode_threads)
+        self._computing = False
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Settings from a dict such as the "execution" block of a job config. None gives the defaults.
+        """
+        if d is None:
+            return cls()
+        if isinstance(d, cls):
+            return d
+        return cls(**d)
+
+    def to_dict(self):
+        return {
+            "time_chunk": self.time_chunk,
+            "scheduler": self.scheduler,
+            "n_workers": self.n_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "memory_limit": self.memory_limit,
+            "piv_chunk": self.piv_chunk,
+            "prefetch": self.prefetch,
+            "decode_threads": self.decode_threads,
+        }
+
+    def video_kwargs(self):
+        """
+        Keyword arguments for Prefetch.PrefetchVideo, frames are read in delayed blocks of time_chunk.
+        """
+        return {"chunksize": self.time_chunk, "prefetch": self.prefetch, "decode_threads": self.decode_threads}
+
+    def chunk(self, da):
+        """
+        Rechunk frames (or a velocimetry dataset) to time_chunk frames along time, one chunk over space.
+        """
+        chunks = {dim: -1 for dim in da.dims if dim != "time"}
+        chunks["time"] = self.time_chunk
+        return da.chunk(chunks)
+
+    def piv_kwargs(self):
+        """
+        Keyword arguments for get_piv: memory_factor such that FF-PIV batches fit in memory_limit. A limit that
+        allows larger batches than pyorc's default memory_factor is not binding and keeps the default.
+        """
+        if self.memory_limit is None:
+            return {}
+        memory_factor = window.available_memory() / self.memory_limit
+        if memory_factor <= PYORC_MEMORY_FACTOR:
+            return {}
+        return {"memory_factor": memory_factor}
+
+    def piv(self, da_proj, engine="numba", **kwargs):
+        """
+        get_piv on projected frames, in batches of piv_chunk frames if set.
+        """
+        kwargs = {**self.piv_kwargs(), **kwargs}
+        if self.piv_chunk is None:
+            return da_proj.frames.get_piv(engine=engine, **kwargs)
+        chunks = list(iter_piv_chunks(da_proj, chunk_size=self.piv_chunk, engine=engine, **kwargs))
+        return xr.concat(chunks, dim="time")
+
+    def to_netcdf(self, ds, path, **kwargs):
+        """
+        Write with time_chunk frames per chunk, computed with the configured scheduler.
+        """
+        with self.compute():
+            if self.scheduler == "processes":
+                # the lock of the netCDF file cannot be shared with worker processes, compute first and
+                # write from this process
+                return ds.load().to_netcdf(path, **kwargs)
+            if "time" in ds.dims:
+                ds = self.chunk(ds)
+            return ds.to_netcdf(path, **kwargs)
+
+    @contextlib.contextmanager
+    def compute(self):
+        """
+        Context in which dask computes with the configured scheduler and workers. Nested calls reuse the
+        outer context, so that only one local cluster is started.
+        """
+        if self._computing:
+            yield None
+            return
+        self._computing = True
+        try:
+            with self._scheduler() as client:
+                yield client
+        finally:
+            self._computing = False
+
+    @contextlib.contextmanager
+    def _scheduler(self):
+        if self.scheduler == "distributed":
+            try:
+                from distributed import Client, LocalCluster
+            except ImportError as e:
+                raise ImportError("scheduler='distributed' needs the distributed package") from e
+            with LocalCluster(n_workers=self.n_workers, threads_per_worker=self.threads_per_worker,
+                              memory_limit=self.memory_limit or "auto", processes=True) as cluster, \
+                    Client(cluster) as client:
+                yield client
+            return
+        config = {}
+        if self.scheduler is not None:
+            config["scheduler"] = self.scheduler
+        if self.n_workers is not None:
+            config["num_workers"] = int(self.n_workers)
+        with dask.config.set(config):
+            yield None
+
+    def __repr__(self):
+        items = ", ".join(f"{k}={v!r}" for k, v in self.to_dict().items())
+        return f"ExecutionSettings({items})"
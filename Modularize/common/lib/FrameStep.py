@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+
+def _as_array(frames, idx):
+    # numpy frames, or lazy pyorc frames of which only the sampled ones are computed
+    if hasattr(frames, "isel"):
+        return frames.isel(time=list(idx)).values
+    return np.asarray(frames)[list(idx)]
+
+
+def _to_uint8(img):
+    if img.dtype == np.uint8:
+        return img
+    img = np.nan_to_num(img.astype(np.float32))
+    lo, hi = img.min(), img.max()
+    return ((img - lo) / (hi - lo if hi > lo else 1.) * 255).astype(np.uint8)
+
+
+def pair_displacement(img_a, img_b, downscale=4, percentile=90, min_texture=2.0):
+    """
+    Coarse displacement [pixels of the full frame] between two frames.
+
+    Dense Farneback optical flow on frames downscaled by downscale, the percentile of the flow magnitude over
+    textured pixels (local contrast above min_texture), so that still and featureless areas do not drag the
+    estimate of the flow down.
+    """
+    a, b = _to_uint8(img_a), _to_uint8(img_b)
+    if downscale > 1:
+        size = (max(a.shape[1] // downscale, 16), max(a.shape[0] // downscale, 16))
+        a = cv2.resize(a, size, interpolation=cv2.INTER_AREA)
+        b = cv2.resize(b, size, interpolation=cv2.INTER_AREA)
+    flow = cv2.calcOpticalFlowFarneback(a, b, None, pyr_scale=0.5, levels=3, winsize=15, iterations=3, poly_n=5,
+                                        poly_sigma=1.2, flags=0)
+    magnitude = np.hypot(flow[..., 0], flow[..., 1])
+    texture = cv2.GaussianBlur(np.abs(cv2.Laplacian(a.astype(np.float32), cv2.CV_32F)), (0, 0), 2)
+    valid = texture > min_texture
+    if valid.sum() < 0.01 * valid.size:
+        valid = np.ones_like(valid)
+    return float(np.percentile(magnitude[valid], percentile)) * max(downscale, 1)
+
+
+def estimate_displacement(frames, step=1, n_pairs=5, start=0, stop=None, **kwargs):
+    """
+    Displacement [pixels per frame] of frames start to stop, the median of pair_displacement over n_pairs frame
+    pairs at spacing step, spread evenly over the range.
+    """
+    stop = len(frames) if stop is None else min(stop, len(frames))
+    step = max(min(step, stop - start - 1), 1)
+    firsts = np.unique(np.linspace(start, stop - 1 - step, max(n_pairs, 1)).round().astype(int))
+    idx = sorted(set(firsts) | set(firsts + step))
+    imgs = dict(zip(idx, _as_array(frames, idx)))
+    displacements = [pair_displacement(imgs[n], imgs[n + step], **kwargs) for n in firsts]
+    return float(np.median(displacements)) / step
+
+
+def select_frame_step(displacement, window_size, target=0.25, max_step=10):
+    """
+    Frame spacing that moves the flow by about target * window_size pixels (a quarter of the interrogation window
+    is the usual PIV rule), for a displacement in pixels per frame. At least 1, at most max_step.
+    """
+    if not np.isfinite(displacement) or displacement <= 0:
+        return max_step
+    return int(np.clip(np.floor(target * window_size / displacement), 1, max_step))
+
+
+def frame_step_schedule(frames, window_size, target=0.25, max_step=10, window_frames=None, n_pairs=5, **kwargs):
+    """
+    Adaptive frame spacing per time window of window_frames frames (the whole clip if None).
+
+    The displacement of every window is estimated on a cheap coarse pass over n_pairs frame pairs, see
+    estimate_displacement. Returns a list of dicts with the start and stop frame, the displacement [pixels per
+    frame] and the frame step of each window.
+    """
+    n_frames = len(frames)
+    window_frames = n_frames if window_frames is None else max(int(window_frames), 2)
+    schedule = []
+    for start in range(0, n_frames - 1, window_frames):
+        stop = min(start + window_frames, n_frames)
+        if stop - start < 2:
+            break
+        displacement = estimate_displacement(frames, n_pairs=n_pairs, start=start, stop=stop, **kwargs)
+        schedule.append({
+            "start": start,
+            "stop": stop,
+            "displacement": displacement,
+            "step": select_frame_step(displacement, window_size, target=target, max_step=max_step),
+        })
+    return schedule
+
+
+def schedule_indices(schedule):
+    """
+    Frame indices that the schedule keeps, consecutive kept frames are the PIV pairs. Every window starts on a
+    kept frame.
+    """
+    idx = []
+    for window in schedule:
+        idx.extend(range(window["start"], window["stop"], window["step"]))
+    return np.array(idx)
+
+
+def adaptive_frames(da, window_size=None, target=0.25, max_step=10, window_frames=None, **kwargs):
+    """
+    Projected pyorc frames thinned to an adaptive frame step, for get_piv, and the schedule used.
+
+    window_size defaults to the PIV window size of the camera config. PIV derives dt from the time coordinate, so
+    velocities of the thinned frames need no correction.
+    """
+    if window_size is None:
+        window_size = da.frames.camera_config.window_size
+    schedule = frame_step_schedule(da, window_size, target=target, max_step=max_step, window_frames=window_frames,
+                                   **kwargs)
+    return da.isel(time=schedule_indices(schedule)), schedule
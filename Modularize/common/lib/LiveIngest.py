@@ -0,0 +1,344 @@
+import copy
+import json
+import math
+import os
+import threading
+import time
+import warnings
+from collections import deque
+
+import cv2
+import numpy as np
+import xarray as xr
+from pyorc import const, helpers
+from pyorc.project import img_to_ortho
+
+from common.lib.Progress import velocity_stats
+from common.lib.Streaming import DEFAULT_MASKS, apply_masks
+from common.lib.Transects import get_transects
+
+
+class FrameProjector:
+    """
+    Projects single gray frames to the grid of a camera configuration, as pyorc's frames.project(method="numpy").
+
+    pyorc derives the pixel to grid index mapping on every project call (seconds for a full HD camera), here it
+    is derived once so that every incoming frame only costs a gather and a group average.
+    """
+
+    def __init__(self, camera_config, h_a=0., camera_shape=None):
+        cc = copy.deepcopy(camera_config)
+        shape = cc.shape
+        y = np.flipud(np.linspace(cc.resolution / 2, cc.resolution * (shape[0] - 0.5), shape[0]))
+        x = np.linspace(cc.resolution / 2, cc.resolution * (shape[1] - 0.5), shape[1])
+        cols, rows = np.meshgrid(np.arange(len(x)), np.arange(len(y)))
+        xs, ys = helpers.get_xs_ys(cols, rows, cc.transform)
+        lons, lats = helpers.get_lons_lats(xs, ys, cc.crs) if hasattr(cc, "crs") else (None, None)
+        z = cc.get_z_a(h_a)
+        idx_img, idx_ortho = cc.map_idx_img_ortho(x, y, z)
+        src_idx, uidx, norm_idx = cc.map_mean_idx_img_ortho(x, y, z)
+        self._mapping = {"x": x, "y": y, "idx_img": idx_img, "idx_ortho": idx_ortho, "src_idx": src_idx,
+                         "uidx": uidx, "norm_idx": norm_idx}
+        self.shape = (len(y), len(x))
+        if camera_shape is None:
+            camera_shape = [cc.height, cc.width]
+        attrs = {"camera_shape": str(list(camera_shape)), "camera_config": cc.to_json(), "h_a": json.dumps(h_a)}
+        template = xr.DataArray(np.zeros((0,) + self.shape, dtype=np.uint8), dims=("time", "y", "x"),
+                                coords={"time": np.zeros(0), "y": y, "x": x}, attrs=attrs, name="frames")
+        self.template = template.frames.add_xy_coords({"xs": xs, "ys": ys, "lon": lons, "lat": lats},
+                                                      {"y": y, "x": x}, const.GEOGRAPHICAL_ATTRS)
+
+    def project(self, img):
+        """
+        Projected frame of a gray frame, in the dtype of the frame as pyorc's project.
+        """
+        return np.nan_to_num(img_to_ortho(img, **self._mapping), copy=False).astype(img.dtype)
+
+    def to_dataarray(self, frames, times):
+        """
+        Projected frames with pyorc's coordinates and attributes, ready for the frames accessor.
+        """
+        coords = {name: coord for name, coord in self.template.coords.items() if name != "time"}
+        coords["time"] = np.asarray(times, dtype=float)
+        return xr.DataArray(frames, dims=self.template.dims, coords=coords, attrs=self.template.attrs,
+                            name=self.template.name)
+
+
+class FrameRingBuffer:
+    """
+    The capacity most recent frames and their times in one preallocated array, memory does not grow with the
+    length of the stream.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8):
+        self.capacity = int(capacity)
+        self._frames = np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+        self._times = np.zeros(self.capacity)
+        self._next = 0
+        self.n_pushed = 0
+
+    def push(self, frame, t):
+        self._frames[self._next] = frame
+        self._times[self._next] = t
+        self._next = (self._next + 1) % self.capacity
+        self.n_pushed += 1
+
+    def __len__(self):
+        return min(self.n_pushed, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self._frames.nbytes + self._times.nbytes
+
+    @property
+    def latest_time(self):
+        return self._times[self._next - 1] if self.n_pushed else None
+
+    def latest(self, n=None):
+        """
+        Copies of the n most recent frames and times (all buffered frames if None), oldest first.
+        """
+        n = len(self) if n is None else min(n, len(self))
+        idx = (self._next - n + np.arange(n)) % self.capacity
+        return self._frames[idx], self._times[idx]
+
+
+class StreamReader(threading.Thread):
+    """
+    Reads gray frames from a cv2.VideoCapture source (camera index, RTSP/HTTP url or file) into a bounded queue.
+
+    A live source never waits for the consumer: when the queue is full the oldest frame is dropped (counted in
+    ``dropped``), so latency stays bounded. A replayed file waits instead, unless realtime=True, in which case it
+    is also read at its own frame rate, as a stand-in for a camera.
+    """
+
+    def __init__(self, source, max_queue=64, realtime=None, fps=None):
+        super().__init__(daemon=True)
+        self.source = source
+        self.cap = cv2.VideoCapture(source)
+        if not self.cap.isOpened():
+            raise IOError(f"Cannot open video source {source}")
+        self.is_file = isinstance(source, str) and os.path.isfile(source)
+        self.realtime = (not self.is_file) if realtime is None else realtime
+        self.drop = self.realtime
+        self.fps = fps or self.cap.get(cv2.CAP_PROP_FPS) or 25.
+        self.camera_shape = [int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))]
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.n_read = 0
+        self.finished = False
+        self.error = None
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            while not self._stop_event.is_set():
+                ret, img = self.cap.read()
+                if not ret:
+                    break
+                if self.is_file:
+                    t = self.n_read / self.fps
+                    if self.realtime:
+                        time.sleep(max(start + t - time.monotonic(), 0.))
+                else:
+                    t = time.monotonic() - start
+                self.n_read += 1
+                item = (cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), t, time.monotonic())
+                with self._cond:
+                    while len(self._queue) >= self.max_queue:
+                        if self.drop:
+                            self._queue.popleft()
+                            self.dropped += 1
+                        elif self._stop_event.is_set():
+                            return
+                        else:
+                            self._cond.wait(0.1)
+                    self._queue.append(item)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.cap.release()
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+
+    def get_batch(self, timeout=1.0):
+        """
+        All queued (frame, time [s], monotonic read time) items, waiting up to timeout for at least one.
+        """
+        with self._cond:
+            if not self._queue and not self.finished:
+                self._cond.wait(timeout)
+            batch = list(self._queue)
+            self._queue.clear()
+            self._cond.notify_all()
+        return batch
+
+    def stop(self):
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+
+
+class LiveVelocimetry:
+    """
+    Rolling velocimetry on a live camera stream.
+
+    Frames are read by a StreamReader and projected one by one (FrameProjector) on an ingest thread, into a
+    FrameRingBuffer holding the last buffer_seconds. Every interval seconds of stream time, PIV runs on the last
+    window seconds of frames, masked with the chain of Streaming.DEFAULT_MASKS, and velocity statistics and, with
+    cross_sections, river flow of the window are published. Memory is bounded by the queue, the ring buffer and
+    one window of PIV results. Ingest continues while PIV runs; for a live source an update that is overtaken by
+    the next one is skipped, so latency stays within about one update. A replayed file (realtime=False) pauses
+    instead, and gives the same windows on every run.
+
+    source : camera index, RTSP/HTTP url, or a video file that is replayed (see StreamReader for realtime)
+    camera_config : pyorc.CameraConfig of the fixed camera
+    cross_sections, names, crs, v_corr, fill_method, quantiles : as Transects.get_transects
+    piv_kwargs : passed to get_piv, default engine "numba"
+    """
+
+    def __init__(self, source, camera_config, h_a=0., window=5.0, interval=5.0, buffer_seconds=None,
+                 cross_sections=None, names=None, crs=None, v_corr=0.9, fill_method="zeros", quantiles=None,
+                 masks=DEFAULT_MASKS, piv_kwargs=None, realtime=None, fps=None, max_queue=64):
+        self.reader = StreamReader(source, max_queue=max_queue, realtime=realtime, fps=fps)
+        self.fps = self.reader.fps
+        self.window = window
+        self.interval = interval
+        self.min_frames = 8  # pyorc's normalize samples 15 frames
+        buffer_seconds = max(buffer_seconds or window, window)
+        self.projector = FrameProjector(camera_config, h_a=h_a, camera_shape=self.reader.camera_shape)
+        self.ring = FrameRingBuffer(max(int(math.ceil(buffer_seconds * self.fps)) + 1, self.min_frames),
+                                    self.projector.shape)
+        self.cross_sections = cross_sections
+        self.transect_kwargs = {"names": names, "crs": crs, "v_corr": v_corr, "fill_method": fill_method,
+                                "quantiles": quantiles}
+        self.masks = masks
+        self.piv_kwargs = {"engine": "numba", **(piv_kwargs or {})}
+        self.n_updates = 0
+        self.skipped = 0
+        self.velocimetry = None
+        self.transects = None
+        self._cond = threading.Condition()
+        self._due = False
+        self._done = False
+        self._error = None
+        self._last_read = None
+        self._next_time = None
+        self._ingest_thread = threading.Thread(target=self._ingest, daemon=True)
+
+    def _ingest(self):
+        try:
+            while True:
+                batch = self.reader.get_batch()
+                if not batch and self.reader.finished:
+                    break
+                for img, t, read_at in batch:
+                    frame = self.projector.project(img)
+                    with self._cond:
+                        # a replay waits for the pending update, a live source overwrites it
+                        while self._due and not self.reader.drop and not self.reader._stop_event.is_set():
+                            self._cond.wait(0.1)
+                        self.ring.push(frame, t)
+                        self._last_read = read_at
+                        if self._next_time is None:
+                            self._next_time = t + self.window
+                        # normalize needs min_frames frames, a short window waits for them
+                        if t >= self._next_time and len(self.ring) >= self.min_frames:
+                            if self._due:
+                                self.skipped += 1
+                            self._due = True
+                            self._next_time = t + self.interval
+                            self._cond.notify_all()
+            if self.reader.error is not None:
+                raise self.reader.error
+        except Exception as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _snapshot(self):
+        frames, times = self.ring.latest()
+        in_window = times >= times[-1] - self.window - 0.5 / self.fps
+        if in_window.sum() < self.min_frames:
+            in_window[-self.min_frames:] = True
+        return frames[in_window], times[in_window], self._last_read
+
+    def update(self, frames, times, read_at=None):
+        """
+        Velocimetry and discharge of a window of projected frames, returns the published summary.
+        """
+        started = time.monotonic()
+        da = self.projector.to_dataarray(frames, times)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            ds = da.frames.normalize().frames.get_piv(**self.piv_kwargs).load()
+        self.velocimetry = apply_masks(ds, self.masks)
+        summary = {
+            "update": self.n_updates,
+            "time": float(times[-1]),
+            "window": [float(times[0]), float(times[-1])],
+            "frames": len(times),
+            "frames_read": self.reader.n_read,
+            "dropped": self.reader.dropped,
+            "skipped": self.skipped,
+            "buffer_mb": self.ring.nbytes / 2**20,
+            "velocity": velocity_stats(self.velocimetry),
+        }
+        if self.cross_sections is not None:
+            self.transects = get_transects(self.velocimetry, self.cross_sections, **self.transect_kwargs)
+            river_flow = self.transects["river_flow"]
+            summary["quantiles"] = river_flow["quantile"].values.tolist()
+            summary["river_flow"] = {str(name): river_flow.sel(transect=name).values.tolist()
+                                     for name in river_flow["transect"].values}
+        now = time.monotonic()
+        summary["compute"] = now - started
+        if read_at is not None:
+            # from reading the newest frame of the window to publishing its results
+            summary["latency"] = now - read_at
+        self.n_updates += 1
+        return summary
+
+    def run(self, max_updates=None, callback=None):
+        """
+        Read the stream and yield a summary every interval seconds of stream time, until the stream ends, stop()
+        is called or max_updates summaries were published. At the end of the stream, frames after the last
+        update are published as well. callback, if given, is called with every summary.
+        """
+        self.reader.start()
+        self._ingest_thread.start()
+        published = None
+        try:
+            while True:
+                with self._cond:
+                    while not self._due and not self._done:
+                        self._cond.wait(1.0)
+                    if self._error is not None:
+                        raise self._error
+                    last = self.ring.latest_time
+                    final = self._done and not self._due
+                    if final and (last is None or last == published or len(self.ring) < self.min_frames):
+                        return
+                    frames, times, read_at = self._snapshot()
+                    self._due = False
+                    self._cond.notify_all()
+                summary = self.update(frames, times, read_at)
+                published = float(times[-1])
+                if callback is not None:
+                    callback(summary)
+                yield summary
+                if final or (max_updates is not None and self.n_updates >= max_updates):
+                    return
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.reader.stop()
+        with self._cond:
+            self._cond.notify_all()
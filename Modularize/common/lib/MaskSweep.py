@@ -0,0 +1,190 @@
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyorc import helpers
+
+from common.lib.Progress import report_stage
+from common.lib.Transects import get_transects, transect_points
+
+
+class MaskStatistics:
+    """
+    The per-sample quantities that pyorc's velocimetry masks threshold, derived once from a velocimetry dataset:
+    velocity components, correlation, signal to noise, speed and angle (time, y, x).
+
+    Every mask below reproduces the pyorc mask of the same name and parameters on a boolean validity array
+    instead of a masked copy of the dataset, so a chain is evaluated without touching the dataset.
+    """
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.dims = ds["v_x"].dims
+        self.v_x = ds["v_x"].values
+        self.v_y = ds["v_y"].values
+        self.corr = ds["corr"].values
+        self.s2n = ds["s2n"].values if "s2n" in ds else None
+        self.speed = (self.v_x ** 2 + self.v_y ** 2) ** 0.5
+        self.angle = np.arctan2(self.v_x, self.v_y)
+        self.valid = np.isfinite(self.v_x)
+        self.n_time = len(ds.time)
+
+    def masked(self, valid):
+        return np.where(valid, self.v_x, np.nan), np.where(valid, self.v_y, np.nan)
+
+    def corr_mask(self, valid, tolerance=0.1):
+        return self.corr > tolerance
+
+    def s2n_mask(self, valid, tolerance=10):
+        return self.s2n > tolerance
+
+    def minmax_mask(self, valid, s_min=0.1, s_max=5.0):
+        return (self.speed > s_min) & (self.speed < s_max)
+
+    def angle_mask(self, valid, angle_expected=0.5 * np.pi, angle_tolerance=0.25 * np.pi):
+        return np.abs(self.angle - angle_expected) < angle_tolerance
+
+    def rolling_mask(self, valid, wdw=5, tolerance=0.5):
+        s = np.where(valid, self.speed, np.nan)
+        s_rolling = xr.DataArray(np.nan_to_num(s, nan=0.), dims=self.dims).rolling(time=wdw, center=True).max()
+        return s > tolerance * s_rolling.values
+
+    def outliers_mask(self, valid, tolerance=1.0, mode="or"):
+        conditions = []
+        with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            for v in self.masked(valid):
+                conditions.append(np.abs((v - np.nanmean(v, axis=0)) / np.nanstd(v, axis=0)) < tolerance)
+        return conditions[0] | conditions[1] if mode == "or" else conditions[0] & conditions[1]
+
+    def variance_mask(self, valid, tolerance=5, mode="and"):
+        conditions = []
+        with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            for v in self.masked(valid):
+                # np.maximum with 1e30 as in pyorc
+                conditions.append(np.abs(np.nanstd(v, axis=0) / np.maximum(np.nanmean(v, axis=0), 1e30)) < tolerance)
+        return conditions[0] | conditions[1] if mode == "or" else conditions[0] & conditions[1]
+
+    def count_mask(self, valid, tolerance=0.33):
+        return valid.sum(axis=0) > tolerance * self.n_time
+
+    def _window(self, valid, reduce_time, wdw, **kwargs):
+        v_x, v_y = self.masked(valid)
+        dims = self.dims
+        if reduce_time:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                v_x, v_y = np.nanmean(v_x, axis=0), np.nanmean(v_y, axis=0)
+            dims = dims[1:]
+        ds = xr.Dataset({"v_x": (dims, v_x), "v_y": (dims, v_y)})
+        return ds, helpers.stack_window(ds, wdw=wdw, **kwargs)
+
+    def window_nan_mask(self, valid, tolerance=0.7, wdw=1, reduce_time=False, **kwargs):
+        _, ds_wdw = self._window(valid, reduce_time, wdw, **kwargs)
+        return (ds_wdw["v_x"].count(dim="stride") >= tolerance * len(ds_wdw.stride)).values
+
+    def window_mean_mask(self, valid, tolerance=0.7, wdw=1, mode="or", reduce_time=False, **kwargs):
+        ds, ds_wdw = self._window(valid, reduce_time, wdw, **kwargs)
+        ds_mean = ds_wdw.mean(dim="stride")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_condition = (np.abs(ds["v_x"] - ds_mean["v_x"]) / ds_mean["v_x"] < tolerance).values
+            y_condition = (np.abs(ds["v_y"] - ds_mean["v_y"]) / ds_mean["v_y"] < tolerance).values
+        return x_condition | y_condition if mode == "or" else x_condition & y_condition
+
+    def apply(self, valid, name, **kwargs):
+        """
+        Validity after one mask of the chain, masks without time apply to every time step.
+        """
+        mask = getattr(self, f"{name}_mask")(valid, **kwargs)
+        return valid & (mask if mask.ndim == valid.ndim else mask[None])
+
+
+def _grid(masks):
+    # (name, [kwargs, ...]) per mask, list values of the kwargs are the candidates of a sweep
+    grid = []
+    for name, kwargs in masks:
+        swept = {k: v for k, v in kwargs.items() if isinstance(v, list)}
+        options = [dict(kwargs, **dict(zip(swept, values))) for values in itertools.product(*swept.values())]
+        grid.append((name, list(swept), options))
+    return grid
+
+
+def chosen_masks(masks, row):
+    """
+    The mask chain (name, kwargs) of one result row of sweep_masks, with the candidate values as given (pandas
+    turns window sizes into floats).
+    """
+    chain = []
+    for name, kwargs in masks:
+        chosen = {}
+        for k, v in kwargs.items():
+            chosen[k] = next(c for c in v if c == row[f"{name}.{k}"]) if isinstance(v, list) else v
+        chain.append((name, chosen))
+    return chain
+
+
+def sweep_masks(ds, masks, cross_sections=None, names=None, crs=None, v_corr=0.9, fill_method="zeros",
+                quantile=0.5, progress=None):
+    """
+    Evaluate every combination of mask thresholds of a mask chain on one velocimetry dataset.
+
+    masks is a chain of (name, kwargs) pairs as for Streaming.apply_masks, in which a list value gives the
+    candidates of a parameter, e.g. ("corr", {"tolerance": [0.1, 0.2, 0.3]}). The statistics are derived once
+    (MaskStatistics) and the chain is walked depth first, so a mask is evaluated once per combination of the
+    masks before it instead of once per full combination, and the dataset is never copied. Validity is the same
+    as with the pyorc masks applied in place.
+
+    Returns a DataFrame with a row per combination: the swept parameters (as "<mask>.<parameter>"), the
+    fraction of the valid samples and grid cells that is kept, and the mean speed [m s-1] of the time-mean
+    velocity field. With cross_sections ((x, y, z) per cross-section, in crs) also the river flow [m3 s-1] at
+    quantile of every cross-section, from the same transect chain as get_transects.
+    """
+    stats = MaskStatistics(ds)
+    grid = _grid(masks)
+    n_total = int(np.prod([len(options) for _, _, options in grid]))
+    points = None
+    if cross_sections:
+        names = names or [f"transect_{n + 1}" for n in range(len(cross_sections))]
+        points = transect_points(ds, cross_sections, crs=crs)
+    n_valid = stats.valid.sum()
+    n_cells = stats.valid.any(axis=0).sum()
+    rows = []
+
+    def evaluate(valid, params):
+        v_x, v_y = stats.masked(valid)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            v_mean = np.nanmean(np.hypot(np.nanmean(v_x, axis=0), np.nanmean(v_y, axis=0)))
+        row = dict(params)
+        row.update({
+            "valid_fraction": float(valid.sum() / n_valid),
+            "cell_fraction": float(valid.any(axis=0).sum() / n_cells),
+            "v_mean": float(v_mean),
+        })
+        if points is not None:
+            ds_masked = ds.where(xr.DataArray(valid, dims=stats.dims))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                ds_q = get_transects(ds_masked, cross_sections, names=names, crs=crs, quantiles=[quantile],
+                                     v_corr=v_corr, fill_method=fill_method, points=points)
+            for name in names:
+                row[f"river_flow.{name}"] = float(ds_q["river_flow"].sel(transect=name).values[0])
+        rows.append(row)
+        if progress is not None:
+            progress.update("sweep", combinations=len(rows), combinations_total=n_total)
+
+    def walk(level, valid, params):
+        if level == len(grid):
+            evaluate(valid, params)
+            return
+        name, swept, options = grid[level]
+        for kwargs in options:
+            walk(level + 1, stats.apply(valid, name, **kwargs),
+                 {**params, **{f"{name}.{k}": kwargs[k] for k in swept}})
+
+    with report_stage(progress, "sweep", frames=stats.n_time):
+        walk(0, stats.valid, {})
+    return pd.DataFrame(rows)
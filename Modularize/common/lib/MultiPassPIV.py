@@ -0,0 +1,261 @@
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+from scipy.interpolate import RegularGridInterpolator
+
+
+def grid_centers(image_shape, window_size, overlap):
+    """
+    Row and column centers of the interrogation windows, the grid of openpiv's
+    pyprocess.get_coordinates(image_shape, window_size, overlap) (centered on the image).
+    """
+    step = window_size - overlap
+    centers = []
+    for size in image_shape[:2]:
+        n = (size - window_size) // step + 1
+        c = np.arange(n) * step + window_size / 2.0
+        c += (size - 1 - ((n - 1) * step + (window_size - 1))) // 2
+        centers.append(c)
+    return centers[0], centers[1]
+
+
+def window_fraction(mask, top, left, window_size):
+    """
+    Fraction of the pixels of each window that lie in mask (2D bool), for windows of window_size (int or
+    (rows, cols)) with top-left corners top, left. Parts of windows outside the image count as outside the mask.
+    """
+    wy, wx = (window_size, window_size) if np.isscalar(window_size) else window_size
+    integral = np.pad(np.cumsum(np.cumsum(np.asarray(mask, dtype=np.int64), axis=0), axis=1), ((1, 0), (1, 0)))
+    h, w = np.shape(mask)
+    t, b = np.clip(top, 0, h), np.clip(np.asarray(top) + wy, 0, h)
+    l, r = np.clip(left, 0, w), np.clip(np.asarray(left) + wx, 0, w)
+    return (integral[b, r] - integral[t, r] - integral[b, l] + integral[t, l]) / (wy * wx)
+
+
+class _PaddedImage:
+    """
+    Frame padded with its mean, so that shifted windows near the border stay inside, with strided access to all
+    windows of one size.
+    """
+
+    def __init__(self, img, pad):
+        img = np.asarray(img, dtype=np.float32)
+        self.pad = pad
+        self.data = np.pad(img, pad, mode="constant", constant_values=float(img.mean()))
+        self._views = {}
+
+    def windows(self, rows, cols, window_size):
+        """
+        Windows (n, window_size, window_size) whose top-left corners are at integer image positions rows, cols.
+        """
+        if window_size not in self._views:
+            self._views[window_size] = sliding_window_view(self.data, (window_size, window_size))
+        limit = self.data.shape[0] - window_size, self.data.shape[1] - window_size
+        r = np.clip(rows + self.pad, 0, limit[0])
+        c = np.clip(cols + self.pad, 0, limit[1])
+        return self._views[window_size][r, c]
+
+
+def _spectra(windows):
+    # normalized windows: zero mean and unit variance, so that correlation peaks are comparable
+    windows = windows - windows.mean(axis=(-2, -1), keepdims=True)
+    windows /= windows.std(axis=(-2, -1), keepdims=True) + 1e-6
+    return fft.rfft2(windows, workers=-1)
+
+
+def _correlation_peaks(fa, fb, window_size, exclude=2):
+    """
+    Sub-pixel displacement (rows, cols) and peak-to-peak signal to noise of circular FFT correlations.
+    """
+    corr = fft.fftshift(fft.irfft2(np.conj(fa) * fb, s=(window_size, window_size), workers=-1), axes=(-2, -1))
+    corr /= window_size * window_size
+    n = len(corr)
+    flat = corr.reshape(n, window_size * window_size)
+    peak = flat.argmax(axis=1)
+    pi, pj = np.divmod(peak, window_size)
+    idx = np.arange(n)
+    p1 = flat[idx, peak]
+    # second peak outside the neighbourhood of the first, for the signal to noise ratio
+    masked = corr.copy()
+    for d in range(-exclude, exclude + 1):
+        rows = np.clip(pi + d, 0, window_size - 1)[:, None]
+        cols = np.clip(pj[:, None] + np.arange(-exclude, exclude + 1), 0, window_size - 1)
+        masked[idx[:, None], rows, cols] = -np.inf
+    p2 = masked.reshape(n, window_size * window_size).max(axis=1, initial=-np.inf)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s2n = np.where(p2 > 0, p1 / p2, np.inf)
+
+    # three point gaussian fit, on positive correlation values
+    inner = (pi > 0) & (pi < window_size - 1) & (pj > 0) & (pj < window_size - 1)
+    ci, cj = np.clip(pi, 1, window_size - 2), np.clip(pj, 1, window_size - 2)
+    c = np.log(np.maximum(corr[idx, ci, cj], 1e-7))
+    cl, cr = (np.log(np.maximum(corr[idx, ci + d, cj], 1e-7)) for d in (-1, 1))
+    cd, cu = (np.log(np.maximum(corr[idx, ci, cj + d], 1e-7)) for d in (-1, 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        di = (cl - cr) / (2 * cl - 4 * c + 2 * cr)
+        dj = (cd - cu) / (2 * cd - 4 * c + 2 * cu)
+    di = np.where(np.isfinite(di) & (np.abs(di) < 1), di, 0.)
+    dj = np.where(np.isfinite(dj) & (np.abs(dj) < 1), dj, 0.)
+    rows = np.where(inner, pi + di - window_size // 2, np.nan)
+    cols = np.where(inner, pj + dj - window_size // 2, np.nan)
+    s2n = np.where(inner, s2n, 0.)
+    return rows, cols, s2n
+
+
+def median_test(u, v, threshold=2.0, eps=0.1):
+    """
+    Normalized median test (Westerweel & Scarano, 2005) on a displacement field in pixels, True for outliers.
+    Also returns the median of the 8 neighbours of every vector.
+    """
+    medians, residuals = [], []
+    for comp in (u, v):
+        padded = np.pad(comp, 1, mode="constant", constant_values=np.nan)
+        nb = sliding_window_view(padded, (3, 3)).reshape(comp.shape + (9,))
+        nb = np.delete(nb, 4, axis=-1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            med = np.nanmedian(nb, axis=-1)
+            res = np.nanmedian(np.abs(nb - med[..., None]), axis=-1)
+        medians.append(med)
+        residuals.append(np.abs(comp - med) / (res + eps))
+    outlier = ~np.isfinite(u) | ~np.isfinite(v) | (np.fmax(residuals[0], residuals[1]) > threshold)
+    return outlier, medians[0], medians[1]
+
+
+def _interpolate(field, rows, cols, new_rows, new_cols):
+    f = RegularGridInterpolator((rows, cols), field, bounds_error=False, fill_value=None)
+    rr, cc = np.meshgrid(new_rows, new_cols, indexing="ij")
+    return f((rr, cc))
+
+
+def _scatter(values, keep, fill):
+    # values of the kept windows back on all windows of a level
+    if keep is None:
+        return values
+    out = np.full(len(keep), fill, dtype=np.result_type(values, type(fill)))
+    out[keep] = values
+    return out
+
+
+class MultiPassPIV:
+    """
+    Coarse-to-fine PIV of frame pairs with window shifting.
+
+    The first level correlates windows of window_sizes[0] (half overlapping by default) without a prediction.
+    Every next level interpolates the validated displacement of the previous one to its finer grid and
+    correlates the windows of frame A with windows of frame B shifted by the (rounded) predicted displacement,
+    so that small windows find displacements beyond their own size. Within a level, iterations refine the shift;
+    the spectra of the windows of frame A are computed once per level and reused by every iteration, and the
+    spectra of an unshifted first level of frame B are reused as frame A of the next consecutive pair.
+    Outliers of the median test are replaced by their neighbourhood median before they predict the next level.
+
+    With a mask (bool frame, e.g. the water region of WaterMask), only windows that contain masked pixels are
+    correlated on every level, the others are NaN (and flagged as outliers) in the output.
+
+    window_sizes : interrogation window sizes [pixels] from coarse to fine, the last one sets the output grid
+    overlaps : overlap [pixels] per level, default half the window
+    iterations : correlations per level
+    mask : frame-sized bool array of the region to evaluate, None for all windows
+    """
+
+    def __init__(self, window_sizes=(64, 32), overlaps=None, iterations=(1, 2), median_threshold=2.0, mask=None):
+        self.window_sizes = list(window_sizes)
+        self.overlaps = list(overlaps) if overlaps is not None else [w // 2 for w in self.window_sizes]
+        if isinstance(iterations, int):
+            iterations = [iterations] * len(self.window_sizes)
+        self.iterations = list(iterations)
+        if not (len(self.window_sizes) == len(self.overlaps) == len(self.iterations)):
+            raise ValueError("window_sizes, overlaps and iterations need one value per level")
+        self.median_threshold = median_threshold
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        if self.mask is not None and not self.mask.any():
+            raise ValueError("mask does not contain any pixel to evaluate")
+        self._cache = None
+
+    def coordinates(self, image_shape):
+        """
+        x (columns) and y (rows) of the output vectors, as openpiv's get_coordinates of the finest level.
+        """
+        rows, cols = grid_centers(image_shape, self.window_sizes[-1], self.overlaps[-1])
+        return np.meshgrid(cols, rows)
+
+    def window_mask(self, image_shape, level=-1):
+        """
+        Windows of a level (the output grid by default) that are evaluated, all of them without a mask.
+        """
+        w, overlap = self.window_sizes[level], self.overlaps[level]
+        rows, cols = grid_centers(image_shape, w, overlap)
+        if self.mask is None:
+            return np.ones((len(rows), len(cols)), dtype=bool)
+        if self.mask.shape != tuple(image_shape[:2]):
+            raise ValueError(f"mask of shape {self.mask.shape} does not fit frames of shape {image_shape[:2]}")
+        top = (rows - w / 2).astype(int)
+        left = (cols - w / 2).astype(int)
+        tt, ll = np.meshgrid(top, left, indexing="ij")
+        return window_fraction(self.mask, tt, ll, w) > 0
+
+    def _level_zero(self, img, key, rows, cols, window_size):
+        if key is not None and self._cache is not None and self._cache[0] == key:
+            return self._cache[1]
+        return _spectra(img.windows(rows, cols, window_size))
+
+    def __call__(self, frame_a, frame_b, dt=1.0, keys=(None, None)):
+        """
+        Velocity u (columns), v (rows) [pixels / dt], peak-to-peak signal to noise and outlier flags of the
+        median test, on the grid of ``coordinates``. keys (e.g. frame numbers) identify the frames for the reuse
+        of spectra between consecutive pairs.
+        """
+        shape = np.shape(frame_a)
+        pad = 2 * max(self.window_sizes)
+        img_a, img_b = _PaddedImage(frame_a, pad), _PaddedImage(frame_b, pad)
+        u = v = None
+        prev = None
+        for level, (w, overlap, n_iter) in enumerate(zip(self.window_sizes, self.overlaps, self.iterations)):
+            rows, cols = grid_centers(shape, w, overlap)
+            top = (rows - w / 2).astype(int)
+            left = (cols - w / 2).astype(int)
+            tt, ll = np.meshgrid(top, left, indexing="ij")
+            tt, ll = tt.ravel(), ll.ravel()
+            keep = None if self.mask is None else self.window_mask(shape, level).ravel()
+            if keep is not None:
+                tt, ll = tt[keep], ll[keep]
+            if prev is None:
+                pred_u = np.zeros((len(rows), len(cols)))
+                pred_v = np.zeros((len(rows), len(cols)))
+            else:
+                pred_u = _interpolate(prev[2], prev[0], prev[1], rows, cols)
+                pred_v = _interpolate(prev[3], prev[0], prev[1], rows, cols)
+            fa = self._level_zero(img_a, keys[0] if level == 0 else None, tt, ll, w)
+            for _ in range(n_iter):
+                shift_u = np.clip(np.round(pred_u), -pad + w, pad - w).astype(int).ravel()
+                shift_v = np.clip(np.round(pred_v), -pad + w, pad - w).astype(int).ravel()
+                if keep is not None:
+                    shift_u, shift_v = shift_u[keep], shift_v[keep]
+                fb = _spectra(img_b.windows(tt + shift_v, ll + shift_u, w))
+                if level == 0 and not shift_u.any() and not shift_v.any():
+                    self._cache = (keys[1], fb) if keys[1] is not None else None
+                d_rows, d_cols, s2n = _correlation_peaks(fa, fb, w)
+                u = _scatter(shift_u + d_cols, keep, np.nan).reshape(len(rows), len(cols))
+                v = _scatter(shift_v + d_rows, keep, np.nan).reshape(len(rows), len(cols))
+                s2n = _scatter(s2n, keep, 0.)
+                outlier, med_u, med_v = median_test(u, v, threshold=self.median_threshold)
+                pred_u = np.nan_to_num(np.where(outlier, med_u, u))
+                pred_v = np.nan_to_num(np.where(outlier, med_v, v))
+            prev = (rows, cols, pred_u, pred_v)
+        s2n = s2n.reshape(u.shape)
+        return u / dt, v / dt, s2n, outlier
+
+
+def multipass_piv(frame_a, frame_b, dt=1.0, window_sizes=(64, 32), overlaps=None, iterations=(1, 2),
+                  median_threshold=2.0, mask=None):
+    """
+    One frame pair with MultiPassPIV. Returns x, y, u, v, sig2noise and outlier flags; x, y, u, v follow
+    openpiv's conventions (image coordinates, rows downward).
+    """
+    piv = MultiPassPIV(window_sizes=window_sizes, overlaps=overlaps, iterations=iterations,
+                       median_threshold=median_threshold, mask=mask)
+    x, y = piv.coordinates(np.shape(frame_a))
+    u, v, s2n, outlier = piv(frame_a, frame_b, dt=dt)
+    return x, y, u, v, s2n, outlier
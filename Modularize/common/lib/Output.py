@@ -0,0 +1,292 @@
+import os
+import shutil
+
+import numpy as np
+import xarray as xr
+from pyorc import const
+
+from common.lib.Execution import ExecutionSettings
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+SUMMARY_GROUPS = ["mean", "median", "quantile"]
+# velocities [m s-1] beyond which summary quantiles are clipped
+VALUE_RANGE = (-10., 10.)
+
+
+def output_format(path):
+    """
+    "zarr" for a path ending in .zarr, "netcdf" otherwise.
+    """
+    return "zarr" if os.path.splitext(str(path).rstrip("/"))[1] == ".zarr" else "netcdf"
+
+
+def time_chunk_size(ds, target_bytes=2 * 2**20):
+    """
+    Time steps per storage chunk, such that one chunk of a velocity variable is about target_bytes.
+
+    Chunks cover the whole grid: one time slice is read from a single chunk, and a mean over time reads all
+    chunks once, sequentially.
+    """
+    if "time" not in ds.dims:
+        return None
+    slice_bytes = max(int(np.prod([ds.sizes[d] for d in ds.dims if d != "time"])) * 4, 1)
+    return int(np.clip(target_bytes // slice_bytes, 1, ds.sizes["time"]))
+
+
+def encoding(ds, fmt="netcdf", time_chunk=None, complevel=4):
+    """
+    Per-variable encoding: pyorc's int16 packing of velocimetry variables, deflate with shuffle (netcdf) or
+    the default zarr compressor, and chunks of time_chunk time steps by the full grid. Grid coordinates are
+    compressed as well.
+    """
+    if time_chunk is None:
+        time_chunk = time_chunk_size(ds)
+    enc = {}
+    for name, var in ds.variables.items():
+        if name in ds.indexes:
+            continue
+        e = {}
+        if name in const.ENCODE_VARS:
+            e.update({k: v for k, v in const.ENCODING_PARAMS.items() if k != "zlib"})
+        elif var.dtype.kind == "f" and name in ds.data_vars:
+            # coordinates (xs, ys, lon, lat) keep full precision
+            e["dtype"] = "float32"
+        chunks = tuple(time_chunk if d == "time" else var.sizes[d] for d in var.dims)
+        if fmt == "netcdf":
+            if var.dtype.kind not in "fiub":
+                enc[name] = e
+                continue
+            e.update({"zlib": True, "complevel": complevel, "shuffle": True})
+            if var.ndim > 0:
+                e["chunksizes"] = chunks
+        elif var.ndim > 0:
+            e["chunks"] = chunks
+        enc[name] = e
+    return enc
+
+
+class SummaryAccumulator:
+    """
+    Per-cell statistics over time of a velocimetry dataset, updated one time chunk at a time.
+
+    Mean and valid count are exact. Quantiles (and the median) of the velocity components come from per-cell
+    histograms with bins of resolution, centred on multiples of it. With the default of 0.01, the precision of
+    pyorc's int16 packing, they equal ``ds.quantile`` for stored results, and are within resolution / 2 otherwise.
+
+    The histograms only span the values seen so far, and never more than value_range [m s-1] (a (min, max) pair,
+    or a dict of them per variable): values outside count in the outermost bins, so quantiles that fall outside
+    the range are clipped to it. Outliers of unmasked PIV therefore cost at most
+    (max - min) / resolution + 1 bins per cell.
+    """
+
+    def __init__(self, quantiles=QUANTILES, resolution=0.01, quantile_vars=("v_x", "v_y"), value_range=VALUE_RANGE):
+        self.quantiles = list(quantiles)
+        self.resolution = resolution
+        self.quantile_vars = list(quantile_vars)
+        self.value_range = value_range
+        self._template = None
+        self._sum = {}
+        self._count = {}
+        self._hist = {}
+        self._base = {}
+
+    def _start(self, ds):
+        self._template = ds.isel(time=0, drop=True)
+        self.data_vars = [name for name in ds.data_vars if "time" in ds[name].dims]
+        self.quantile_vars = [name for name in self.quantile_vars if name in self.data_vars]
+
+    def update(self, ds):
+        """
+        Add the time steps of ds (a time chunk of the dataset) to the statistics.
+        """
+        if self._template is None:
+            self._start(ds)
+        for name in self.data_vars:
+            values = ds[name].transpose("time", ...).values
+            values = values.reshape(len(values), -1)
+            valid = np.isfinite(values)
+            if name not in self._sum:
+                self._sum[name] = np.zeros(values.shape[1])
+                self._count[name] = np.zeros(values.shape[1], dtype=np.int64)
+            self._sum[name] += np.where(valid, values, 0.).sum(axis=0)
+            self._count[name] += valid.sum(axis=0)
+            if name in self.quantile_vars:
+                self._add_histogram(name, values, valid)
+        return self
+
+    def _bin_range(self, name):
+        value_range = self.value_range
+        if isinstance(value_range, dict):
+            value_range = value_range.get(name, VALUE_RANGE)
+        return tuple(int(np.round(v / self.resolution)) for v in value_range)
+
+    def _add_histogram(self, name, values, valid):
+        n_cells = values.shape[1]
+        bins = np.clip(np.round(values[valid] / self.resolution), *self._bin_range(name)).astype(np.int64)
+        if bins.size == 0:
+            return
+        cells = np.broadcast_to(np.arange(n_cells), values.shape)[valid]
+        lo, hi = bins.min(), bins.max()
+        if name not in self._hist:
+            self._base[name] = lo
+            self._hist[name] = np.zeros((hi - lo + 1, n_cells), dtype=np.int32)
+        base, hist = self._base[name], self._hist[name]
+        # grow the histogram when values fall outside the bins seen so far
+        pad_lo, pad_hi = max(base - lo, 0), max(hi - (base + len(hist) - 1), 0)
+        if pad_lo or pad_hi:
+            hist = np.pad(hist, ((pad_lo, pad_hi), (0, 0)))
+            base -= pad_lo
+        # counts of the occupied bins only, a dense bincount would copy the whole histogram per chunk
+        index, counts = np.unique((bins - base) * n_cells + cells, return_counts=True)
+        hist.reshape(-1)[index] += counts.astype(np.int32)
+        self._base[name], self._hist[name] = base, hist
+
+    def _quantiles(self, name):
+        count = self._count[name]
+        result = np.full((len(self.quantiles), len(count)), np.nan)
+        if name not in self._hist:
+            return result
+        cells = count > 0
+        cum = np.cumsum(self._hist[name][:, cells], axis=0, dtype=np.int32)
+        values = (self._base[name] + np.arange(len(cum))) * self.resolution
+        for n, q in enumerate(self.quantiles):
+            # linear interpolation between the two closest ranks, as numpy's default quantile method
+            rank = q * (count[cells] - 1)
+            lo, hi = np.floor(rank), np.ceil(rank)
+            v_lo = values[(cum <= lo).sum(axis=0)]
+            v_hi = values[(cum <= hi).sum(axis=0)]
+            result[n, cells] = v_lo + (rank - lo) * (v_hi - v_lo)
+        return result
+
+    def result(self):
+        """
+        Summary datasets keyed by group: "mean" (with the valid time steps per cell as "count"),
+        "median" and "quantile".
+        """
+        template = self._template
+        shape = {name: template[name].shape for name in self.data_vars}
+        ds_mean = template[self.data_vars].copy()
+        for name in self.data_vars:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = self._sum[name] / self._count[name]
+            ds_mean[name] = template[name].copy(data=mean.reshape(shape[name]))
+        if self.quantile_vars:
+            name = self.quantile_vars[0]
+            ds_mean["count"] = template[name].copy(data=self._count[name].reshape(shape[name]).astype(np.int32))
+            ds_mean["count"].attrs = {"long_name": "number of valid time steps"}
+        q = np.array(self.quantiles)
+        ds_quantile = template[self.quantile_vars].expand_dims(quantile=q).copy()
+        for name in self.quantile_vars:
+            data = self._quantiles(name).reshape((len(q),) + shape[name])
+            ds_quantile[name] = ds_quantile[name].copy(data=data)
+        ds_median = ds_quantile.sel(quantile=0.5, drop=True) if 0.5 in self.quantiles else None
+        summaries = {"mean": ds_mean, "quantile": ds_quantile}
+        if ds_median is not None:
+            summaries["median"] = ds_median
+        return summaries
+
+
+def summarize(ds, quantiles=QUANTILES, chunk_size=25, resolution=0.01, value_range=VALUE_RANGE):
+    """
+    Time-mean, median and time-quantile summaries of a velocimetry dataset, keyed by summary group, in one
+    pass over chunks of chunk_size time steps (see SummaryAccumulator). Lazy datasets are only loaded one
+    chunk at a time. With no quantiles only the "mean" is computed, without histograms.
+
+    The "mean" dataset can be used in place of ``ds.mean(dim="time", keep_attrs=True)``, "median" in place
+    of ``ds.median(dim="time")``.
+    """
+    if len(quantiles) == 0:
+        accumulator = SummaryAccumulator(quantile_vars=())
+    else:
+        accumulator = SummaryAccumulator(quantiles=sorted(set(quantiles) | {0.5}), resolution=resolution,
+                                         value_range=value_range)
+    for start in range(0, ds.sizes["time"], chunk_size):
+        accumulator.update(ds.isel(time=slice(start, start + chunk_size)))
+    summaries = accumulator.result()
+    if len(quantiles) == 0:
+        return {"mean": summaries["mean"]}
+    if 0.5 not in quantiles:
+        summaries["quantile"] = summaries["quantile"].sel(quantile=list(quantiles))
+    return summaries
+
+
+def _check_zarr():
+    try:
+        import zarr  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Writing or reading .zarr output needs the zarr package") from e
+
+
+def write(ds, path, time_chunk=None, complevel=4, summary=True, quantiles=QUANTILES, execution=None,
+          summaries=None):
+    """
+    Write a velocimetry dataset as compressed NetCDF4, or zarr for a path ending in .zarr.
+
+    The raw data is stored with storage chunks of time_chunk time steps (default: about 2 MB per chunk), with
+    the summaries of ``summarize`` in groups "mean", "median" and "quantile" of the same file or store, unless
+    summary=False (as for unmasked PIV, whose summaries are rarely read and whose outliers make the quantile
+    histograms wide). Summaries already computed with ``summarize`` can be passed as summaries.
+    execution (Execution.ExecutionSettings or dict) sets the scheduler that computes lazy data while writing.
+    """
+    fmt = output_format(path)
+    execution = ExecutionSettings.from_dict(execution)
+    if time_chunk is None:
+        time_chunk = time_chunk_size(ds)
+    if summaries is None:
+        summaries = summarize(ds, quantiles=quantiles) if summary else {}
+    if fmt == "zarr":
+        _check_zarr()
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        with execution.compute():
+            ds_write = ds.chunk({d: (time_chunk if d == "time" else -1) for d in ds.dims}) if time_chunk else ds
+            ds_write.to_zarr(path, mode="w", encoding=encoding(ds, fmt, time_chunk, complevel))
+            for group, ds_summary in summaries.items():
+                ds_summary.to_zarr(path, group=group, mode="a", encoding=encoding(ds_summary, fmt))
+        return path
+    execution.to_netcdf(ds, path, mode="w", format="NETCDF4",
+                        encoding=encoding(ds, fmt, time_chunk, complevel))
+    with execution.compute():
+        for group, ds_summary in summaries.items():
+            ds_summary.to_netcdf(path, group=group, mode="a", format="NETCDF4",
+                                 encoding=encoding(ds_summary, fmt, complevel=complevel))
+    return path
+
+
+def open_velocimetry(path, chunks=None):
+    """
+    Open a velocimetry result written by ``write`` (or any NetCDF with velocimetry variables).
+    """
+    if output_format(path) == "zarr":
+        _check_zarr()
+        return xr.open_zarr(path, chunks=chunks)
+    return xr.open_dataset(path, chunks=chunks)
+
+
+def open_summary(path, group="mean"):
+    """
+    Stored summary group ("mean", "median" or "quantile") of a result written by ``write``, None if it was written
+    without summaries.
+    """
+    if group not in SUMMARY_GROUPS:
+        raise ValueError(f"Unknown summary group {group}, choose from {SUMMARY_GROUPS}")
+    try:
+        if output_format(path) == "zarr":
+            _check_zarr()
+            return xr.open_zarr(path, group=group).load()
+        with xr.open_dataset(path, group=group) as ds:
+            return ds.load()
+    except (OSError, KeyError, FileNotFoundError):
+        return None
+
+
+def load_summary(path, group="mean", quantiles=QUANTILES):
+    """
+    Stored summary group of a result, computed from the raw data when it was not stored.
+    """
+    ds_summary = open_summary(path, group=group)
+    if ds_summary is None:
+        with open_velocimetry(path) as ds:
+            # the mean needs no quantile histograms
+            ds_summary = summarize(ds, quantiles=[] if group == "mean" else quantiles)[group]
+    return ds_summary
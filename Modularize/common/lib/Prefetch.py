@@ -0,0 +1,246 @@
+import atexit
+import queue
+import threading
+import weakref
+
+import cv2
+import numpy as np
+from pyorc import cv
+
+from common.lib.Stabilization import CachedVideo
+
+# decoders that are still running, stopped at exit: the interpreter must not tear down a capture mid-read
+_active = weakref.WeakSet()
+
+
+def open_capture(fn, threads=0):
+    """
+    cv2.VideoCapture with multithreaded FFmpeg decoding, threads=0 lets FFmpeg use all cores. Falls back to
+    the default backend if FFmpeg cannot open the file.
+    """
+    cap = cv2.VideoCapture(fn, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, int(threads)])
+    if not cap.isOpened():
+        cap = cv2.VideoCapture(fn)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video {fn}")
+    return cap
+
+
+class FramePrefetcher(threading.Thread):
+    """
+    Decodes frames start_frame to end_frame (inclusive) of a video in a background thread, chunksize frames at a
+    time, into n_buffers preallocated chunk buffers.
+
+    The decoder only fills free buffers, so it runs up to n_buffers chunks ahead of the consumer and memory
+    stays bounded. Frames are read and converted as pyorc's Video.get_frames_chunk does
+    (rotation, stabilization transforms ms per frame, method), so they are identical to pyorc's frames.
+
+    Iterating yields (index of the first frame, frames) per chunk. A buffer is handed back to the decoder when
+    the next chunk is requested: copy frames that must outlive the iteration step.
+    """
+
+    def __init__(self, fn, start_frame=0, end_frame=None, method="grayscale", rotation=None, ms=None,
+                 chunksize=20, n_buffers=3, threads=0):
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.start_frame = int(start_frame)
+        self.end_frame = end_frame
+        self.method = method
+        self.rotation = rotation
+        self.ms = ms
+        self.chunksize = int(chunksize)
+        self.n_buffers = int(n_buffers)
+        self.threads = threads
+        self.error = None
+        self.n_read = 0
+        self._buffers = None
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._stop_event = threading.Event()
+
+    def _read(self, cap):
+        ms = self.ms[self.n_read] if self.ms is not None else None
+        ret, img = cv.get_frame(cap, rotation=self.rotation, ms=ms, method=self.method)
+        return img if ret else None
+
+    def run(self):
+        cap = None
+        _active.add(self)
+        try:
+            cap = open_capture(self.fn, self.threads)
+            cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            n_frames = None if self.end_frame is None else self.end_frame - self.start_frame + 1
+            img = self._read(cap)
+            while img is not None and not self._stop_event.is_set():
+                if self._buffers is None:
+                    self._buffers = [np.empty((self.chunksize,) + img.shape, dtype=img.dtype)
+                                     for _ in range(self.n_buffers)]
+                    for idx in range(self.n_buffers):
+                        self._free.put(idx)
+                idx = self._free.get()
+                if idx is None:
+                    break
+                n_start, k = self.n_read, 0
+                while img is not None and k < self.chunksize and not self._stop_event.is_set():
+                    self._buffers[idx][k] = img
+                    k += 1
+                    self.n_read += 1
+                    img = None if self.n_read == n_frames else self._read(cap)
+                self._filled.put((n_start, k, idx))
+        except Exception as e:
+            self.error = e
+        finally:
+            if cap is not None:
+                cap.release()
+            self._filled.put(None)
+
+    def __iter__(self):
+        if self.ident is None:
+            self.start()
+        previous = None
+        while True:
+            item = self._filled.get()
+            if previous is not None:
+                self._free.put(previous)
+            if item is None:
+                break
+            n_start, k, previous = item
+            yield n_start, self._buffers[previous][:k]
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self._stop_event.set()
+        # wake up a decoder that waits for a free buffer
+        self._free.put(None)
+
+
+@atexit.register
+def _stop_all():
+    prefetchers = list(_active)
+    for prefetcher in prefetchers:
+        prefetcher.stop()
+    for prefetcher in prefetchers:
+        prefetcher.join(timeout=5)
+
+
+class _ClipStore(threading.Thread):
+    # at most max_chunks decoded chunks of a clip, filled from a FramePrefetcher while the computation reads the
+    # chunks that are ready. Chunks that were read are dropped first (oldest first) when a new chunk needs room,
+    # the decoder waits while all held chunks are still unread
+
+    def __init__(self, prefetcher, max_chunks):
+        super().__init__(daemon=True)
+        self.prefetcher = prefetcher
+        self.max_chunks = max(int(max_chunks), 1)
+        self.chunks = {}
+        self.read = []
+        self.n_ready = 0
+        self.finished = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def _full(self):
+        return len(self.chunks) >= self.max_chunks and not self.read
+
+    def run(self):
+        try:
+            for n_start, frames in self.prefetcher:
+                frames = frames.copy()
+                with self._cond:
+                    self._cond.wait_for(lambda: not self._full() or self.prefetcher._stop_event.is_set())
+                    if self.prefetcher._stop_event.is_set():
+                        break
+                    if len(self.chunks) >= self.max_chunks:
+                        del self.chunks[self.read.pop(0)]
+                    self.chunks[n_start] = frames
+                    self.n_ready = n_start + len(frames)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+
+    def _find(self, n_start, n_end):
+        for start, frames in self.chunks.items():
+            if start <= n_start and n_end <= start + len(frames):
+                return start, frames[n_start - start:n_end - start]
+        return None, None
+
+    def get(self, n_start, n_end):
+        """
+        Frames n_start to n_end, or None if they are not held (dropped already, spread over two chunks, or not
+        decoded while the store is full), then the caller reads them from the video itself.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.n_ready >= n_end or self.finished or self._full())
+            if self.error is not None:
+                raise self.error
+            start, frames = self._find(n_start, n_end)
+            if start is not None and start not in self.read:
+                self.read.append(start)
+                # a dropped chunk makes room for the decoder
+                self._cond.notify_all()
+        return frames
+
+    def stop(self):
+        self.prefetcher.stop()
+        with self._cond:
+            self._cond.notify_all()
+
+
+class PrefetchVideo(CachedVideo):
+    """
+    CachedVideo of which get_frames decodes the clip once, ahead of the computation.
+
+    pyorc reads every chunk of get_frames by opening and seeking the video, on the dask thread that needs it,
+    and again whenever a later step recomputes the chunk (normalize takes the mean over all frames, so every PIV
+    batch reads the whole clip). Here a FramePrefetcher decodes the clip sequentially with multithreaded FFmpeg
+    (decode_threads) in the background, and the chunks wait for their frames, so decoding overlaps with
+    normalize, project and PIV. At most max_chunks decoded chunks are held: chunks that were read are dropped
+    first, and the decoder waits while all of them are unread. A chunk read again after it was dropped is decoded
+    by pyorc as without prefetching, so a clip that fits in max_chunks chunks is decoded once. Frames are the
+    same as pyorc's. prefetch=False gives a plain CachedVideo.
+    """
+
+    def __init__(self, fn, *args, prefetch=True, decode_threads=0, n_buffers=3, max_chunks=8, **kwargs):
+        self.prefetch = prefetch
+        self.decode_threads = decode_threads
+        self.n_buffers = n_buffers
+        self.max_chunks = max_chunks
+        self._stores = {}
+        super().__init__(fn, *args, **kwargs)
+
+    def get_frames(self, method="grayscale"):
+        if self.prefetch and self.frames is None and method not in self._stores:
+            n_frames = len(self.frame_number)
+            prefetcher = FramePrefetcher(self.fn, start_frame=self.start_frame,
+                                         end_frame=self.start_frame + n_frames - 1, method=method,
+                                         rotation=self.rotation, ms=self.ms, chunksize=self.chunksize,
+                                         n_buffers=self.n_buffers, threads=self.decode_threads)
+            self._stores[method] = _ClipStore(prefetcher, self.max_chunks)
+            self._stores[method].start()
+        return super().get_frames(method=method)
+
+    def get_frames_chunk(self, n_start, n_end, method="grayscale"):
+        store = getattr(self, "_stores", {}).get(method)
+        frames = None if store is None else store.get(n_start, n_end)
+        if frames is None:
+            return super().get_frames_chunk(n_start, n_end, method=method)
+        return frames
+
+    def stop(self):
+        """
+        Stop decoding, e.g. when the computation ends before the last frame. Frames not yet decoded are read
+        by pyorc from then on.
+        """
+        for store in self._stores.values():
+            store.stop()
+
+    def __getstate__(self):
+        # worker processes (scheduler "processes" or "distributed") decode their chunks themselves
+        state = self.__dict__.copy()
+        state["_stores"] = {}
+        return state
@@ -4,13 +4,25 @@ import xarray as xr
 import cartopy
 import cartopy.crs as ccrs
 import cartopy.io.img_tiles as cimgt
-from dask.diagnostics import ProgressBar
 from matplotlib import patches
 import copy
 import numpy as np
 
+from common.lib.Convergence import ConvergenceMonitor
+from common.lib.Execution import ExecutionSettings
+from common.lib.FrameStep import adaptive_frames
+from common.lib.LiveIngest import LiveVelocimetry
+from common.lib.Output import load_summary, open_velocimetry, write
+from common.lib.Prefetch import PrefetchVideo
+from common.lib.Profiling import materialize, materializing, profile_stage, profiled
+from common.lib.Progress import report_stage, velocity_stats
+from common.lib.STIV import get_stiv
+from common.lib.Streaming import iter_piv_chunks, stream_discharge
+from common.lib.WaterMask import mask_frames, mask_velocimetry, water_roi
 
-def process(VideoPath , JSONpath , bbox_coords , NetCDF_path ):
+
+def process(VideoPath , JSONpath , bbox_coords , NetCDF_path , h_a=0. , progress=None , execution=None ,
+            frame_step=1 , water_mask=None , cross_sections=None , crs=None , converge=None):
 
     video_file = VideoPath # Parameter 1 - Vid Path
     cam_config = pyorc.load_camera_config(JSONpath) # Parameter 2 - JSON path
@@ -18,36 +30,127 @@ def process(VideoPath , JSONpath , bbox_coords , NetCDF_path ):
     # Parameter 3 - bbox coords as list 
     stabilize = bbox_coords 
 
-    video = pyorc.Video(
-        video_file,
-        camera_config=cam_config,
-        start_frame=0,
-        end_frame=125,
-        stabilize=stabilize,
-        h_a=0.,
-    )
-
-    da = video.get_frames()
-    da_norm = da.frames.normalize()
-    da_norm_proj = da_norm.frames.project(method="numpy") # remove method = numpy to use default OpenCV method 
-
-    da_rgb = video.get_frames(method="rgb")
-    da_rgb_proj = da_rgb.frames.project()
-
-    piv = da_norm_proj.frames.get_piv(engine="numba") # Velocimetry Computation (PIV / FFPIV / OpenPIV)
-
-    if (NetCDF_path):
-        piv.to_netcdf(NetCDF_path)    
+    # progress (Progress.ProgressReporter) receives an event per stage, and per PIV chunk.
+    # Stages are also timed by an active Profiling.Profiler, see Profiler.activate
+    # execution (Execution.ExecutionSettings or dict) sets time chunks, dask scheduler, workers and memory
+    # frame_step: spacing of the PIV frame pairs, or "auto" to pick it per clip from the flow (FrameStep)
+    # water_mask: only correlate the PIV windows on water (WaterMask). "geometry" (or True) takes the water
+    # from the stabilize polygon and the cross-sections ((x, y, z) per cross-section, in crs), "variance"
+    # from a temporal variance map of the projected frames
+    # converge: stop PIV once the running mean velocity, and river flow over the cross-sections, are stable
+    # (Convergence.ConvergenceMonitor), a tolerance or a dict of its settings. The velocimetry then only covers
+    # the frames used, see its "frames_used" and "converged" attributes. This saves the PIV of the remaining
+    # frames, not their decoding: pyorc's normalize takes its background from frames sampled over the whole
+    # clip, so the first chunk already reads the video to its end
+    execution = ExecutionSettings.from_dict(execution)
+    with execution.compute():
+        with report_stage(progress, "stabilize"):
+            # transforms are estimated on the first run and read from the video's sidecar afterwards,
+            # frames are decoded once in the background while the later stages compute
+            video = PrefetchVideo(
+                video_file,
+                camera_config=cam_config,
+                start_frame=0,
+                end_frame=125,
+                stabilize=stabilize,
+                h_a=h_a, # water level, e.g. WaterLevel.detect_water_level_video(...)["h"]
+                **execution.video_kwargs(),
+            )
+        n_frames = int(video.end_frame - video.start_frame + 1)
+
+        # unless materialized, decode, normalize and project only build the dask graph, and their frames are
+        # computed (and counted) by the PIV chunks. Their events then carry no frames, so no frames/s
+        lazy_frames = n_frames if materializing() else None
+        with report_stage(progress, "decode", frames=lazy_frames):
+            da = materialize(execution.chunk(video.get_frames()))
+        with profile_stage("normalize", frames=lazy_frames):
+            da_norm = materialize(execution.chunk(da.frames.normalize()))
+        with report_stage(progress, "project", frames=lazy_frames):
+            # remove method = numpy to use default OpenCV method
+            da_norm_proj = materialize(execution.chunk(da_norm.frames.project(method="numpy")))
+
+        # times of all frames of the clip, to count the frames read up to a PIV time step
+        clip_time = da_norm_proj.time.values
+        if frame_step == "auto":
+            with profile_stage("frame_step", frames=n_frames):
+                # the coarse pass and PIV read the same frames, keep them instead of decoding twice
+                da_norm_proj, schedule = adaptive_frames(da_norm_proj.persist())
+            if progress is not None:
+                progress.emit("frame_step", "completed", schedule=schedule)
+        elif frame_step > 1:
+            da_norm_proj = da_norm_proj.isel(time=slice(None, None, frame_step))
+        n_frames = len(da_norm_proj.time)
+        if n_frames < 2:
+            raise ValueError(f"PIV needs at least two frames, {n_frames} left after frame_step {frame_step}")
+
+        windows = None
+        if water_mask:
+            with profile_stage("water_mask", frames=n_frames):
+                if water_mask == "variance":
+                    # the variance map and PIV read the same frames, keep them instead of decoding twice
+                    da_norm_proj = da_norm_proj.persist()
+                    roi = water_roi(da_norm_proj, variance=True, h_a=h_a)
+                else:
+                    roi = water_roi(da_norm_proj, polygon=stabilize, cross_sections=cross_sections, crs=crs,
+                                    h_a=h_a)
+                da_norm_proj, windows = mask_frames(da_norm_proj, roi)
+            if progress is not None:
+                progress.emit("water_mask", "completed", windows=float(windows.mean()))
+
+        with report_stage(progress, "piv", frames=n_frames):
+            monitor = None
+            if converge is not None:
+                settings = converge if isinstance(converge, dict) else {"tolerance": converge}
+                monitor = ConvergenceMonitor(cross_sections=cross_sections, crs=crs, **settings)
+            if progress is None and monitor is None:
+                # Velocimetry Computation (PIV / FFPIV / OpenPIV)
+                piv = materialize(execution.piv(da_norm_proj, engine="numba"))
+                if windows is not None:
+                    piv = mask_velocimetry(piv, windows)
+            else:
+                # same result as one get_piv call, but with provisional statistics after every chunk
+                chunks = []
+                n_piv, frames_used = 0, 0
+                chunk_size = execution.piv_chunk or (25 if monitor is None else execution.time_chunk)
+                for ds_chunk in iter_piv_chunks(da_norm_proj, chunk_size=chunk_size, engine="numba",
+                                                **execution.piv_kwargs()):
+                    if windows is not None:
+                        ds_chunk = mask_velocimetry(ds_chunk, windows)
+                    chunks.append(ds_chunk)
+                    # chunks share a frame, the last frame of this one is frame n_piv of da_norm_proj. With a
+                    # frame_step the frames in between were read from the video as well
+                    n_piv += len(ds_chunk.time)
+                    frames_used = int(np.searchsorted(clip_time, da_norm_proj.time.values[n_piv])) + 1
+                    if progress is not None:
+                        progress.update("piv", frames=frames_used, frames_total=len(clip_time),
+                                        stats=velocity_stats(ds_chunk))
+                    if monitor is not None and monitor.update(ds_chunk)["converged"]:
+                        # no PIV of the frames after, the decoder has read them already for normalize
+                        video.stop()
+                        break
+                piv = xr.concat(chunks, dim="time")
+            if monitor is not None:
+                piv.attrs["frames_used"] = frames_used
+                piv.attrs["converged"] = int(monitor.converged)
+                if progress is not None:
+                    progress.emit("convergence", "completed", frames=frames_used, frames_total=len(clip_time),
+                                  **monitor.summary())
+
+        if (NetCDF_path):
+            # compressed NetCDF4, or zarr for a .zarr path, summaries are stored with the masked results
+            with profile_stage("write", frames=n_frames):
+                write(piv, NetCDF_path, summary=False, execution=execution)
 
     return piv 
 
 
 ##--------
 
-def mask(VideoPath , NetCDF_path , Masked_NetCDF_Path):
+def mask(VideoPath , NetCDF_path , Masked_NetCDF_Path , plot_path="Modularize/layered_plot.png" , progress=None ,
+         execution=None):
 
     video_file = VideoPath     # parameter 1 
-    ds = xr.open_dataset(NetCDF_path)  # parameter 2
+    ds = open_velocimetry(NetCDF_path)  # parameter 2
 
     video = pyorc.Video(video_file, start_frame=0, end_frame=125)
 
@@ -57,41 +160,44 @@ def mask(VideoPath , NetCDF_path , Masked_NetCDF_Path):
     #da_rgb = video.get_frames(method="rgb")
 
 
-    ds_mask2 = copy.deepcopy(ds)
-    ds_mask2.velocimetry.mask.corr(inplace=True)
-    ds_mask2.velocimetry.mask.minmax(inplace=True)
-    ds_mask2.velocimetry.mask.rolling(inplace=True)
-    ds_mask2.velocimetry.mask.outliers(inplace=True)
-    ds_mask2.velocimetry.mask.variance(inplace=True)
-    ds_mask2.velocimetry.mask.angle(angle_tolerance=0.5*np.pi)
-    ds_mask2.velocimetry.mask.count(inplace=True)
-    ds_mask2.velocimetry.mask.window_mean(wdw=2, inplace=True, tolerance=0.5, reduce_time=True)
+    with report_stage(progress, "mask", frames=len(ds.time)):
+        ds_mask2 = copy.deepcopy(ds)
+        ds_mask2.velocimetry.mask.corr(inplace=True)
+        ds_mask2.velocimetry.mask.minmax(inplace=True)
+        ds_mask2.velocimetry.mask.rolling(inplace=True)
+        ds_mask2.velocimetry.mask.outliers(inplace=True)
+        ds_mask2.velocimetry.mask.variance(inplace=True)
+        ds_mask2.velocimetry.mask.angle(angle_tolerance=0.5*np.pi)
+        ds_mask2.velocimetry.mask.count(inplace=True)
+        ds_mask2.velocimetry.mask.window_mean(wdw=2, inplace=True, tolerance=0.5, reduce_time=True)
+        if progress is not None:
+            progress.update("mask", stats=velocity_stats(ds_mask2))
 
     #ds_mean_mask2 = ds_mask2.mean(dim="time", keep_attrs=True)
 
 
-    ds_mask2.velocimetry.set_encoding()
-    ds_mask2.to_netcdf(Masked_NetCDF_Path)
+    with profile_stage("write"):
+        write(ds_mask2, Masked_NetCDF_Path, execution=execution)
 
-    mean_plt(VideoPath , NetCDF_path)
+    mean_plt(VideoPath , NetCDF_path , plot_path)
 
     return ds_mask2 
 
 
-def mean_plt(VideoPath , NetCDF_path):
-    ds = xr.open_dataset(NetCDF_path)  # parameter 2
+@profiled("plot")
+def mean_plt(VideoPath , NetCDF_path , plot_path="Modularize/layered_plot.png"):
+    # time-mean stored next to the results by Output.write, the raw data is only read if it is missing
+    ds_mean = load_summary(NetCDF_path, "mean")  # parameter 2
 
     video_file = VideoPath
     video = pyorc.Video(video_file, start_frame=0, end_frame=125)
     
-    video.camera_config = ds.velocimetry.camera_config
+    video.camera_config = ds_mean.velocimetry.camera_config
 
     da_rgb = video.get_frames(method="rgb")
     da_rgb_proj = da_rgb.frames.project()
     p = da_rgb_proj[0].frames.plot()
 
-    ds_mean = ds.mean(dim="time", keep_attrs=True)
-
     # first a pcolormesh
     ds_mean.velocimetry.plot.pcolormesh(
         ax=p.axes,
@@ -108,4 +214,70 @@ def mean_plt(VideoPath , NetCDF_path):
         width=0.0015,
     )
 
-    p.axes.figure.savefig("Modularize/layered_plot.png", dpi=300, bbox_inches="tight")
\ No newline at end of file
+    p.axes.figure.savefig(plot_path, dpi=300, bbox_inches="tight")
+
+
+def process_stream(VideoPath , JSONpath , bbox_coords , cross_sections , crs=None , chunk_size=25 , callback=None ,
+                   execution=None):
+
+    # provisional discharge per chunk of frames, while PIV is still running: a generator of the summaries, each
+    # yielded (and passed to callback) as soon as its chunk is done. Every chunk is computed in its own
+    # execution.compute() context, none is open while the consumer runs (with the distributed scheduler this
+    # starts a local cluster per chunk)
+    cam_config = pyorc.load_camera_config(JSONpath)
+    execution = ExecutionSettings.from_dict(execution)
+
+    video = PrefetchVideo(
+        VideoPath,
+        camera_config=cam_config,
+        start_frame=0,
+        end_frame=125,
+        stabilize=bbox_coords,
+        h_a=0.,
+        **execution.video_kwargs(),
+    )
+
+    da_norm_proj = execution.chunk(video.get_frames().frames.normalize().frames.project(method="numpy"))
+
+    # the final StreamingDischarge is the return value of the generator, as for stream_discharge
+    return (yield from stream_discharge(da_norm_proj, cross_sections, chunk_size=chunk_size, crs=crs,
+                                        callback=callback, compute=execution.compute,
+                                        piv_kwargs={"engine": "numba", **execution.piv_kwargs()}))
+
+
+def process_live(Source , JSONpath , cross_sections=None , crs=None , window=5.0 , interval=5.0 , h_a=0. ,
+                 callback=None , max_updates=None , **kwargs):
+
+    # rolling velocimetry on a camera stream (RTSP/HTTP url, camera index) or a replayed file, yields a summary
+    # with velocity statistics and river flow per transect every interval seconds, see LiveIngest.LiveVelocimetry
+    cam_config = pyorc.load_camera_config(JSONpath)
+    live = LiveVelocimetry(Source, cam_config, h_a=h_a, window=window, interval=interval,
+                           cross_sections=cross_sections, crs=crs, **kwargs)
+    return live.run(max_updates=max_updates, callback=callback)
+
+
+def process_stiv(VideoPath , JSONpath , bbox_coords , lines , NetCDF_path , h_a=0. , engine="gst" , window=None ,
+                 execution=None):
+
+    # surface velocity along search lines (STIV.lines_from_cross_section), instead of full-field PIV
+    cam_config = pyorc.load_camera_config(JSONpath)
+    execution = ExecutionSettings.from_dict(execution)
+
+    with execution.compute():
+        video = PrefetchVideo(
+            VideoPath,
+            camera_config=cam_config,
+            start_frame=0,
+            end_frame=125,
+            stabilize=bbox_coords,
+            h_a=h_a,
+            **execution.video_kwargs(),
+        )
+
+        da_norm_proj = execution.chunk(video.get_frames().frames.normalize().frames.project(method="numpy"))
+        stiv = get_stiv(da_norm_proj, lines, window=window, engine=engine, batch_size=execution.time_chunk)
+
+        if (NetCDF_path):
+            write(stiv, NetCDF_path, summary=False, execution=execution)
+
+    return stiv
@@ -0,0 +1,271 @@
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    # unix only
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_ENV = "PIPELINE_PROFILE"
+
+_active = contextvars.ContextVar("profiler", default=None)
+
+
+def _rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    return None
+
+
+def _max_rss_mb():
+    # peak RSS of the process so far, ru_maxrss is in kB on linux
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if psutil is not None:
+        # peak_wset is the peak working set on windows, other platforms only report the current RSS
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 2**20
+    return None
+
+
+class _PeakSampler(threading.Thread):
+    """
+    Samples the RSS of the process every interval [s], for the peak within one stage.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss_mb())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _rss_mb())
+        return self.peak
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, peak RSS and frames/s of pipeline stages.
+
+    Stages are marked with ``profiler.stage(name, frames)``, or anywhere down the call stack with
+    ``profile_stage`` / ``@profiled`` once the profiler is activated (``with profiler.activate():``).
+    Every stage gives one record, appended as a json line to log_path and passed to callback.
+
+    With cprofile=True each outermost stage also runs under cProfile (dask computations in it on the
+    synchronous scheduler, so that they are seen by the profiler) and is dumped to profile_dir/<stage>.prof.
+    With materialize=True, lazy stage results passed through ``materialize`` are computed inside their stage,
+    so time is attributed to the stage that defines it instead of the one that triggers the computation.
+    A disabled profiler (enabled=False) only costs a function call per stage.
+    """
+
+    def __init__(self, enabled=True, log_path=None, callback=None, cprofile=False, profile_dir=None,
+                 materialize=False, rss_interval=0.05):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.callback = callback
+        self.cprofile = cprofile
+        self.profile_dir = profile_dir
+        self.materialize = materialize
+        self.rss_interval = rss_interval
+        self.records = []
+        self._stack = []
+        self._cprofile_running = False
+
+    @classmethod
+    def from_env(cls, var=PROFILE_ENV, **kwargs):
+        """
+        Profiler enabled by an environment variable holding the json lines log path, e.g.
+        PIPELINE_PROFILE=profile.jsonl. Set PIPELINE_PROFILE_CPROFILE=1 for cProfile dumps next to it and
+        PIPELINE_PROFILE_MATERIALIZE=1 to compute every stage within its own timing.
+        """
+        log_path = os.environ.get(var)
+        if not log_path:
+            return cls(enabled=False)
+        kwargs.setdefault("cprofile", os.environ.get(f"{var}_CPROFILE", "") not in ("", "0"))
+        kwargs.setdefault("materialize", os.environ.get(f"{var}_MATERIALIZE", "") not in ("", "0"))
+        kwargs.setdefault("profile_dir", os.path.dirname(os.path.abspath(log_path)))
+        return cls(log_path=log_path, **kwargs)
+
+    def stage(self, name, frames=None):
+        """
+        Context manager recording one stage, with the number of frames processed in it for frames/s.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, frames)
+
+    @contextmanager
+    def _stage(self, name, frames):
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+        sampler = None
+        if psutil is not None and self.rss_interval:
+            sampler = _PeakSampler(self.rss_interval)
+            sampler.start()
+        profile, scheduler = None, nullcontext()
+        if self.cprofile and not self._cprofile_running:
+            import dask
+
+            profile = cProfile.Profile()
+            scheduler = dask.config.set(scheduler="synchronous")
+            self._cprofile_running = True
+        status, error = "completed", None
+        start = time.time()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        try:
+            with scheduler:
+                if profile is not None:
+                    profile.enable()
+                try:
+                    yield self
+                finally:
+                    if profile is not None:
+                        profile.disable()
+        except Exception as e:
+            status, error = "failed", str(e)
+            raise
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self._stack.pop()
+            record = {
+                "stage": name,
+                "parent": parent,
+                "status": status,
+                "start": start,
+                "wall": wall,
+                "cpu": cpu,
+                "cpu_util": cpu / wall if wall > 0 else None,
+                "frames": frames,
+                "fps": frames / wall if frames and wall > 0 else None,
+                "rss_mb": _rss_mb(),
+                "peak_rss_mb": sampler.stop() if sampler is not None else _max_rss_mb(),
+                "pid": os.getpid(),
+            }
+            if error is not None:
+                record["error"] = error
+            if profile is not None:
+                self._cprofile_running = False
+                record["profile_file"] = self._dump(profile, name)
+            self._record(record)
+
+    def _dump(self, profile, name):
+        profile_dir = self.profile_dir or "."
+        os.makedirs(profile_dir, exist_ok=True)
+        fn = os.path.join(profile_dir, f"{name}.prof")
+        profile.dump_stats(fn)
+        return fn
+
+    def _record(self, record):
+        self.records.append(record)
+        if self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.callback is not None:
+            self.callback(record)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the profiler of ``profile_stage``, ``@profiled`` and ``materialize`` calls within the block.
+        """
+        token = _active.set(self if self.enabled else None)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+    def summary(self):
+        """
+        Total wall and CPU time [s], frames and the highest peak RSS [MB] per stage name.
+        """
+        summary = {}
+        for r in self.records:
+            s = summary.setdefault(r["stage"], {"calls": 0, "wall": 0.0, "cpu": 0.0, "frames": 0, "peak_rss_mb": 0.0})
+            s["calls"] += 1
+            s["wall"] += r["wall"]
+            s["cpu"] += r["cpu"]
+            s["frames"] += r["frames"] or 0
+            s["peak_rss_mb"] = max(s["peak_rss_mb"], r["peak_rss_mb"] or 0.0)
+        for s in summary.values():
+            s["fps"] = s["frames"] / s["wall"] if s["frames"] and s["wall"] > 0 else None
+        return summary
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"records": self.records, "summary": self.summary()}, f, indent=2)
+        return path
+
+
+def get_profiler():
+    """
+    The active profiler, or None.
+    """
+    return _active.get()
+
+
+def profile_stage(name, frames=None):
+    """
+    Stage of the active profiler, a no-op without one.
+    """
+    profiler = _active.get()
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, frames=frames)
+
+
+def profiled(name=None):
+    """
+    Decorator recording every call of a function as a stage of the active profiler.
+    """
+    def decorator(func):
+        stage = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active.get()
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def materializing(profiler=None):
+    """
+    Whether ``materialize`` computes lazy results, i.e. whether the (active) profiler has materialize=True.
+    """
+    if profiler is None:
+        profiler = _active.get()
+    return profiler is not None and profiler.materialize
+
+
+def materialize(obj, profiler=None):
+    """
+    Compute a lazy xarray object right away if the (active) profiler asks for it (materialize=True),
+    otherwise return it as is.
+    """
+    if materializing(profiler):
+        return obj.load()
+    return obj
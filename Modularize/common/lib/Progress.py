@@ -0,0 +1,95 @@
+import time
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+
+from common.lib.Profiling import profile_stage
+
+
+class ProgressReporter:
+    """
+    Emits structured progress events of pipeline stages to a callback.
+
+    Every event is a dict with the stage name, its status ("started", "progress", "completed" or "failed"),
+    frames done and total, elapsed time [s] and throughput [frames/s], and optionally provisional
+    velocity statistics. With callback=None events are only kept in ``events``.
+    """
+
+    def __init__(self, callback=None, keep_events=True):
+        self.callback = callback
+        self.keep_events = keep_events
+        self.events = []
+        self._started = {}
+
+    def emit(self, stage, status, frames=None, frames_total=None, stats=None, **kwargs):
+        now = time.time()
+        elapsed = now - self._started.get(stage, now)
+        event = {
+            "stage": stage,
+            "status": status,
+            "time": now,
+            "elapsed": elapsed,
+            "frames": frames,
+            "frames_total": frames_total,
+            "fps": frames / elapsed if frames and elapsed > 0 else None,
+        }
+        if stats is not None:
+            event["stats"] = stats
+        event.update(kwargs)
+        if self.keep_events:
+            self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+        return event
+
+    def update(self, stage, frames=None, frames_total=None, stats=None, **kwargs):
+        return self.emit(stage, "progress", frames=frames, frames_total=frames_total, stats=stats, **kwargs)
+
+    @contextmanager
+    def stage(self, stage, frames=None):
+        """
+        Emit "started" on entry and "completed" (or "failed") on exit of a block, with frames processed in it.
+        """
+        self._started[stage] = time.time()
+        self.emit(stage, "started", frames=0, frames_total=frames)
+        try:
+            yield self
+        except Exception as e:
+            self.emit(stage, "failed", frames_total=frames, error=str(e))
+            raise
+        self.emit(stage, "completed", frames=frames, frames_total=frames)
+
+
+@contextmanager
+def report_stage(progress, stage, frames=None):
+    """
+    progress.stage(...) that is a no-op when progress is None. The stage is also recorded by the active
+    Profiling.Profiler, if any.
+    """
+    with profile_stage(stage, frames=frames):
+        if progress is None:
+            yield None
+        else:
+            with progress.stage(stage, frames=frames):
+                yield progress
+
+
+def velocity_stats(ds):
+    """
+    Provisional statistics of the velocity magnitude [m s-1] of a velocimetry dataset, for progress events.
+    """
+    v = np.hypot(ds["v_x"].values, ds["v_y"].values)
+    valid = v[np.isfinite(v)]
+    if valid.size == 0:
+        return {"valid_fraction": 0.0, "mean": None, "median": None, "p95": None, "max": None}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        p50, p95 = np.quantile(valid, [0.5, 0.95])
+    return {
+        "valid_fraction": float(valid.size / v.size),
+        "mean": float(valid.mean()),
+        "median": float(p50),
+        "p95": float(p95),
+        "max": float(valid.max()),
+    }
@@ -0,0 +1,210 @@
+import json
+
+import numpy as np
+import scipy.optimize
+from pyproj import CRS, Transformer
+
+COLUMNS = ["area", "perimeter", "width"]
+
+
+def _stations(profile, crs=None):
+    # horizontal distance along the profile and bed level of a (3, n) profile or (x, y, z) cross-section
+    x, y, z = (np.asarray(c, dtype=float) for c in profile)
+    if len(x) == 0:
+        # profile measured along y only, as the 2d profiles of app_calibration
+        x = np.zeros_like(y)
+    if crs is not None and CRS.from_user_input(crs).is_geographic:
+        # metres in a local equidistant projection around the cross-section
+        local = f"+proj=aeqd +lon_0={x.mean()} +lat_0={y.mean()} +units=m"
+        x, y = Transformer.from_crs(CRS.from_user_input(crs), CRS.from_proj4(local), always_xy=True).transform(x, y)
+    s = np.concatenate([[0.], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+    return s, z
+
+
+def wetted_geometry(s, z, levels):
+    """
+    Wetted area [m2], wetted perimeter [m] and top width [m] of a cross-section with bed levels z at stations s
+    [m], for every water level in levels (same datum as z). The bed is linear between the points, so every
+    segment is clipped exactly at the water surface. All parts of the section below a level count as wet, and
+    above a bank end the section is closed by a vertical wall.
+
+    Returns three arrays of the shape of levels.
+    """
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))[:, None]
+    ds, z0, z1 = np.diff(s), z[:-1], z[1:]
+    z_lo, z_hi = np.minimum(z0, z1), np.maximum(z0, z1)
+    length = np.hypot(ds, z1 - z0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # wet fraction of each segment, 1 for flat segments below the level
+        f = np.clip(np.where(z_hi > z_lo, (levels - z_lo) / (z_hi - z_lo), (levels > z_lo).astype(float)), 0, 1)
+    area = np.where(f >= 1, ds * (levels - 0.5 * (z0 + z1)), 0.5 * f * ds * np.maximum(levels - z_lo, 0))
+    walls = np.maximum(levels[:, 0] - z[0], 0) + np.maximum(levels[:, 0] - z[-1], 0)
+    return area.sum(axis=1), (f * length).sum(axis=1) + walls, (f * ds).sum(axis=1)
+
+
+class RatingTable:
+    """
+    Wetted area, wetted perimeter and top width of a cross-section for a dense grid of water levels, so that the
+    geometry of any level in between is a linear interpolation.
+
+    Levels are water surface elevations in the datum of the profile, from the lowest bed point up to z_max
+    (default the higher of the two profile ends). Use the profile of app_calibration.apply_transformations (its
+    third return value, (3, n) x, y, z) or a cross-section (x, y, z) of Transects.read_cross_section, with its
+    crs if that is geographic. A camera water level h_a converts with camera_config.get_z_a(h_a).
+    """
+
+    def __init__(self, levels, area, perimeter, width):
+        self.levels = np.asarray(levels, dtype=np.float64)
+        self.area = np.asarray(area, dtype=np.float32)
+        self.perimeter = np.asarray(perimeter, dtype=np.float32)
+        self.width = np.asarray(width, dtype=np.float32)
+
+    @classmethod
+    def from_profile(cls, profile, step=0.001, z_max=None, crs=None):
+        """
+        Table for levels every step [m] from the bed up to z_max.
+        """
+        s, z = _stations(profile, crs=crs)
+        if z_max is None:
+            z_max = max(z[0], z[-1])
+        levels = np.arange(z.min(), z_max + 0.5 * step, step)
+        return cls(levels, *wetted_geometry(s, z, levels))
+
+    @property
+    def bed_level(self):
+        return float(self.levels[0])
+
+    def lookup(self, h):
+        """
+        {"area", "perimeter", "width", "hydraulic_radius"} at water level(s) h, NaN outside the table.
+        """
+        result = {c: np.interp(h, self.levels, getattr(self, c), left=np.nan, right=np.nan) for c in COLUMNS}
+        area, perimeter = result["area"], result["perimeter"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result["hydraulic_radius"] = np.where(perimeter > 0, area / perimeter,
+                                                  np.where(np.isnan(perimeter), np.nan, 0.))
+        return result
+
+    def to_dict(self):
+        return {"levels": self.levels, **{c: getattr(self, c) for c in COLUMNS}}
+
+    def save(self, fn):
+        np.savez_compressed(fn, **self.to_dict())
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as f:
+            return cls(f["levels"], *(f[c] for c in COLUMNS))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __repr__(self):
+        return f"RatingTable({len(self)} levels, {self.levels[0]:.3f} to {self.levels[-1]:.3f} m)"
+
+
+def power_law(h, a, h0, b):
+    # Q = a (h - h0)^b, zero below the cease-to-flow level h0
+    return a * np.maximum(h - h0, 0) ** b
+
+
+class RatingCurve:
+    """
+    Stage-discharge relation of a cross-section, fitted to accumulated (level, discharge) observations, e.g.
+    the median river flow of every processed clip with its water level.
+
+    method "manning" fits one factor k in Q = k A R^(2/3) (Manning with k = sqrt(slope) / n), with area A and
+    hydraulic radius R from the RatingTable, so a single observation is enough. "power" fits Q = a (h - h0)^b,
+    which needs at least three observations over a range of levels. The fit is refitted only when observations
+    were added, and the discharge is then tabulated on the levels of the table, so that discharge(h) is an
+    interpolation (microseconds) for levels that come from optical water level detection.
+    """
+
+    def __init__(self, table, method="manning", observations=None, params=None):
+        if method not in ("manning", "power"):
+            raise ValueError(f"Unknown method {method}, choose from ['manning', 'power']")
+        self.table = table
+        self.method = method
+        self.observations = [tuple(map(float, o)) for o in observations or []]
+        self.params = params
+        self._q = None
+
+    def add(self, h, q):
+        """
+        Add an observation of discharge q [m3 s-1] at water level h.
+        """
+        if np.isfinite(h) and np.isfinite(q):
+            self.observations.append((float(h), float(q)))
+            self.params = None
+            self._q = None
+        return self
+
+    def _conveyance(self, h):
+        geometry = self.table.lookup(h)
+        return geometry["area"] * geometry["hydraulic_radius"] ** (2 / 3)
+
+    def fit(self):
+        """
+        Fit the parameters to the observations, returns them.
+        """
+        if not self.observations:
+            raise ValueError("RatingCurve needs observations to fit")
+        h, q = np.array(self.observations).T
+        if self.method == "manning":
+            c = self._conveyance(h)
+            valid = np.isfinite(c) & (c > 0)
+            if not valid.any():
+                raise ValueError("No observation is within the levels of the rating table")
+            # least squares through the origin
+            self.params = {"k": float((c[valid] * q[valid]).sum() / (c[valid] ** 2).sum())}
+        else:
+            if len(h) < 3:
+                raise ValueError("A power law rating curve needs at least 3 observations")
+            h0 = min(self.table.bed_level, h.min() - 0.01)
+            p0 = [q.max() / max(h.max() - h0, 1e-3), h0, 1.6]
+            bounds = ([0, self.table.bed_level - 1.0, 0.5], [np.inf, h.min() - 1e-6, 5.0])
+            popt, _ = scipy.optimize.curve_fit(power_law, h, q, p0=np.clip(p0, *bounds), bounds=bounds)
+            self.params = dict(zip(["a", "h0", "b"], map(float, popt)))
+        self._q = None
+        return self.params
+
+    def _tabulated(self):
+        if self.params is None:
+            self.fit()
+        if self._q is None:
+            levels = self.table.levels
+            if self.method == "manning":
+                self._q = self.params["k"] * self._conveyance(levels)
+            else:
+                self._q = power_law(levels, **self.params)
+        return self._q
+
+    def discharge(self, h):
+        """
+        Discharge [m3 s-1] at water level(s) h, NaN outside the levels of the table.
+        """
+        return np.interp(h, self.table.levels, self._tabulated(), left=np.nan, right=np.nan)
+
+    def residuals(self):
+        """
+        Observed minus rated discharge [m3 s-1] per observation.
+        """
+        h, q = np.array(self.observations).T
+        return q - self.discharge(h)
+
+    def save(self, fn):
+        """
+        Table, observations and fit in one compressed npz.
+        """
+        meta = {"method": self.method, "observations": self.observations, "params": self.params}
+        np.savez_compressed(fn, rating=json.dumps(meta), **self.table.to_dict())
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as f:
+            table = RatingTable(f["levels"], *(f[c] for c in COLUMNS))
+            meta = json.loads(str(f["rating"]))
+        return cls(table, **meta)
+
+    def __repr__(self):
+        return f"RatingCurve({self.method}, {len(self.observations)} observations, params={self.params})"
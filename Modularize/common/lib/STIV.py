@@ -0,0 +1,296 @@
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+from scipy.interpolate import interp1d
+from scipy.ndimage import gaussian_filter
+from pyorc import helpers
+
+
+VELOCITY_ATTRS = {
+    "v_x": {"standard_name": "sea_water_x_velocity", "long_name": "Flow element center velocity x-direction",
+            "units": "m s-1"},
+    "v_y": {"standard_name": "sea_water_y_velocity", "long_name": "Flow element center velocity y-direction",
+            "units": "m s-1"},
+    "corr": {"long_name": "Coherence of the space-time image streaks", "units": "-"},
+    "s2n": {"long_name": "Signal to noise ratio of the streak orientation", "units": "-"},
+}
+
+
+def lines_from_cross_section(x, y, n_lines=10, length=1.0):
+    """
+    Search lines of the given length [m] perpendicular to a cross-section (i.e. along the flow),
+    centred at n_lines equidistant positions on the cross-section. Returns a list of ((x0, y0), (x1, y1)).
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    s = np.r_[0, np.cumsum(np.hypot(np.diff(x), np.diff(y)))]
+    s_lines = np.linspace(0, s[-1], n_lines + 2)[1:-1]
+    xc, yc = np.interp(s_lines, s, x), np.interp(s_lines, s, y)
+    # perpendicular of the overall cross-section direction
+    dx, dy = x[-1] - x[0], y[-1] - y[0]
+    nx, ny = -dy / np.hypot(dx, dy), dx / np.hypot(dx, dy)
+    return [((xi - 0.5 * length * nx, yi - 0.5 * length * ny), (xi + 0.5 * length * nx, yi + 0.5 * length * ny))
+            for xi, yi in zip(xc, yc)]
+
+
+def line_positions(da, lines, n_samples=None):
+    """
+    Fractional (row, col) positions of samples along search lines, in the grid of projected frames da.
+
+    lines is a list of ((x0, y0), (x1, y1)) in the coordinate system of the camera configuration (as xs, ys).
+    All lines get the same number of samples, by default one per grid cell along the longest line.
+    Returns rows and cols of shape (lines, samples) and the sample spacing [m] per line.
+    """
+    transform = helpers.affine_from_grid(da["xs"].values, da["ys"].values)
+    lines = np.asarray(lines, dtype=float)
+    lengths = np.hypot(lines[:, 1, 0] - lines[:, 0, 0], lines[:, 1, 1] - lines[:, 0, 1])
+    if n_samples is None:
+        resolution = np.abs(transform.a) if transform.a != 0 else np.hypot(transform.a, transform.d)
+        n_samples = int(np.ceil(lengths.max() / resolution)) + 1
+    f = np.linspace(0, 1, n_samples)
+    xs = lines[:, 0, 0][:, None] + f * (lines[:, 1, 0] - lines[:, 0, 0])[:, None]
+    ys = lines[:, 0, 1][:, None] + f * (lines[:, 1, 1] - lines[:, 0, 1])[:, None]
+    # fractional rows and cols, as rasterio.transform.rowcol(..., op=float)
+    cols, rows = ~transform @ (xs, ys)
+    return rows, cols, lengths / (n_samples - 1)
+
+
+class SpaceTimeSampler:
+    """
+    Precomputed bilinear sampling of search lines in a frame grid.
+
+    The 4 neighbouring pixels (as flat indices) and their weights are computed once for all samples of all
+    lines, after which the space-time images of a batch of frames are extracted with a single gather.
+    Samples outside the grid are NaN.
+    """
+
+    def __init__(self, shape, rows, cols):
+        self.shape = tuple(shape)
+        self.n_lines, self.n_samples = rows.shape
+        ny, nx = self.shape
+        r, c = rows.ravel(), cols.ravel()
+        self.valid = (r >= 0) & (r <= ny - 1) & (c >= 0) & (c <= nx - 1)
+        r0 = np.clip(np.floor(r), 0, max(ny - 2, 0)).astype(np.int64)
+        c0 = np.clip(np.floor(c), 0, max(nx - 2, 0)).astype(np.int64)
+        fr, fc = np.clip(r - r0, 0, 1), np.clip(c - c0, 0, 1)
+        self.index = np.stack([r0 * nx + c0, r0 * nx + c0 + 1, (r0 + 1) * nx + c0, (r0 + 1) * nx + c0 + 1], axis=1)
+        self.weights = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc], axis=1)
+        self.index[~self.valid] = 0
+        self.weights = np.where(self.valid[:, None], self.weights, 0).astype(np.float32)
+
+    def sample(self, frames, out=None):
+        """
+        Space-time images (lines, time, samples) of frames (time, y, x), a numpy array or memmap.
+        """
+        frames = np.asarray(frames) if not isinstance(frames, np.memmap) else frames
+        n_t = frames.shape[0]
+        values = frames.reshape(n_t, -1)[:, self.index]
+        sti = np.einsum("tpk,pk->tp", values.astype(np.float32, copy=False), self.weights)
+        sti[:, ~self.valid] = np.nan
+        sti = sti.reshape(n_t, self.n_lines, self.n_samples).transpose(1, 0, 2)
+        if out is None:
+            return np.ascontiguousarray(sti)
+        out[...] = sti
+        return out
+
+    def sample_batches(self, frames, batch_size=64):
+        """
+        Space-time images of a whole frame stack, extracted batch by batch in a contiguous (lines, time, samples)
+        array. frames is an xarray.DataArray (computed per batch if dask backed), numpy array or memmap.
+        """
+        n_t = frames.shape[0]
+        out = np.empty((self.n_lines, n_t, self.n_samples), dtype=np.float32)
+        for start in range(0, n_t, batch_size):
+            stop = min(start + batch_size, n_t)
+            batch = frames[start:stop]
+            if isinstance(batch, xr.DataArray):
+                batch = batch.values
+            self.sample(batch, out=out[:, start:stop])
+        return out
+
+
+_SAMPLERS = OrderedDict()
+
+
+def get_sampler(da, lines, n_samples=None, max_cached=32):
+    """
+    SpaceTimeSampler and line geometry (rows, cols, spacing) for frames da and a set of lines.
+
+    Cached per grid (shape and georeference, i.e. the camera configuration) and line set, so repeated runs
+    on new videos of the same station skip the geometry.
+    """
+    transform = helpers.affine_from_grid(da["xs"].values, da["ys"].values)
+    key = (da.shape[-2:], tuple(transform), tuple(np.asarray(lines, dtype=float).ravel()), n_samples)
+    if key in _SAMPLERS:
+        _SAMPLERS.move_to_end(key)
+        return _SAMPLERS[key]
+    rows, cols, spacing = line_positions(da, lines, n_samples=n_samples)
+    item = SpaceTimeSampler(da.shape[-2:], rows, cols), rows, cols, spacing
+    _SAMPLERS[key] = item
+    if len(_SAMPLERS) > max_cached:
+        _SAMPLERS.popitem(last=False)
+    return item
+
+
+def frames_to_memmap(da, path, batch_size=64, dtype=np.float32):
+    """
+    Write a (lazy) frame stack (time, y, x) to a .npy file batch by batch and return it as read-only memmap.
+    Sampling many line sets from the memmap avoids recomputing the projection, with bounded memory.
+    """
+    mm = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=da.shape)
+    for start in range(0, da.shape[0], batch_size):
+        mm[start:start + batch_size] = da[start:start + batch_size].values
+    mm.flush()
+    del mm
+    return np.load(path, mmap_mode="r")
+
+
+def space_time_images(da, rows, cols, batch_size=64):
+    """
+    Bilinearly sampled space-time images of shape (lines, time, samples) from frames da (time, y, x).
+    """
+    return SpaceTimeSampler(da.shape[-2:], rows, cols).sample_batches(da, batch_size=batch_size)
+
+
+def _prepare(sti, sigma):
+    # remove the stationary background per sample, leaving the moving texture
+    with warnings.catch_warnings():
+        # samples outside the grid are NaN in all frames
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        sti = sti - np.nanmean(sti, axis=1, keepdims=True)
+    sti = np.nan_to_num(sti)
+    if sigma:
+        sti = gaussian_filter(sti, sigma=(0, sigma, sigma))
+    return sti
+
+
+def orientation_gst(sti, sigma=1.0):
+    """
+    Streak velocity [samples per frame] of space-time images (lines, time, samples) from the gradient
+    structure tensor, integrated over each whole image. Returns velocity, coherence (0-1) and a signal
+    to noise ratio (largest over smallest eigenvalue).
+    """
+    sti = _prepare(sti, sigma)
+    i_t, i_x = np.gradient(sti, axis=(1, 2))
+    j_xx = (i_x * i_x).sum(axis=(1, 2))
+    j_tt = (i_t * i_t).sum(axis=(1, 2))
+    j_xt = (i_x * i_t).sum(axis=(1, 2))
+    # dominant eigenvector is the gradient direction, streaks are perpendicular to it
+    theta = 0.5 * np.arctan2(2 * j_xt, j_xx - j_tt)
+    root = np.sqrt((j_xx - j_tt) ** 2 + 4 * j_xt ** 2)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        coherence = root / (j_xx + j_tt)
+        s2n = (j_xx + j_tt + root) / (j_xx + j_tt - root)
+    return -np.tan(theta), coherence, s2n
+
+
+def orientation_fft(sti, sigma=0.0, n_angles=720, k_min=0.02, k_max=0.4):
+    """
+    Streak velocity [samples per frame] of space-time images (lines, time, samples) from the 2D power
+    spectrum. Streaks map on a line through the origin of the spectrum, the angle with the highest power
+    (band-passed between k_min and k_max cycles per sample) is searched for all lines at once.
+    Returns velocity, coherence (1 - mean / peak power over the angles) and peak to mean ratio.
+    """
+    sti = _prepare(sti, sigma)
+    n_lines, n_t, n_s = sti.shape
+    window = np.hanning(n_t)[:, None] * np.hanning(n_s)[None, :]
+    power = np.abs(np.fft.fftshift(np.fft.fft2(sti * window), axes=(1, 2))) ** 2
+
+    # nearest-bin polar sampling of the spectrum, in normalized frequencies of both axes
+    angles = np.linspace(-0.5 * np.pi, 0.5 * np.pi, n_angles, endpoint=False)
+    radii = np.arange(k_min, k_max, 0.5 / max(n_t, n_s))
+    k_x = np.cos(angles)[:, None] * radii[None, :]
+    k_t = np.sin(angles)[:, None] * radii[None, :]
+    idx_x = np.clip(np.round(k_x * n_s).astype(int) + n_s // 2, 0, n_s - 1)
+    idx_t = np.clip(np.round(k_t * n_t).astype(int) + n_t // 2, 0, n_t - 1)
+    profile = power[:, idx_t, idx_x].sum(axis=2)
+
+    best = np.argmax(profile, axis=1)
+    # parabolic refinement of the peak angle
+    p0 = profile[np.arange(n_lines), (best - 1) % n_angles]
+    p1 = profile[np.arange(n_lines), best]
+    p2 = profile[np.arange(n_lines), (best + 1) % n_angles]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        shift = np.where(p0 - 2 * p1 + p2 != 0, 0.5 * (p0 - p2) / (p0 - 2 * p1 + p2), 0.0)
+        theta = angles[best] + shift * np.pi / n_angles
+        s2n = p1 / profile.mean(axis=1)
+        coherence = 1 - 1 / s2n
+    # energy of f(x - u t) lies on k_t = -u k_x
+    return -np.tan(theta), coherence, s2n
+
+
+ENGINES = {"gst": orientation_gst, "fft": orientation_fft}
+
+
+def get_stiv(da, lines, window=None, engine="gst", n_samples=None, frames=None, batch_size=64, **kwargs):
+    """
+    Surface velocities along search lines with space-time image velocimetry (STIV).
+
+    da are projected frames (time, y, x) as returned by frames.project(), lines a list of ((x0, y0), (x1, y1))
+    in the coordinate system of the camera configuration, e.g. from lines_from_cross_section. The frame stack
+    is cut in time windows of window frames (default: one window over all frames) and the streak orientation
+    in each space-time image is estimated with engine "gst" (gradient structure tensor) or "fft"
+    (2D power spectrum). kwargs are passed to the engine.
+
+    Frames are read in batches of batch_size. frames can be a memmap of the same stack (see frames_to_memmap)
+    to sample from instead of da, which then only provides the coordinates.
+
+    Returns a dataset with the variables of get_piv (v_x, v_y, corr, s2n) and dimensions (time, line).
+    Velocities are positive in the direction from the start to the end of a line.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'engine must be one of {list(ENGINES)}, not "{engine}"')
+    sampler, rows, cols, spacing = get_sampler(da, lines, n_samples=n_samples)
+    sti = sampler.sample_batches(da if frames is None else frames, batch_size=batch_size)
+    return stiv_from_images(da, sti, rows, cols, spacing, window=window, engine=engine, **kwargs)
+
+
+def stiv_from_images(da, sti, rows, cols, spacing, window=None, engine="gst", **kwargs):
+    """
+    Velocity dataset from precomputed space-time images (lines, time, samples), see get_stiv.
+    """
+    orientation = ENGINES[engine]
+    time = da["time"].values.astype(float)
+    dt = np.median(np.diff(time))
+    n_t = sti.shape[1]
+    window = n_t if window is None else int(window)
+    starts = np.arange(0, n_t - window + 1, window)
+    results = [orientation(sti[:, start:start + window], **kwargs) for start in starts]
+    u = np.stack([r[0] for r in results]) * spacing / dt
+    corr = np.stack([r[1] for r in results])
+    s2n = np.stack([r[2] for r in results])
+
+    # direction of each line in the local x (columns) and y (rows upward) axes of the projected grid
+    d_col, d_row = cols[:, -1] - cols[:, 0], rows[:, -1] - rows[:, 0]
+    norm = np.hypot(d_col, d_row)
+    row_c, col_c = rows.mean(axis=1), cols.mean(axis=1)
+    f_x = interp1d(np.arange(0, len(da["x"])), da["x"], fill_value="extrapolate")
+    f_y = interp1d(np.arange(0, len(da["y"])), da["y"], fill_value="extrapolate")
+    transform = helpers.affine_from_grid(da["xs"].values, da["ys"].values)
+    xs_c, ys_c = transform @ (col_c, row_c)
+
+    ds = xr.Dataset(
+        {
+            "v_x": (("time", "line"), u * (d_col / norm)),
+            "v_y": (("time", "line"), u * (-d_row / norm)),
+            "corr": (("time", "line"), corr),
+            "s2n": (("time", "line"), s2n),
+        },
+        coords={
+            "time": time[starts + window // 2],
+            "line": np.arange(sti.shape[0]),
+            "x": ("line", f_x(col_c)),
+            "y": ("line", f_y(row_c)),
+            "xs": ("line", np.asarray(xs_c)),
+            "ys": ("line", np.asarray(ys_c)),
+        },
+        attrs={k: v for k, v in da.attrs.items() if k in ("camera_shape", "camera_config", "h_a")},
+    )
+    for var, attrs in VELOCITY_ATTRS.items():
+        ds[var].attrs = attrs
+    ds.attrs["engine"] = f"stiv_{engine}"
+    ds.attrs["window"] = window
+    return ds
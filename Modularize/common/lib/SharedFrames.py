@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import xarray as xr
+
+
+_attach_lock = threading.Lock()
+
+
+def _attach(name):
+    # Attaching must not register the block with the resource tracker of this process: only the creating process
+    # unlinks it. A tracker of its own (a process that is not a child of the owner) would otherwise warn about a
+    # leak and unlink it a second time at exit. Unregistering after attaching is no option, a child shares the
+    # tracker of its parent and would drop the owner's registration.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedFrames:
+    """
+    A stack of frames (time, y, x[, band]) written once into shared memory, or into a memory-mapped file with
+    path, that any process reads by index without a copy.
+
+    Pickling a SharedFrames (as a process pool does with its arguments) only sends the name, shape and dtype of
+    the block, the receiving process attaches to the same memory. A 1080p uint8 frame is 2 MB that is otherwise
+    pickled, sent and unpickled for every frame pair a worker gets, 8 MB as float32.
+
+    The creating process owns the block: close() unmaps it, and for the owner also frees the shared memory or
+    removes the file. Use it as a context manager. Frames read from it are views, they are only valid while
+    it is open.
+    """
+
+    def __init__(self, shape, dtype, path=None, name=None, create=True):
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.owner = create
+        self._shm = None
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        if path is not None:
+            self.name = path
+            self._array = np.memmap(path, dtype=self.dtype, shape=self.shape, mode="w+" if create else "r+")
+        else:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes) if create else _attach(name)
+            self.name = self._shm.name
+            self._array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self._meta = None
+
+    @classmethod
+    def from_array(cls, frames, path=None, dtype=None):
+        """
+        Write frames into a new block: a numpy array, a list of equally shaped frames, or a pyorc frames
+        DataArray (e.g. the output of frames.project()). A lazy DataArray is computed one time chunk at a time,
+        so the frames are only held once, in the block. dtype converts on writing (e.g. np.int32 for OpenPIV).
+        """
+        if isinstance(frames, (list, tuple)):
+            shape = (len(frames),) + np.shape(frames[0])
+            src_dtype = np.asarray(frames[0]).dtype
+        else:
+            shape, src_dtype = frames.shape, frames.dtype
+        store = cls(shape, dtype or src_dtype, path=path)
+        if hasattr(frames, "dims"):
+            store._meta = (frames.dims, frames.coords, frames.attrs, frames.name)
+            step = frames.chunks[0][0] if frames.chunks is not None else len(frames)
+            for n in range(0, len(frames), step):
+                store._array[n:n + step] = frames.isel(time=slice(n, n + step)).values
+        else:
+            for n, frame in enumerate(frames):
+                store._array[n] = frame
+        if path is not None:
+            store._array.flush()
+        return store
+
+    @property
+    def array(self):
+        return self._array
+
+    @property
+    def nbytes(self):
+        return self._array.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return self._array[idx]
+
+    def __setitem__(self, idx, value):
+        self._array[idx] = value
+
+    def as_dataarray(self):
+        """
+        The frames as the DataArray they were written from, backed by the block (only in the creating process),
+        so that e.g. frames.get_piv() reads them in place.
+        """
+        if self._meta is None:
+            raise ValueError("SharedFrames was not written from a DataArray")
+        dims, coords, attrs, name = self._meta
+        return xr.DataArray(self._array, dims=dims, coords=coords, attrs=attrs, name=name)
+
+    def __getstate__(self):
+        return {"shape": self.shape, "dtype": self.dtype.str, "path": self.path, "name": self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["dtype"], path=state["path"], name=state["name"], create=False)
+
+    def close(self):
+        # views that are still referenced keep the mapping alive, the memory is freed once they are gone
+        self._array = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                pass
+            if self.owner:
+                self._shm.unlink()
+            self._shm = None
+        elif self.owner and self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __repr__(self):
+        kind = "memmap" if self.path is not None else "shared_memory"
+        return f"SharedFrames({kind}, name={self.name!r}, shape={self.shape}, dtype={self.dtype})"
+
+
+# frames and pair function of a map_pairs worker process, set once per worker
+_worker = {}
+# workers are not forked from the pipeline process: a fork copies the locks held by its decoder and dask threads,
+# which then never get released
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def _init_worker(frames, func, keys, kwargs):
+    _worker.update(frames=frames, func=func, keys=keys, kwargs=kwargs)
+
+
+def _run_pair(pair):
+    frames, i, j = _worker["frames"], pair[0], pair[1]
+    kwargs = dict(_worker["kwargs"], keys=(i, j)) if _worker["keys"] else _worker["kwargs"]
+    return _worker["func"](frames[i], frames[j], **kwargs)
+
+
+def map_pairs(func, frames, pairs=None, n_workers=None, chunksize=None, keys=False, **kwargs):
+    """
+    func(frame_a, frame_b, **kwargs) for frame pairs of a SharedFrames in n_workers processes, in order of the
+    pairs (consecutive frames by default).
+
+    func must be picklable, e.g. a MultiPassPIV or a functools.partial of openpiv's extended_search_area_piv. It
+    is sent once per worker together with the handle of the frames, the tasks only carry the frame indices.
+    Workers are started with START_METHOD, so func must be importable from a module.
+    Every worker gets runs of chunksize consecutive pairs; with keys=True func is also called with
+    keys=(i, j), so that MultiPassPIV reuses the spectra of the shared frame within a run.
+    """
+    if pairs is None:
+        pairs = [(n, n + 1) for n in range(len(frames) - 1)]
+    pairs = [(int(i), int(j)) for i, j in pairs]
+    n_workers = n_workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(pairs) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context(START_METHOD),
+                             initializer=_init_worker, initargs=(frames, func, keys, kwargs)) as executor:
+        return list(executor.map(_run_pair, pairs, chunksize=chunksize))
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pyorc
+
+HASH_BLOCK = 4 * 2**20
+SIDECAR_SUFFIX = ".stab.npz"
+
+# content hashes of videos already hashed in this process, by (path, size, modification time)
+_hashes = {}
+
+
+def video_hash(fn):
+    """
+    sha1 of the contents of a video file, so that a renamed or copied video reuses its transforms and a
+    re-encoded one does not.
+    """
+    stat = os.stat(fn)
+    key = (os.path.abspath(fn), stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        sha = hashlib.sha1()
+        with open(fn, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                sha.update(block)
+        _hashes[key] = sha.hexdigest()
+    return _hashes[key]
+
+
+def transform_key(polygon, start_frame, end_frame, split=2, rotation=None):
+    """
+    Key of a set of stabilization transforms within the sidecar of one video.
+    """
+    polygon = np.round(np.asarray(polygon, dtype=float), 3).tolist()
+    params = json.dumps([polygon, int(start_frame), int(end_frame), split, rotation])
+    return "ms_" + hashlib.sha1(params.encode()).hexdigest()[:16]
+
+
+class StabilizationCache:
+    """
+    Sidecar .npz file with the per-frame affine transforms (n_frames x 2 x 3) estimated for one video, one array
+    per stabilization polygon and frame range.
+
+    By default the sidecar sits next to the video (<video>.stab.npz). With cache_dir it is
+    <cache_dir>/<video hash>.stab.npz instead, for read-only video folders. Transforms stored for different
+    video contents are discarded.
+    """
+
+    def __init__(self, fn, cache_dir=None):
+        self.video_hash = video_hash(fn)
+        if cache_dir is None:
+            self.path = fn + SIDECAR_SUFFIX
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, self.video_hash + SIDECAR_SUFFIX)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                entries = {name: f[name] for name in f.files}
+        except (OSError, ValueError):
+            return {}
+        if str(entries.pop("video_hash", "")) != self.video_hash:
+            return {}
+        return entries
+
+    def get(self, key):
+        return self._load().get(key)
+
+    def put(self, key, ms):
+        entries = self._load()
+        entries[key] = np.asarray(ms, dtype=np.float64)
+        # write next to the sidecar and move in place, readers never see a partial file
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, video_hash=np.array(self.video_hash), **entries)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def __contains__(self, key):
+        return key in self._load()
+
+
+class CachedVideo(pyorc.Video):
+    """
+    pyorc.Video that estimates its stabilization transforms once per video and polygon.
+
+    The transforms of pyorc's feature tracking are stored in a StabilizationCache and reused by every later
+    CachedVideo on the same video contents, polygon and frame range, so reopening a video only costs the frame
+    index. pyorc applies them to the gray, RGB or HSV frames of every get_frames / get_frame call, chunk by chunk.
+    Without stabilize it is a plain pyorc.Video: the cache (and the hash of the video) is only set up when pyorc
+    asks for the transforms. cache=False turns the cache off, cache_dir moves the sidecar.
+    """
+
+    def __init__(self, fn, *args, cache=True, cache_dir=None, **kwargs):
+        # pyorc sets fn after estimating the transforms
+        self._video_fn = fn
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.stabilization_cached = False
+        super().__init__(fn, *args, **kwargs)
+
+    def get_ms(self, cap, split=2):
+        if not self.cache:
+            return super().get_ms(cap, split=split)
+        cache = StabilizationCache(self._video_fn, cache_dir=self.cache_dir)
+        key = transform_key(self.stabilize, self.start_frame, self.end_frame, split=split, rotation=self.rotation)
+        ms = cache.get(key)
+        if ms is not None and len(ms) == self.end_frame - self.start_frame + 1:
+            self.ms = list(ms)
+            self.stabilization_cached = True
+            return
+        super().get_ms(cap, split=split)
+        try:
+            cache.put(key, self.ms)
+        except OSError:
+            # an unwritable sidecar location only costs the reuse
+            pass
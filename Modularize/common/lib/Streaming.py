@@ -0,0 +1,179 @@
+import contextlib
+import time
+import warnings
+
+import xarray as xr
+
+from common.lib.Transects import concat_transects, sample_points, split_points, transect_points
+
+
+# same mask chain as Processing.mask, without the time-reducing window_mean (its angle mask is not applied in
+# place and has no effect there)
+DEFAULT_MASKS = [
+    ("corr", {}),
+    ("minmax", {}),
+    ("rolling", {}),
+    ("outliers", {}),
+    ("variance", {}),
+    ("count", {}),
+]
+
+
+def iter_piv_chunks(da_proj, chunk_size=25, engine="numba", compute=None, **piv_kwargs):
+    """
+    Compute PIV per time chunk of projected frames and yield each result as soon as it is ready.
+
+    Consecutive chunks share one frame so that no frame pair is skipped. compute, e.g.
+    ExecutionSettings.compute, returns the context that each chunk is computed in. It is left before the chunk
+    is yielded, so that its dask settings do not apply to the consumer's code between chunks.
+    """
+    n_frames = len(da_proj.time)
+    for start in range(0, n_frames - 1, chunk_size):
+        stop = min(start + chunk_size + 1, n_frames)
+        with (compute or contextlib.nullcontext)():
+            ds_chunk = da_proj.isel(time=slice(start, stop)).frames.get_piv(engine=engine, **piv_kwargs).load()
+        yield ds_chunk
+
+
+def apply_masks(ds, masks=DEFAULT_MASKS):
+    """
+    Apply a chain of velocimetry masks given as (name, kwargs) pairs, in place.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=UserWarning)
+        for name, kwargs in masks:
+            getattr(ds.velocimetry.mask, name)(inplace=True, **kwargs)
+    return ds
+
+
+class StreamingDischarge:
+    """
+    Provisional river flow that is updated per time chunk of PIV results.
+
+    Every chunk is masked with chunk-local statistics and sampled over all cross-sections at once. The sampled
+    point velocities go into per-point histograms (Output.SummaryAccumulator), so the quantiles over all time
+    steps seen so far, and the river flow of each quantile, follow the offline transect chain while an update
+    only costs its own chunk. Quantiles of v_x and v_y are within resolution / 2 [m s-1] of ``ds.quantile``.
+    """
+
+    def __init__(self, cross_sections, names=None, crs=None, wdw=1, tolerance=0.5, v_corr=0.9,
+                 fill_method="zeros", masks=DEFAULT_MASKS, quantiles=None, resolution=0.001):
+        # Output imports Execution, which imports this module
+        from common.lib.Output import SummaryAccumulator
+
+        self.cross_sections = cross_sections
+        self.names = names
+        self.crs = crs
+        self.wdw = wdw
+        self.tolerance = tolerance
+        self.v_corr = v_corr
+        self.fill_method = fill_method
+        self.masks = masks
+        self.quantiles = quantiles if quantiles is not None else [0.05, 0.25, 0.5, 0.75, 0.95]
+        self._points = None
+        self._accumulator = SummaryAccumulator(quantiles=self.quantiles, resolution=resolution)
+        self.samples = None
+        self._transects = None
+        self._v_sum = None
+        self._v_count = None
+        self.n_chunks = 0
+        self.n_time = 0
+        self.started = time.time()
+
+    def _get_transects(self):
+        points = self._points[0]
+        ds_all = self._accumulator.result()["quantile"]
+        transects = split_points(ds_all, points)
+        for ds_points in transects:
+            ds_points.transect.vector_to_scalar()
+            ds_points.transect.get_q(v_corr=self.v_corr, fill_method=self.fill_method)
+            ds_points.transect.get_river_flow()
+        return concat_transects(transects, self.names)
+
+    def update(self, ds_chunk):
+        """
+        Mask a new chunk of PIV results and update the running velocities and river flow.
+        Returns the provisional summary, see ``summary``.
+        """
+        ds_chunk = apply_masks(ds_chunk.copy(deep=True), self.masks)
+
+        v_x = ds_chunk["v_x"].fillna(0.0).sum(dim="time")
+        v_y = ds_chunk["v_y"].fillna(0.0).sum(dim="time")
+        count = ds_chunk["v_x"].count(dim="time")
+        if self._v_sum is None:
+            self._v_sum, self._v_count = [v_x, v_y], count
+        else:
+            self._v_sum = [self._v_sum[0] + v_x, self._v_sum[1] + v_y]
+            self._v_count = self._v_count + count
+
+        if self._points is None:
+            self._points = transect_points(ds_chunk, self.cross_sections, crs=self.crs)
+        _, _x, _y = self._points
+        # point velocities of this chunk, (time, points)
+        self.samples = sample_points(ds_chunk, _x, _y, wdw=self.wdw, tolerance=self.tolerance)
+        self._accumulator.update(self.samples)
+        self._transects = self._get_transects()
+        self.n_chunks += 1
+        self.n_time += len(ds_chunk.time)
+        return self.summary()
+
+    def transect_samples(self):
+        """
+        Point velocities of the last chunk, one dataset (time, points) per cross-section, in order of names.
+        """
+        transects = []
+        start = 0
+        for x, _, _, _ in self._points[0]:
+            transects.append(self.samples.isel(points=slice(start, start + len(x))))
+            start += len(x)
+        return transects
+
+    @property
+    def mean_velocity(self):
+        """
+        Masked time-mean v_x and v_y over all chunks so far.
+        """
+        count = self._v_count.where(self._v_count > 0)
+        return xr.Dataset({"v_x": self._v_sum[0] / count, "v_y": self._v_sum[1] / count, "valid_count": self._v_count})
+
+    @property
+    def transects(self):
+        """
+        Provisional transect dataset with a "transect" dimension, as returned by Transects.get_transects.
+        """
+        return self._transects
+
+    @property
+    def river_flow(self):
+        """
+        Running river flow quantiles [m3 s-1] per transect.
+        """
+        return self._transects["river_flow"]
+
+    def summary(self):
+        river_flow = self.river_flow
+        return {
+            "chunks": self.n_chunks,
+            "time_steps": self.n_time,
+            "elapsed": time.time() - self.started,
+            "quantiles": self.quantiles,
+            "river_flow": {str(name): river_flow.sel(transect=name).values.tolist()
+                           for name in river_flow["transect"].values},
+        }
+
+
+def stream_discharge(da_proj, cross_sections, chunk_size=25, piv_kwargs=None, callback=None, compute=None,
+                     **kwargs):
+    """
+    Run PIV chunk by chunk on projected frames and yield a provisional discharge summary after each chunk.
+
+    kwargs are passed to StreamingDischarge. callback, if given, is called with every summary. compute as for
+    iter_piv_chunks. Returns the StreamingDischarge with the final state when the generator is exhausted.
+    """
+    stream = StreamingDischarge(cross_sections, **kwargs)
+    for ds_chunk in iter_piv_chunks(da_proj, chunk_size=chunk_size, compute=compute, **(piv_kwargs or {})):
+        summary = stream.update(ds_chunk)
+        if callback is not None:
+            callback(summary)
+        yield summary
+    return stream
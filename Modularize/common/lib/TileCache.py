@@ -0,0 +1,174 @@
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from urllib.request import HTTPError, Request, URLError, urlopen
+
+import numpy as np
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import cartopy.io.img_tiles as cimgt
+from PIL import Image
+from pyproj import CRS, Transformer
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "stiv_tiles")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+BLANK_COLOR = (250, 250, 250)
+
+
+class CachedGoogleTiles(cimgt.GoogleTiles):
+    """
+    GoogleTiles that serve tiles from a local disk cache with an LRU size limit.
+
+    With offline=True (default) a tile missing from the cache is never fetched,
+    a blank tile is returned instead so that plots render in deterministic time.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, style="satellite", max_bytes=DEFAULT_MAX_BYTES,
+                 offline=True, timeout=10, **kwargs):
+        super().__init__(style=style, cache=False, **kwargs)
+        self.tile_dir = os.path.join(cache_dir, self.__class__.__name__, style)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.timeout = timeout
+        os.makedirs(self.tile_dir, exist_ok=True)
+        self._index = self._load_index()
+        # cartopy requests tiles from a thread pool
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        # least recently used first, based on the file modification times
+        entries = []
+        for name in os.listdir(self.tile_dir):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.tile_dir, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        entries.sort()
+        return OrderedDict((name, size) for _, name, size in entries)
+
+    def _tile_file(self, tile):
+        return "_".join([str(i) for i in tile]) + ".npy"
+
+    @property
+    def cache_size(self):
+        return sum(self._index.values())
+
+    def has_tile(self, tile):
+        return self._tile_file(tile) in self._index
+
+    def _touch(self, name):
+        self._index.move_to_end(name)
+        os.utime(os.path.join(self.tile_dir, name))
+
+    def _evict(self):
+        total = self.cache_size
+        while total > self.max_bytes and len(self._index) > 1:
+            name, size = self._index.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.tile_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _store(self, tile, img):
+        name = self._tile_file(tile)
+        path = os.path.join(self.tile_dir, name)
+        np.save(path, img, allow_pickle=False)
+        with self._lock:
+            self._index[name] = os.path.getsize(path)
+            self._index.move_to_end(name)
+            self._evict()
+
+    def fetch_tile(self, tile):
+        """
+        Download a single tile and store it in the cache. Returns False if the download failed.
+        """
+        request = Request(self._image_url(tile), headers={"User-Agent": self.user_agent})
+        try:
+            with urlopen(request, timeout=self.timeout) as fh:
+                img = Image.open(io.BytesIO(fh.read()))
+        except (HTTPError, URLError, OSError):
+            return False
+        img = np.asarray(img.convert(self.desired_tile_form or "RGB"))
+        self._store(tile, img)
+        return True
+
+    def get_image(self, tile):
+        name = self._tile_file(tile)
+        if name not in self._index and not self.offline:
+            self.fetch_tile(tile)
+        with self._lock:
+            img = None
+            if name in self._index:
+                img = np.load(os.path.join(self.tile_dir, name), allow_pickle=False)
+                self._touch(name)
+        if img is None:
+            img = np.full((256, 256, 3), BLANK_COLOR, dtype=np.uint8)
+        return img, self.tileextent(tile), "lower"
+
+
+def tile_index(lon, lat, zoom):
+    """
+    Google/OSM (x, y) tile index containing a lon-lat position at a zoom level.
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_extent(extent, zoom):
+    """
+    All tiles (x, y, z) covering extent [lon_min, lon_max, lat_min, lat_max] at a zoom level.
+    """
+    lon_min, lon_max, lat_min, lat_max = extent
+    x0, y0 = tile_index(lon_min, lat_max, zoom)
+    x1, y1 = tile_index(lon_max, lat_min, zoom)
+    return [(x, y, zoom) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def camera_config_extent(cam_config, buffer=0.0005):
+    """
+    Lon-lat extent [lon_min, lon_max, lat_min, lat_max] around the GCPs and the camera position of a camera
+    configuration.
+    """
+    dst = np.array(cam_config.gcps["dst"])[:, 0:2]
+    if getattr(cam_config, "lens_position", None) is not None:
+        dst = np.vstack([dst, np.array(cam_config.lens_position)[0:2]])
+    transformer = Transformer.from_crs(CRS.from_user_input(cam_config.crs), CRS.from_epsg(4326), always_xy=True)
+    lon, lat = transformer.transform(dst[:, 0], dst[:, 1])
+    return [min(lon) - buffer, max(lon) + buffer, min(lat) - buffer, max(lat) + buffer]
+
+
+def seed_tiles(extent, zoom_levels=(17, 18, 19), cache_dir=DEFAULT_CACHE_DIR, style="satellite",
+               max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Pre-seed the tile cache for a station bounding box. Run once on a machine with internet access.
+    Returns the number of tiles that were missing from the cache and could not be fetched.
+    """
+    tiler = CachedGoogleTiles(cache_dir=cache_dir, style=style, max_bytes=max_bytes, offline=False)
+    if isinstance(zoom_levels, int):
+        zoom_levels = [zoom_levels]
+    failed = 0
+    for zoom in zoom_levels:
+        for tile in tiles_in_extent(extent, zoom):
+            if not tiler.has_tile(tile) and not tiler.fetch_tile(tile):
+                failed += 1
+    return failed
+
+
+def get_geo_axes(extent, zoom_level=19, cache_dir=DEFAULT_CACHE_DIR, style="satellite", offline=True, ax=None,
+                 figsize=None):
+    """
+    Geographical axes with a satellite background served from the tile cache, on a new figure of figsize
+    unless ax is given. Drop-in for the tiles="GoogleTiles" option of pyorc plot functions.
+    """
+    tiler = CachedGoogleTiles(cache_dir=cache_dir, style=style, offline=offline)
+    if ax is None:
+        ax = plt.figure(figsize=figsize).add_subplot(projection=tiler.crs)
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+    ax.add_image(tiler, zoom_level, zorder=1)
+    return ax
@@ -0,0 +1,217 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+import rasterio
+from pyproj import CRS
+from scipy.interpolate import interp1d
+from pyorc import helpers
+
+from common.lib.Progress import report_stage
+
+
+def _transect_points(ds, x, y, z, crs, distance):
+    # same point sampling as pyorc's velocimetry.get_transect
+    if crs is not None:
+        x, y = zip(*helpers.xyz_transform(list(zip(*(x, y))), crs_from=crs,
+                                          crs_to=CRS.from_wkt(ds.velocimetry.camera_config.crs)))
+    if distance is None:
+        distance = np.abs(np.diff(ds.x)[0])
+    x, y, z, s = helpers.xy_equidistant(list(x), list(y), distance=distance, z=z)
+    return np.array(x), np.array(y), np.array(z), np.array(s)
+
+
+def _effective_field(ds, wdw, tolerance):
+    """
+    Window-median velocity field, computed once and shared by all transects.
+    """
+    if wdw == 0:
+        return ds
+    ds_wdw = helpers.stack_window(ds, wdw=wdw)
+    missing_tolerance = ds_wdw.mean(dim="time").count(dim="stride") > tolerance * len(ds_wdw.stride)
+    ds_effective = ds_wdw.median(dim="stride", keep_attrs=True).where(missing_tolerance)
+    # scipy does not tolerate np.float32, see pyorc get_transect
+    for var in ds_effective:
+        ds_effective[var] = ds_effective[var].astype(np.float64)
+    for coord in ds_effective.coords:
+        ds_effective[coord] = ds_effective[coord].astype(np.float64)
+    return ds_effective
+
+
+def crs_list(crs, n):
+    """
+    One crs per cross-section, crs is either a single crs for all n cross-sections or a list of them.
+    """
+    if isinstance(crs, (list, tuple)):
+        if len(crs) != n:
+            raise ValueError(f"Got {len(crs)} crs for {n} cross-sections")
+        return list(crs)
+    return [crs] * n
+
+
+def transect_points(ds, cross_sections, crs=None, distance=None):
+    """
+    Sampling points of all cross-sections and their positions in the local grid of ds.
+
+    crs is the crs of all cross-sections, or a list with one crs per cross-section (None for the crs of the
+    camera configuration).
+    Returns a list of (x, y, z, s) arrays per cross-section and the concatenated local x and y
+    positions of all points. Only depends on the grid, so can be reused for every time chunk.
+    """
+    transform = helpers.affine_from_grid(ds["xs"].values, ds["ys"].values)
+    f_x = interp1d(np.arange(0, len(ds["x"])), ds["x"], fill_value="extrapolate")
+    f_y = interp1d(np.arange(0, len(ds["y"])), ds["y"], fill_value="extrapolate")
+
+    points = [_transect_points(ds, x, y, z, crs_xs, distance)
+              for (x, y, z), crs_xs in zip(cross_sections, crs_list(crs, len(cross_sections)))]
+    x_all = np.concatenate([p[0] for p in points])
+    y_all = np.concatenate([p[1] for p in points])
+    rows, cols = rasterio.transform.rowcol(transform, list(x_all), list(y_all), op=float)
+    _x = xr.DataArray(f_x(np.array(cols)), dims="points")
+    _y = xr.DataArray(f_y(np.array(rows)), dims="points")
+    return points, _x, _y
+
+
+def sample_points(ds, _x, _y, wdw=1, tolerance=0.5):
+    """
+    Velocities of all transect points over time, in a single pass over the velocity cube.
+    """
+    ds_effective = _effective_field(ds, wdw, tolerance)
+    method = "nearest" if wdw == 0 else "linear"
+    return ds_effective.interp(x=_x, y=_y, method=method)
+
+
+def split_points(ds_all, points):
+    """
+    Split sampled points back into one dataset per cross-section, with transect coordinates and flow direction.
+    """
+    transects = []
+    start = 0
+    for x, y, z, s in points:
+        ds_points = ds_all.isel(points=slice(start, start + len(x)))
+        start += len(x)
+        ds_points = ds_points.assign_coords(xcoords=("points", x), ycoords=("points", y), scoords=("points", s))
+        if z is not None:
+            ds_points = ds_points.assign_coords(zcoords=("points", z))
+        alpha = helpers.xy_angle(ds_points["x"], ds_points["y"])
+        ds_points["v_dir"] = (("points"), alpha - 0.5 * np.pi)
+        ds_points["v_dir"].attrs = {
+            "standard_name": "river_flow_angle",
+            "long_name": "Angle of river flow in radians from North",
+            "units": "rad",
+        }
+        transects.append(ds_points)
+    return transects
+
+
+def sample_transects(ds, cross_sections, crs=None, wdw=1, tolerance=0.5, rolling=None, quantiles=None,
+                     distance=None, points=None):
+    """
+    Sample the velocity field for many cross-sections in one interpolation.
+
+    cross_sections is a list of (x, y, z) coordinate tuples. Returns a list of datasets with the same
+    layout as ds.velocimetry.get_transect, one per cross-section. points (the result of transect_points on the
+    same grid) skips deriving the sampling points again.
+    """
+    if quantiles is None:
+        quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+    if points is None:
+        points = transect_points(ds, cross_sections, crs=crs, distance=distance)
+    points, _x, _y = points
+    ds_all = sample_points(ds, _x, _y, wdw=wdw, tolerance=tolerance)
+    if rolling is not None:
+        ds_all = ds_all.rolling(time=rolling, min_periods=1).mean()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        ds_all = ds_all.quantile(quantiles, dim="time", keep_attrs=True)
+
+    transects = split_points(ds_all, points)
+    for ds_points in transects:
+        if np.isnan(ds_points["v_x"]).all():
+            warnings.warn("No valid velocimetry points found over bathymetry of a cross-section.", stacklevel=2)
+        ds_points.transect.vector_to_scalar()
+    return transects
+
+
+def get_transects(ds, cross_sections, names=None, crs=None, wdw=1, tolerance=0.5, rolling=None, quantiles=None,
+                  distance=None, v_corr=0.9, fill_method="zeros", progress=None, points=None):
+    """
+    Transect velocities, depth integrated flow and river flow for N cross-sections in one pass.
+
+    Replaces a get_transect -> get_q -> get_river_flow chain per cross-section. Returns a single
+    dataset with a "transect" dimension, points of shorter transects are padded with NaN.
+    Select with ds_q.sel(transect=...) or ds_q["transect"], ds_q.transect is pyorc's accessor.
+    progress (Progress.ProgressReporter) receives "transect" and "discharge" stage events. points as for
+    sample_transects.
+    """
+    with report_stage(progress, "transect", frames=len(ds.time)):
+        transects = sample_transects(ds, cross_sections, crs=crs, wdw=wdw, tolerance=tolerance, rolling=rolling,
+                                     quantiles=quantiles, distance=distance, points=points)
+    if isinstance(v_corr, (int, float)):
+        v_corr = [v_corr] * len(transects)
+    if isinstance(fill_method, str):
+        fill_method = [fill_method] * len(transects)
+    with report_stage(progress, "discharge"):
+        for n, (ds_points, corr, fill) in enumerate(zip(transects, v_corr, fill_method)):
+            ds_points.transect.get_q(v_corr=corr, fill_method=fill)
+            ds_points.transect.get_river_flow()
+            if progress is not None:
+                progress.update("discharge", transect=n, transects=n + 1, transects_total=len(transects),
+                                quantiles=ds_points["quantile"].values.tolist(),
+                                river_flow=ds_points["river_flow"].values.tolist())
+    return concat_transects(transects, names)
+
+
+def concat_transects(transects, names=None):
+    if names is None:
+        names = [f"transect_{n + 1}" for n in range(len(transects))]
+    n_points = max(len(ds_points.points) for ds_points in transects)
+    padded = [ds_points.pad(points=(0, n_points - len(ds_points.points))) for ds_points in transects]
+    return xr.concat(padded, dim=xr.DataArray(list(names), dims="transect", name="transect"),
+                     combine_attrs="override")
+
+
+def read_cross_section(fn):
+    """
+    Read x, y, z and crs of a cross-section from a geojson/shapefile of 3D points, or a csv with x, y, z columns.
+    """
+    if fn.endswith(".csv"):
+        df = pd.read_csv(fn)
+        return (df["x"].values, df["y"].values, df["z"].values), None
+    gdf = gpd.read_file(fn)
+    return (gdf.geometry.x.values, gdf.geometry.y.values, gdf.geometry.z.values), gdf.crs
+
+
+def get_transects_from_recipe(ds, recipe, base_dir="."):
+    """
+    Run the "transect" block of a recipe (e.g. ngwerere.yml) with a batched sampling pass.
+
+    Transects sharing the same get_transect settings are sampled together, each with the crs of its own file.
+    """
+    groups = {}
+    for name, cfg in recipe.items():
+        if not isinstance(cfg, dict) or "shapefile" not in cfg:
+            continue
+        key = tuple(sorted((cfg.get("get_transect") or {}).items()))
+        groups.setdefault(key, []).append(name)
+
+    results = []
+    for key, names in groups.items():
+        coords, crs, v_corr, fill_method = [], [], [], []
+        for name in names:
+            xyz, crs_xs = read_cross_section(os.path.join(base_dir, recipe[name]["shapefile"]))
+            coords.append(xyz)
+            crs.append(crs_xs)
+            get_q = recipe[name].get("get_q") or {}
+            v_corr.append(get_q.get("v_corr", 0.9))
+            fill_method.append(get_q.get("fill_method", "zeros"))
+        results.append(get_transects(ds, coords, names=names, crs=crs, v_corr=v_corr, fill_method=fill_method,
+                                     **dict(key)))
+    if len(results) == 1:
+        return results[0]
+    n_points = max(len(ds_q.points) for ds_q in results)
+    results = [ds_q.pad(points=(0, n_points - len(ds_q.points))) for ds_q in results]
+    return xr.concat(results, dim="transect", combine_attrs="override")
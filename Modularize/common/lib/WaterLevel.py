@@ -0,0 +1,309 @@
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import geopandas as gpd
+import pyorc
+
+from common.lib.Stabilization import CachedVideo
+
+
+def sample_frames(video_file, n_frames=5, start_frame=0, end_frame=None, stabilize=None, rotation=None):
+    """
+    Decode only n_frames evenly spaced grayscale frames of a video, by seeking instead of decoding the whole clip.
+    With stabilize or rotation the frames are read as Processing.process reads them, from a
+    Stabilization.CachedVideo with the same settings, so the transforms are estimated once for both.
+    Returns a (n_frames, height, width) uint8 array.
+    """
+    if stabilize is not None or rotation is not None:
+        video = CachedVideo(video_file, start_frame=start_frame, end_frame=end_frame, stabilize=stabilize,
+                            rotation=rotation)
+        idxs = np.unique(np.linspace(0, video.end_frame - video.start_frame, n_frames).astype(int))
+        return np.stack([video.get_frame(int(idx)) for idx in idxs])
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        raise IOError(f"Cannot open video: {video_file}")
+    if end_frame is None:
+        end_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) - 1
+    idxs = np.unique(np.linspace(start_frame, end_frame, n_frames).astype(int))
+    frames = []
+    for idx in idxs:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(idx))
+        ret, img = cap.read()
+        if ret:
+            frames.append(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+    cap.release()
+    if not frames:
+        raise IOError(f"No frames could be read from {video_file}")
+    return np.stack(frames)
+
+
+def _as_gray_stack(imgs):
+    imgs = np.asarray(imgs)
+    if imgs.ndim == 3 and imgs.shape[-1] in (3, 4):
+        # a single RGB(A) frame, not a stack of gray frames
+        imgs = imgs[None]
+    if imgs.ndim == 2:
+        imgs = imgs[None]
+    elif imgs.ndim == 4:
+        imgs = imgs[..., :3].mean(axis=-1)
+    return imgs.astype(np.uint8)
+
+
+def level_range(cross_section, min_h=None, max_h=None, min_z=None, max_z=None):
+    """
+    Bounds (min_z, max_z) of the water level as in pyorc's detect_water_level: z given directly, or from a water
+    level h, limited to the bed levels of the cross-section. Either may be None.
+    """
+    if min_z is None and min_h is not None:
+        min_z = np.maximum(cross_section.camera_config.h_to_z(min_h), cross_section.z.min())
+    if max_z is None and max_h is not None:
+        max_z = np.minimum(cross_section.camera_config.h_to_z(max_h), cross_section.z.max())
+    if min_z is not None and max_z is not None and min_z > max_z:
+        raise ValueError("Minimum water level is higher than maximum water level.")
+    return min_z, max_z
+
+
+def candidate_levels(cross_section, l_min, l_max, ds_max=0.5, dz_max=0.02):
+    """
+    Candidate l values (and their z) between l_min and l_max, the same as pyorc's detect_water_level_s2n
+    evaluates: the cross-section points, and points every 0.01 along l once z changed by dz_max or s by ds_max.
+    """
+    valid = (cross_section.l >= l_min) & (cross_section.l <= l_max)
+    ls, zs = list(cross_section.l[valid]), list(cross_section.z[valid])
+    current_l, last_z, last_s = l_min, None, None
+    while current_l <= l_max:
+        z = cross_section.interp_z(current_l)
+        s = cross_section.interp_s_from_l(current_l)
+        if last_z is None or abs(z - last_z) >= dz_max or abs(s - last_s) >= ds_max:
+            ls.append(current_l)
+            zs.append(z)
+            last_z, last_s = z, s
+        current_l += 0.01
+    ls.append(l_max)
+    zs.append(cross_section.interp_z(l_max))
+    order = np.argsort(ls)
+    return np.array(ls)[order], np.array(zs)[order]
+
+
+class LevelScorer:
+    """
+    Histogram scores of candidate water lines on a cross-section, for many frames at once.
+
+    The projected polygons left and right of each candidate water line, and the pixels they cover, only depend
+    on the geometry. They are computed once per candidate and reused for every frame. Scores follow
+    pyorc.CrossSection.get_histogram_score: 0 is most distinct, 2 is no difference or too few samples.
+    """
+
+    def __init__(self, cross_section, bank="far", bin_size=5, length=2.0, padding=0.5, offset=0.0, min_h=None,
+                 max_h=None, min_z=None, max_z=None, min_samples=50):
+        if not 5 <= int(bin_size) <= 20:
+            raise ValueError("Bin size must be between 5 and 20")
+        self.cross_section = cross_section
+        self.camera_config = cross_section.camera_config
+        self.bank = bank
+        self.bin_size = int(bin_size)
+        self.length = length
+        self.padding = padding
+        self.offset = offset
+        self.min_samples = min_samples
+        self.l_min, self.l_max = cross_section.get_line_of_interest(bank=bank)
+        self.min_z, self.max_z = level_range(cross_section, min_h=min_h, max_h=max_h, min_z=min_z, max_z=max_z)
+        self.n_bins = len(np.arange(0, 256, self.bin_size)) - 1
+        self._pixels = {}
+
+    def _polygon_pixels(self, pol):
+        # same pixel selection as pyorc.cv.get_polygon_pixels, as flat indices into the full frame
+        if pol.is_empty:
+            return None
+        height, width = self.camera_config.height, self.camera_config.width
+        min_x, min_y, max_x, max_y = map(int, pol.bounds)
+        min_x, min_y = max(min_x, 0), max(min_y, 0)
+        max_x, max_y = min(max_x, width), min(max_y, height)
+        if max_x <= min_x or max_y <= min_y:
+            return np.array([], dtype=np.int64)
+        mask = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8)
+        coords = [(x - min_x, y - min_y) for x, y in pol.exterior.coords]
+        cv2.fillPoly(mask, [np.array(coords, dtype=np.int32)], color=255)
+        rows, cols = np.nonzero(mask == 255)
+        return (rows + min_y) * width + (cols + min_x)
+
+    def pixels(self, l):
+        """
+        Cached flat pixel indices (dry side, wet side) of the polygons around candidate water line l.
+        """
+        key = round(float(l), 4)
+        if key not in self._pixels:
+            cs = self.cross_section
+            pol1 = cs.get_csl_pol(l=l, offset=self.offset, padding=(0, self.padding), length=self.length,
+                                  camera=True)[0]
+            pol2 = cs.get_csl_pol(l=l, offset=self.offset, padding=(-self.padding, 0), length=self.length,
+                                  camera=True)[0]
+            self._pixels[key] = (self._polygon_pixels(pol1), self._polygon_pixels(pol2))
+        return self._pixels[key]
+
+    def _penalty(self, l):
+        z = self.cross_section.interp_z(l)
+        # pyorc only checks max_z without a min_z, here both bounds hold
+        if self.min_z is not None and z < self.min_z:
+            return 2.0 + np.abs(z - self.min_z)
+        if self.max_z is not None and z > self.max_z:
+            return 2.0 + np.abs(z - self.max_z)
+        return None
+
+    def _histograms(self, imgs_flat, idx):
+        # normalized histograms of all frames in one bincount, same bins as pyorc's _histogram
+        n_frames = imgs_flat.shape[0]
+        vals = imgs_flat[:, idx].astype(np.int64)
+        last_edge = self.n_bins * self.bin_size
+        bins = np.minimum(vals // self.bin_size, self.n_bins - 1)
+        valid = vals <= last_edge
+        keys = (np.arange(n_frames)[:, None] * self.n_bins + bins)[valid]
+        counts = np.bincount(keys, minlength=n_frames * self.n_bins).reshape(n_frames, self.n_bins)
+        total = counts.sum(axis=1, keepdims=True)
+        return np.where(total > 0, counts / np.maximum(total, 1), counts)
+
+    def score(self, imgs, l_values):
+        """
+        Scores of shape (frames, candidates) for grayscale frames (frames, height, width) and candidate l values.
+        """
+        imgs = _as_gray_stack(imgs)
+        imgs_flat = imgs.reshape(len(imgs), -1)
+        scores = np.full((len(imgs_flat), len(l_values)), 2.0)
+        for n, l in enumerate(l_values):
+            penalty = self._penalty(l)
+            if penalty is not None:
+                scores[:, n] = penalty
+                continue
+            idx1, idx2 = self.pixels(l)
+            if idx1 is None or idx2 is None or idx1.size < self.min_samples or idx2.size < self.min_samples:
+                continue
+            hist1 = self._histograms(imgs_flat, idx1)
+            hist2 = self._histograms(imgs_flat, idx2)
+            scores[:, n] = 2 - np.maximum(hist1, hist2).sum(axis=1)
+        return scores
+
+    def candidates(self, ds_max=0.5, dz_max=0.02):
+        """
+        Candidate l values and their z over the line of interest, as in pyorc's detect_water_level_s2n.
+        """
+        return candidate_levels(self.cross_section, self.l_min, self.l_max, ds_max=ds_max, dz_max=dz_max)
+
+
+def detect_water_levels(cross_section, imgs, ds_max=0.5, dz_max=0.02, scorer=None, **kwargs):
+    """
+    Detect the water level on a batch of frames, all candidate levels evaluated for all frames at once.
+
+    Returns a dict with the median water level "h", its spread (half the interquartile range) "h_spread",
+    the level per frame "h_frames" and a signal to noise ratio per frame "s2n".
+    """
+    if scorer is None:
+        scorer = LevelScorer(cross_section, **kwargs)
+    imgs = _as_gray_stack(imgs)
+    l_range, z_range = scorer.candidates(ds_max=ds_max, dz_max=dz_max)
+    scores = scorer.score(imgs, l_range)
+    idx = np.argmin(scores, axis=1)
+    best = scores[np.arange(len(imgs)), idx]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        s2n = scores.mean(axis=1) / best
+    h_frames = np.array([scorer.camera_config.z_to_h(z) for z in z_range[idx]])
+    q25, h, q75 = np.quantile(h_frames, [0.25, 0.5, 0.75])
+    return {
+        "h": float(h),
+        "h_spread": float((q75 - q25) / 2),
+        "h_frames": h_frames.tolist(),
+        "s2n": s2n.tolist(),
+    }
+
+
+def _level_grid(l_min, l_max, step):
+    # candidates on multiples of step, so that cached polygons are hit again by later searches
+    l_values = np.arange(np.ceil(l_min / step), np.floor(l_max / step) + 1) * step
+    return np.unique(np.r_[l_min, l_values, l_max].round(6))
+
+
+def _l_from_h(scorer, h):
+    # candidate l on the line of interest whose bed level is closest to water level h
+    l_values = np.linspace(scorer.l_min, scorer.l_max, 500)
+    z = scorer.cross_section.interp_z(l_values)
+    return l_values[np.argmin(np.abs(z - scorer.camera_config.h_to_z(h)))]
+
+
+def _search(scorer, imgs, l_min, l_max, coarse_step, tolerance):
+    # finer grids stay within [l_min, l_max], so an optimum on its edge tells that the window missed it
+    step = coarse_step
+    l_values = _level_grid(l_min, l_max, step)
+    while True:
+        # frames are scored jointly, so a batch of frames gives one robust optimum
+        scores = scorer.score(imgs, l_values).mean(axis=0)
+        l_best = l_values[np.argmin(scores)]
+        if step <= tolerance:
+            return l_best, scores.min()
+        lo, hi = max(l_best - step, l_min), min(l_best + step, l_max)
+        step = max(step / 4, tolerance)
+        l_values = _level_grid(lo, hi, step)
+
+
+def detect_water_level(cross_section, imgs, coarse_step=0.2, tolerance=0.005, h_prev=None, search_radius=0.3,
+                       scorer=None, **kwargs):
+    """
+    Coarse-to-fine replacement of pyorc.CrossSection.detect_water_level.
+
+    Candidate water lines are scored on a coarse grid over the line of interest, then on finer grids around
+    the best candidate until the step is below tolerance [m along the cross-section]. With h_prev (e.g. the
+    level of the previous clip) only a window of search_radius around it is searched, falling back to the
+    full range if the optimum ends up on the edge of that window. Reuse one LevelScorer per station
+    (scorer=...) to keep the projected polygons cached between clips. kwargs are passed to LevelScorer.
+    """
+    if scorer is None:
+        scorer = LevelScorer(cross_section, **kwargs)
+    imgs = _as_gray_stack(imgs)
+    l_opt = None
+    if h_prev is not None:
+        l_prev = _l_from_h(scorer, h_prev)
+        lo, hi = max(l_prev - search_radius, scorer.l_min), min(l_prev + search_radius, scorer.l_max)
+        l_opt, _ = _search(scorer, imgs, lo, hi, coarse_step, tolerance)
+        if (np.isclose(l_opt, lo) and lo > scorer.l_min) or (np.isclose(l_opt, hi) and hi < scorer.l_max):
+            l_opt = None
+    if l_opt is None:
+        l_opt, _ = _search(scorer, imgs, scorer.l_min, scorer.l_max, coarse_step, tolerance)
+    h = scorer.camera_config.z_to_h(cross_section.interp_z(l_opt))
+    if np.isclose(l_opt, scorer.l_min) or np.isclose(l_opt, scorer.l_max):
+        warnings.warn(
+            f"The detected water level is on the edge of the search space and may be wrong. "
+            f"Water level is {h} m. at cross-section length {l_opt}.",
+            UserWarning,
+            stacklevel=2,
+        )
+    return float(h)
+
+
+def detect_water_level_video(video_file, cam_config_file, cross_section_file, n_frames=5, start_frame=0,
+                             end_frame=None, stabilize=None, rotation=None, **kwargs):
+    """
+    Water level of one video from n_frames lazily sampled frames. The "h" of the result can be passed
+    as h_a to Processing.process, with the same stabilize (and frame range) as given there.
+    """
+    cam_config = pyorc.load_camera_config(cam_config_file)
+    cross_section = pyorc.CrossSection(camera_config=cam_config, cross_section=gpd.read_file(cross_section_file))
+    imgs = sample_frames(video_file, n_frames=n_frames, start_frame=start_frame, end_frame=end_frame,
+                         stabilize=stabilize, rotation=rotation)
+    result = detect_water_levels(cross_section, imgs, **kwargs)
+    result["video_file"] = video_file
+    return result
+
+
+def _detect_water_level_video(args):
+    video_file, cam_config_file, cross_section_file, kwargs = args
+    return detect_water_level_video(video_file, cam_config_file, cross_section_file, **kwargs)
+
+
+def detect_water_level_videos(video_files, cam_config_file, cross_section_file, max_workers=None, **kwargs):
+    """
+    Water levels of many videos of the same station, one process per video.
+    """
+    jobs = [(video_file, cam_config_file, cross_section_file, kwargs) for video_file in video_files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_detect_water_level_video, jobs))
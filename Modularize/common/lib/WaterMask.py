@@ -0,0 +1,191 @@
+import json
+
+import cv2
+import numpy as np
+import rasterio
+import xarray as xr
+from ffpiv import window
+from pyorc import helpers
+from pyproj import CRS
+
+from common.lib.MultiPassPIV import window_fraction
+from common.lib.Transects import crs_list
+
+
+def _h_a(frames, h_a):
+    if h_a is not None:
+        return h_a
+    h_a = frames.attrs.get("h_a")
+    return json.loads(h_a) if isinstance(h_a, str) else h_a
+
+
+def _to_grid(frames, x, y):
+    # real world x, y to fractional column and row of the projected grid, as Transects.transect_points
+    transform = helpers.affine_from_grid(frames["xs"].values, frames["ys"].values)
+    rows, cols = rasterio.transform.rowcol(transform, list(x), list(y), op=float)
+    return np.array(cols), np.array(rows)
+
+
+def _fill(shape, cols, rows, convex=False):
+    mask = np.zeros(shape, dtype=np.uint8)
+    pts = np.round(np.column_stack([cols, rows])).astype(np.int32)
+    if convex:
+        cv2.fillConvexPoly(mask, cv2.convexHull(pts), 1)
+    else:
+        cv2.fillPoly(mask, [pts], 1)
+    return mask.astype(bool)
+
+
+def _dilate(mask, radius):
+    radius = int(np.ceil(radius))
+    if radius <= 0:
+        return mask
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    return cv2.dilate(mask.astype(np.uint8), kernel).astype(bool)
+
+
+def polygon_mask(frames, polygon, h_a=None, densify=10):
+    """
+    Water region of a polygon in camera pixels (the stabilize polygon, which encloses the water) on the grid of
+    projected frames. The edges are densified so that lens distortion bends them as in the projection.
+    """
+    cc = frames.frames.camera_config
+    polygon = np.asarray(polygon, dtype=float)
+    ends = np.roll(polygon, -1, axis=0)
+    f = np.linspace(0, 1, densify, endpoint=False)[None, :, None]
+    points = (polygon[:, None] + f * (ends - polygon)[:, None]).reshape(-1, 2)
+    xyz = cc.unproject_points(points, cc.get_z_a(_h_a(frames, h_a)))
+    cols, rows = _to_grid(frames, xyz[:, 0], xyz[:, 1])
+    return _fill(frames.shape[-2:], cols, rows)
+
+
+def cross_section_mask(frames, cross_sections, crs=None, h_a=None, buffer=1.0):
+    """
+    Water region spanned by cross-sections ((x, y, z) per cross-section, as read_cross_section) on the grid of
+    projected frames: the hull of their points below the water level, widened by buffer [m]. With one
+    cross-section this is a band of 2 * buffer along its wetted part. crs is one crs or one per cross-section.
+    """
+    cc = frames.frames.camera_config
+    z_a = cc.get_z_a(_h_a(frames, h_a))
+    xs, ys = [], []
+    for (x, y, z), crs_xs in zip(cross_sections, crs_list(crs, len(cross_sections))):
+        x, y, z = (np.asarray(c, dtype=float) for c in (x, y, z))
+        if crs_xs is not None:
+            x, y = (np.array(c) for c in zip(*helpers.xyz_transform(list(zip(x, y)), crs_from=crs_xs,
+                                                                     crs_to=CRS.from_wkt(cc.crs))))
+        wet = z < z_a
+        if not wet.any():
+            # a water level below the whole profile (or another datum), take the whole cross-section
+            wet = np.ones_like(wet)
+        xs.append(x[wet])
+        ys.append(y[wet])
+    cols, rows = _to_grid(frames, np.concatenate(xs), np.concatenate(ys))
+    return _dilate(_fill(frames.shape[-2:], cols, rows, convex=True), buffer / cc.resolution)
+
+
+def variance_mask(frames, n_frames=20, smooth=3, min_area=0.05):
+    """
+    Water region from a temporal variance map: the standard deviation over n_frames frames spread over the
+    clip, smoothed over smooth pixels and split with Otsu's threshold into moving (water) and still (banks,
+    structures) pixels. Pixels without data (zero in all frames, outside the camera view) are never water.
+    Small specks are removed and connected regions below min_area of the largest one are dropped.
+
+    frames : numpy (time, y, x) frames or pyorc frames, of which only the sampled ones are computed
+    """
+    n = len(frames)
+    idx = np.unique(np.linspace(0, n - 1, min(n_frames, n)).round().astype(int))
+    if hasattr(frames, "isel"):
+        imgs = frames.isel(time=list(idx)).values
+    else:
+        imgs = np.asarray(frames)[idx]
+    imgs = imgs.astype(np.float32)
+    std = cv2.GaussianBlur(imgs.std(axis=0), (0, 0), smooth)
+    valid = (imgs != 0).any(axis=0)
+    scaled = np.zeros(std.shape, dtype=np.uint8)
+    if valid.any() and std[valid].max() > 0:
+        scaled[valid] = np.clip(std[valid] / std[valid].max() * 255, 0, 255).astype(np.uint8)
+    threshold, _ = cv2.threshold(scaled[valid].reshape(1, -1), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = ((scaled > threshold) & valid).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * smooth + 1, 2 * smooth + 1))
+    mask = cv2.morphologyEx(cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel), cv2.MORPH_CLOSE, kernel)
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+    if n_labels <= 1:
+        return mask.astype(bool)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    return np.isin(labels, 1 + np.flatnonzero(areas >= min_area * areas.max()))
+
+
+def water_roi(frames, polygon=None, cross_sections=None, crs=None, variance=False, h_a=None, margin=0.,
+              buffer=1.0, n_frames=20):
+    """
+    Water region of interest on the grid of projected pyorc frames, the union of the regions of the given
+    sources: a polygon in camera pixels (the stabilize polygon), the hull of the wetted cross-sections and/or the
+    temporal variance map of the frames. margin [m] widens the region, so that windows on the water line are
+    kept. The projected grid itself already is the bounding box of the AOI corners.
+
+    Returns a bool DataArray on the y, x coordinates of the frames.
+    """
+    masks = []
+    if polygon is not None:
+        masks.append(polygon_mask(frames, polygon, h_a=h_a))
+    if cross_sections:
+        masks.append(cross_section_mask(frames, cross_sections, crs=crs, h_a=h_a, buffer=buffer))
+    if variance:
+        masks.append(variance_mask(frames, n_frames=n_frames))
+    if not masks:
+        raise ValueError("water_roi needs a polygon, cross-sections or variance=True")
+    roi = _dilate(np.logical_or.reduce(masks), margin / frames.frames.camera_config.resolution)
+    return xr.DataArray(roi, dims=("y", "x"), coords={"y": frames["y"], "x": frames["x"]}, name="water_roi")
+
+
+def _piv_windows(frames, window_size=None, overlap=None):
+    # interrogation windows as get_piv derives them from the camera config
+    if window_size is None:
+        window_size = frames.frames.camera_config.window_size
+    if overlap is None:
+        overlap = 2 * (int(round(window_size if np.isscalar(window_size) else window_size[0]) / 2),)
+    window_size = window.round_to_even(2 * (window_size,) if np.isscalar(window_size) else window_size)
+    return window_size, overlap
+
+
+def window_mask(roi, window_size, overlap):
+    """
+    Interrogation windows of FF-PIV (get_piv) on a frame of roi's shape that contain water, (rows, cols) bool.
+    """
+    cols, rows = window.get_rect_coordinates(np.shape(roi), window_size, overlap, search_area_size=window_size)
+    top = rows - window_size[0] // 2
+    left = cols - window_size[1] // 2
+    tt, ll = np.meshgrid(top, left, indexing="ij")
+    return window_fraction(np.asarray(roi), tt, ll, window_size) > 0
+
+
+def mask_frames(frames, roi, window_size=None, overlap=None):
+    """
+    Projected frames of which get_piv only correlates the interrogation windows that contain water.
+
+    FF-PIV skips windows that are blank in the first frame (as it does outside the camera view), so the pixels
+    outside every water window are set to zero. Windows that touch the water keep all their pixels, their
+    vectors are the same as without the mask. window_size and overlap default to those of get_piv.
+
+    Returns the frames and the water windows on the PIV grid, for mask_velocimetry.
+    """
+    window_size, overlap = _piv_windows(frames, window_size, overlap)
+    windows = window_mask(roi, window_size, overlap)
+    cols, rows = window.get_rect_coordinates(frames.shape[-2:], window_size, overlap, search_area_size=window_size)
+    keep = np.zeros(frames.shape[-2:], dtype=bool)
+    for r, c in zip(*np.nonzero(windows)):
+        top, left = rows[r] - window_size[0] // 2, cols[c] - window_size[1] // 2
+        keep[top:top + window_size[0], left:left + window_size[1]] = True
+    keep = xr.DataArray(keep, dims=("y", "x"), coords={"y": frames["y"], "x": frames["x"]})
+    masked = frames.where(keep, 0).astype(frames.dtype)
+    masked.attrs = frames.attrs
+    masked.name = frames.name
+    return masked, windows
+
+
+def mask_velocimetry(ds, windows):
+    """
+    Velocimetry of masked frames with NaN outside the water windows. Overlapping windows next to the water
+    still see part of its pixels and are correlated by FF-PIV, their vectors are dropped here.
+    """
+    return ds.where(xr.DataArray(windows, dims=("y", "x")))
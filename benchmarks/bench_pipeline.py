@@ -0,0 +1,481 @@
+"""
+Offline benchmarks of the velocimetry pipeline stages.
+
+Times and measures memory of:
+  * the stages of Processing.process (stabilize, decode, project, piv) on a synthetic particle-image video,
+    for a number of frame counts, projection methods and PIV engines
+  * Processing.mask, and Transects.get_transects, on the bundled ngwerere velocimetry results
+  * the OpenPIV frame-pair loop of PIV_approach/main.ipynb on synthetic particle images
+  * DISTO_values/app_calibration.apply_transformations on the bundled field data
+  * sending 1080p frame pairs to PIV worker processes, pickled against SharedFrames
+
+Results are written as json, with the git commit and library versions. Compare with an earlier run to
+catch regressions:
+
+    python benchmarks/bench_pipeline.py --quick --output before.json
+    python benchmarks/bench_pipeline.py --quick --compare before.json
+
+Every lazy (dask) stage is computed before its timer stops, so that time is attributed to the stage that
+causes it. Wall time is the best of --repeat runs, memory is the tracemalloc peak of the first run. Cases
+whose optional dependencies are missing are recorded as "skipped".
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import matplotlib
+matplotlib.use("Agg")
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(ROOT, "Modularize"))
+sys.path.append(os.path.join(ROOT, "DISTO_values"))
+
+NGWERERE = os.path.join(ROOT, "computation", "examples", "ngwerere")
+DISTO = os.path.join(ROOT, "DISTO_values")
+
+# area for stabilization of the ngwerere camera, as in computation/processing.py
+STABILIZE = [[150, 0], [500, 1079], [1750, 1079], [900, 0]]
+
+
+class Measurement:
+    """
+    Wall time [s], CPU time [s] and peak traced memory [MB] of one block.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.wall = None
+        self.cpu = None
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        if self.trace_memory:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        return False
+
+
+class Benchmark:
+    """
+    Collects one record per (case, stage, params), over repeated runs.
+    """
+
+    def __init__(self, repeat=3, trace_memory=True):
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.records = {}
+
+    @contextlib.contextmanager
+    def measure(self, case, stage, params, n_run, frames=None):
+        m = Measurement(trace_memory=self.trace_memory and n_run == 0)
+        with m:
+            yield m
+        key = (case, stage, json.dumps(params, sort_keys=True))
+        record = self.records.setdefault(key, {
+            "case": case,
+            "stage": stage,
+            "params": params,
+            "status": "ok",
+            "frames": frames,
+            "walls": [],
+            "cpus": [],
+            "peak_mb": None,
+        })
+        record["walls"].append(m.wall)
+        record["cpus"].append(m.cpu)
+        if m.peak_mb is not None:
+            record["peak_mb"] = m.peak_mb
+
+    def skip(self, case, params, reason):
+        key = (case, None, json.dumps(params, sort_keys=True))
+        self.records[key] = {"case": case, "stage": None, "params": params, "status": "skipped",
+                             "reason": reason}
+
+    def results(self):
+        results = []
+        for record in self.records.values():
+            record = dict(record)
+            if record["status"] == "ok":
+                walls = record.pop("walls")
+                cpus = record.pop("cpus")
+                record["wall"] = float(np.min(walls))
+                record["wall_median"] = float(np.median(walls))
+                record["cpu"] = float(np.min(cpus)) if cpus else None
+                record["repeat"] = len(walls)
+                record["fps"] = record["frames"] / record["wall"] if record["frames"] and record["wall"] else None
+            results.append(record)
+        return results
+
+
+def particle_frames(n_frames, height, width, displacement=(0.0, 3.0), density=0.02, diameter=3.0, seed=0):
+    """
+    Synthetic particle images (n_frames, height, width) uint8 with all particles moving
+    displacement (rows, cols) [pix] per frame.
+    """
+    rng = np.random.default_rng(seed)
+    dy, dx = displacement
+    # particles on a domain large enough to keep the view filled over all frames
+    pad_y, pad_x = int(abs(dy) * n_frames) + 10, int(abs(dx) * n_frames) + 10
+    n_particles = int(density * (height + 2 * pad_y) * (width + 2 * pad_x))
+    y0 = rng.uniform(-pad_y, height + pad_y, n_particles)
+    x0 = rng.uniform(-pad_x, width + pad_x, n_particles)
+    intensity = rng.uniform(0.5, 1.0, n_particles)
+    frames = np.empty((n_frames, height, width), dtype=np.uint8)
+    for n in range(n_frames):
+        # bilinear splat of sub-pixel particle positions, blurred to gaussian particles
+        y, x = y0 + n * dy, x0 + n * dx
+        inside = (y >= 0) & (y < height - 1) & (x >= 0) & (x < width - 1)
+        yi, xi = np.floor(y[inside]).astype(int), np.floor(x[inside]).astype(int)
+        fy, fx = y[inside] - yi, x[inside] - xi
+        img = np.zeros((height, width), dtype=np.float32)
+        for oy, ox, w in [(0, 0, (1 - fy) * (1 - fx)), (0, 1, (1 - fy) * fx), (1, 0, fy * (1 - fx)), (1, 1, fy * fx)]:
+            np.add.at(img, (yi + oy, xi + ox), intensity[inside] * w)
+        sigma = diameter / 4
+        img = cv2.GaussianBlur(img, (0, 0), sigma) * (2 * np.pi * sigma ** 2)
+        frames[n] = np.clip(30 + 200 * img, 0, 255).astype(np.uint8)
+    return frames
+
+
+def write_video(fn, frames, fps=25):
+    """
+    Write grayscale frames to an mp4 (mp4v) video file.
+    """
+    height, width = frames.shape[1:]
+    writer = cv2.VideoWriter(fn, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise IOError(f"Cannot write video: {fn}")
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+    return fn
+
+
+def bench_process(bench, video_file, n_frames_list, methods, engines):
+    """
+    Stages of Processing.process, each computed before the next one starts.
+    """
+    import pyorc
+
+    cam_config = pyorc.load_camera_config(os.path.join(NGWERERE, "ngwerere.json"))
+    for n_frames in n_frames_list:
+        for method in methods:
+            for engine in engines:
+                params = {"frames": n_frames, "project": method, "engine": engine}
+                for n_run in range(bench.repeat):
+                    with bench.measure("process", "stabilize", params, n_run, frames=n_frames):
+                        video = pyorc.Video(video_file, camera_config=copy.deepcopy(cam_config), start_frame=0,
+                                            end_frame=n_frames - 1, stabilize=STABILIZE, h_a=0.)
+                    with bench.measure("process", "decode", params, n_run, frames=n_frames):
+                        da_norm = video.get_frames().frames.normalize().load()
+                    with bench.measure("process", "project", params, n_run, frames=n_frames):
+                        da_proj = da_norm.frames.project(method=method).load()
+                    with bench.measure("process", "piv", params, n_run, frames=n_frames):
+                        piv = da_proj.frames.get_piv(engine=engine).load()
+                    del video, da_norm, da_proj, piv
+
+
+def bench_process_end_to_end(bench, video_file, n_frames):
+    """
+    Processing.process as called by the pipeline, including writing the NetCDF.
+    """
+    from common.lib import Processing
+
+    params = {"frames": n_frames}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_run in range(bench.repeat):
+            with bench.measure("process_total", "process", params, n_run, frames=n_frames):
+                Processing.process(video_file, os.path.join(NGWERERE, "ngwerere.json"), STABILIZE,
+                                   os.path.join(tmp, "piv.nc"))
+
+
+def bench_mask(bench, video_file):
+    """
+    Processing.mask on the bundled ngwerere velocimetry, with the masking itself timed from its progress events.
+    """
+    import xarray as xr
+    from common.lib import Processing
+    from common.lib.Progress import ProgressReporter
+
+    nc = os.path.join(NGWERERE, "ngwerere_piv.nc")
+    with xr.open_dataset(nc) as ds:
+        n_frames = len(ds.time)
+    params = {"dataset": "ngwerere_piv.nc"}
+    masking = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_run in range(bench.repeat):
+            progress = ProgressReporter()
+            with bench.measure("mask_total", "mask", params, n_run, frames=n_frames):
+                Processing.mask(video_file, nc, os.path.join(tmp, "masked.nc"),
+                                plot_path=os.path.join(tmp, "plot.png"), progress=progress)
+            masking += [e["elapsed"] for e in progress.events if e["stage"] == "mask" and e["status"] == "completed"]
+            matplotlib.pyplot.close("all")
+    bench.records[("mask", "mask", json.dumps(params, sort_keys=True))] = {
+        "case": "mask", "stage": "mask", "params": params, "status": "ok", "frames": n_frames,
+        "walls": masking, "cpus": [], "peak_mb": None,
+    }
+
+
+def bench_transects(bench):
+    """
+    Transects.get_transects on the bundled masked ngwerere velocimetry.
+    """
+    import xarray as xr
+    from common.lib.Transects import get_transects, read_cross_section
+
+    ds = xr.open_dataset(os.path.join(NGWERERE, "ngwerere_masked.nc")).load()
+    cross_sections, crs = zip(*[read_cross_section(os.path.join(NGWERERE, fn))
+                                for fn in ["cross_section1.geojson", "cross_section2.geojson"]])
+    params = {"dataset": "ngwerere_masked.nc", "cross_sections": len(cross_sections)}
+    for n_run in range(bench.repeat):
+        with bench.measure("transect", "get_transects", params, n_run, frames=len(ds.time)):
+            get_transects(ds, list(cross_sections), crs=list(crs))
+
+
+def openpiv_loop(frames, dt, winsize=32, searchsize=32, overlap=16):
+    """
+    Steps 3-6 of the PIV_approach notebook for consecutive frame pairs, without plotting and csv output.
+    """
+    import openpiv.filters as filters
+    import openpiv.pyprocess as process
+
+    results = []
+    for im1, im2 in zip(frames[:-1], frames[1:]):
+        u, v, sig2noise = process.extended_search_area_piv(
+            frame_a=im1.astype(np.int32),
+            frame_b=im2.astype(np.int32),
+            window_size=winsize,
+            overlap=overlap,
+            dt=dt,
+            search_area_size=searchsize,
+            sig2noise_method="peak2peak",
+        )
+        flags = sig2noise <= 1.3
+        u, v = filters.replace_outliers(u, v, flags, method="localmean", max_iter=3, kernel_size=2)
+        x, y = process.get_coordinates(image_size=im1.shape, search_area_size=winsize, overlap=overlap)
+        results.append((x, y, u, v))
+    return results
+
+
+def bench_piv_approach(bench, frames, frame_step=5, fps=25):
+    try:
+        import openpiv  # noqa: F401
+    except ImportError as e:
+        bench.skip("piv_approach", {"frame_step": frame_step}, str(e))
+        return
+    # frame extraction as in the notebook: every frame_step-th frame
+    frames = frames[::frame_step]
+    params = {"frame_step": frame_step, "pairs": len(frames) - 1, "shape": list(frames.shape[1:])}
+    for n_run in range(bench.repeat):
+        with bench.measure("piv_approach", "openpiv_loop", params, n_run, frames=len(frames) - 1):
+            openpiv_loop(frames, dt=frame_step / fps)
+    # coarse-to-fine mode of the notebook, on the same 32 px output grid
+    from common.lib.MultiPassPIV import MultiPassPIV
+
+    for n_run in range(bench.repeat):
+        multipass = MultiPassPIV(window_sizes=(64, 32), overlaps=(32, 16), iterations=(1, 2))
+        with bench.measure("piv_approach", "multipass", params, n_run, frames=len(frames) - 1):
+            for n, (im1, im2) in enumerate(zip(frames[:-1], frames[1:])):
+                multipass(im1, im2, dt=frame_step / fps, keys=(n, n + 1))
+
+
+def frame_difference(frame_a, frame_b):
+    # a cheap pair function, so that the transport of the frames dominates
+    return float(np.abs(frame_b.astype(np.float32) - frame_a).mean())
+
+
+def _pickled_pair(pair):
+    return frame_difference(*pair)
+
+
+def bench_shared_frames(bench, frames, n_workers=4, dtypes=("uint8", "float32")):
+    """
+    A process pool over consecutive frame pairs, with every pair pickled to a worker against workers reading
+    the pairs from a SharedFrames (written once, included in the time). Projected frames are float.
+    """
+    from common.lib.SharedFrames import SharedFrames, map_pairs
+
+    n_pairs = len(frames) - 1
+    chunksize = max(1, n_pairs // (4 * n_workers))
+    for dtype in dtypes:
+        stack = frames.astype(dtype)
+        params = {"dtype": dtype, "shape": list(stack.shape[1:]), "pairs": n_pairs, "workers": n_workers}
+        for n_run in range(bench.repeat):
+            with bench.measure("shared_frames", "pickle", params, n_run, frames=n_pairs):
+                with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    pickled = list(executor.map(_pickled_pair, zip(stack[:-1], stack[1:]), chunksize=chunksize))
+            with bench.measure("shared_frames", "shared", params, n_run, frames=n_pairs):
+                with SharedFrames.from_array(stack) as shared:
+                    result = map_pairs(frame_difference, shared, n_workers=n_workers, chunksize=chunksize)
+            assert result == pickled
+
+
+def bench_calibration(bench, profile_points=(None, 1000)):
+    """
+    app_calibration.apply_transformations on the bundled field data, and on a densified cross-section.
+    """
+    try:
+        import app_calibration
+    except ImportError as e:
+        bench.skip("calibration", {}, str(e))
+        return
+    import matplotlib.pyplot as plt
+
+    data = app_calibration.read_data(DISTO)
+    for n_points in profile_points:
+        case_data = copy.deepcopy(data)
+        if n_points is not None:
+            # same profile, resampled to n_points along the cross-section
+            s = np.linspace(0, 1, len(case_data["profile"]["y"]))
+            s_new = np.linspace(0, 1, n_points)
+            for key in ["x", "y", "z"]:
+                if len(case_data["profile"][key]):
+                    case_data["profile"][key] = np.interp(s_new, s, case_data["profile"][key]).tolist()
+        params = {"profile_points": len(case_data["profile"]["y"])}
+        for n_run in range(bench.repeat):
+            run_data = copy.deepcopy(case_data)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                with bench.measure("calibration", "apply_transformations", params, n_run):
+                    app_calibration.apply_transformations(run_data, fig=plt.figure())
+            plt.close("all")
+
+
+def environment():
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except Exception:
+            return None
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True,
+                                         stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": {m: version(m) for m in ["numpy", "pyorc", "xarray", "dask", "numba", "cv2", "openpiv"]},
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Stages whose best wall time got more than threshold (fraction) slower than in baseline.
+    """
+    def key(r):
+        return r["case"], r["stage"], json.dumps(r["params"], sort_keys=True)
+
+    before = {key(r): r for r in baseline["results"] if r["status"] == "ok"}
+    regressions = []
+    for r in results:
+        b = before.get(key(r))
+        if r["status"] != "ok" or b is None or not b["wall"]:
+            continue
+        ratio = r["wall"] / b["wall"]
+        if ratio > 1 + threshold:
+            regressions.append({"case": r["case"], "stage": r["stage"], "params": r["params"],
+                                "wall": r["wall"], "baseline": b["wall"], "ratio": ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the velocimetry pipeline stages.")
+    parser.add_argument("--output", help="json file for the results (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="json results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown counted as regression (0.2 = 20%%)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="one frame count, default method and engine only")
+    parser.add_argument("--frames", type=int, nargs="+", default=[25, 50])
+    parser.add_argument("--cases", nargs="+",
+                        default=["process", "mask", "transect", "piv_approach", "shared_frames", "calibration"])
+    parser.add_argument("--workers", type=int, default=4, help="worker processes of the shared_frames case")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (lower overhead)")
+    args = parser.parse_args(argv)
+
+    n_frames_list = args.frames[:1] if args.quick else args.frames
+    methods = ["numpy"] if args.quick else ["numpy", "cv"]
+    engines = ["numba"] if args.quick else ["numba", "numpy"]
+    bench = Benchmark(repeat=args.repeat, trace_memory=not args.no_memory)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # particles move ~3 pix per frame downstream, in the 1920x1080 view of the ngwerere camera
+        frames = particle_frames(max(n_frames_list), 1080, 1920)
+        video_file = write_video(os.path.join(tmp, "particles.mp4"), frames)
+        if "process" in args.cases:
+            print("process stages...")
+            bench_process(bench, video_file, n_frames_list, methods, engines)
+            bench_process_end_to_end(bench, video_file, len(frames))
+        if "mask" in args.cases:
+            print("mask...")
+            bench_mask(bench, video_file)
+        if "transect" in args.cases:
+            print("transects...")
+            bench_transects(bench)
+        if "piv_approach" in args.cases:
+            print("PIV_approach loop...")
+            bench_piv_approach(bench, frames)
+        if "shared_frames" in args.cases:
+            print("shared frames...")
+            bench_shared_frames(bench, frames, n_workers=args.workers)
+        if "calibration" in args.cases:
+            print("app_calibration...")
+            bench_calibration(bench)
+
+    env = environment()
+    from common.lib.Profiling import _max_rss_mb
+    env["max_rss_mb"] = _max_rss_mb()
+    report = {"environment": env, "repeat": args.repeat, "results": bench.results()}
+    if args.compare:
+        with open(args.compare) as f:
+            report["regressions"] = compare(report["results"], json.load(f), threshold=args.threshold)
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(ROOT, "benchmarks", "results"), exist_ok=True)
+        output = os.path.join(ROOT, "benchmarks", "results", f"{(env['commit'] or 'unknown')[:10]}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for r in report["results"]:
+        if r["status"] != "ok":
+            print(f"{r['case']:<14} skipped: {r['reason']}")
+            continue
+        peak = f"{r['peak_mb']:8.1f} MB" if r["peak_mb"] is not None else " " * 11
+        fps = f"{r['fps']:8.1f} fps" if r["fps"] else ""
+        print(f"{r['case']:<14} {r['stage']:<22} {r['wall']:8.3f} s {peak} {fps}  {r['params']}")
+    print(f"results written to {output}")
+    for r in report.get("regressions", []):
+        print(f"REGRESSION {r['case']} {r['stage']} {r['params']}: {r['baseline']:.3f} s -> {r['wall']:.3f} s "
+              f"({r['ratio']:.2f}x)")
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,783 @@
 """
-1. cam config steps 
+Asynchronous job API for the velocimetry pipeline.
 
-2. 
+1. POST /jobs with a video and a station config (camera config, stabilization polygon, cross-sections),
+   either as multipart form (files "cam_config", "cross_sections" + field "config" with json, up to
+   MAX_FORM_SIZE) or as json with paths of files on the server, relative to (or inside) the data root.
+   Videos are uploaded with /uploads (4.) and referenced with "upload". Returns a job id right away.
 
-"""
\ No newline at end of file
+2. GET /jobs/<id> for the status, timing and results of every stage (process -> mask -> transect),
+   GET /jobs for all jobs.
+
+3. GET /jobs/<id>/events for a Server-Sent Events stream of progress events of the pipeline stages
+   (stabilize, decode, project, piv, mask, transect, discharge) with frame counts, frames/s and provisional
+   velocity statistics. Past events are replayed first. The stream ends with a "job" event.
+   With "profile": true (or "cprofile") in the job config, every stage is also profiled: "profile" events
+   with wall/CPU time, peak RSS and frames/s, a json lines log in the job directory and a per-stage summary
+   in the stage results. "profile_materialize": true computes every lazy step within its own stage.
+   An "execution" block in the job config sets time chunks, dask scheduler, workers and memory limit
+   (see Execution.ExecutionSettings), e.g. {"time_chunk": 40, "scheduler": "threads", "n_workers": 8}.
+   "frame_step" sets the spacing of the PIV frame pairs, "auto" picks it from the flow (see FrameStep).
+   "water_mask" only correlates PIV windows on water: "geometry" from the stabilization polygon and the
+   cross-sections, "variance" from the temporal variance of the frames (see WaterMask).
+   "converge" stops PIV once the mean velocity and the river flow over the cross-sections are stable within
+   a tolerance, e.g. 0.05 or {"tolerance": 0.05, "confidence": 0.95, "min_frames": 20} (see Convergence).
+   The process stage then reports the frames used, and a "convergence" event has the estimates and bounds.
+
+4. Resumable chunked upload of videos:
+   POST /uploads with json {"filename", "size", "sha256" (optional, of the whole file)} returns an upload id.
+   PUT /uploads/<id> with one chunk as body, and headers Upload-Offset (byte offset of the chunk) and optionally
+   Upload-Checksum (sha256 hex of the chunk). Chunks are written straight to disk, a chunk with a wrong
+   offset is refused with 409, one with a wrong checksum is rolled back with 400, as are malformed headers.
+   HEAD or GET /uploads/<id> returns the offset to resume from after a dropped connection.
+   The video is probed (fps, frames, size) as soon as enough has arrived to decode, and
+   GET /uploads/<id>/frame?index=<n> returns any frame that is already on disk as jpg.
+   POST /jobs with {"upload": <id>, ...} instead of "video" runs a completed upload.
+
+The stages run in a bounded process pool, the event loop only handles requests. Cross-origin requests are
+only allowed from the dashboard (--origin).
+
+    python computation/API_Layer.py --port 8000 --workers 2 --data-root computation --origin http://localhost:5173
+
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import tornado.iostream
+import tornado.web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+
+DEFAULT_JOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs")
+DEFAULT_DATA_ROOT = os.path.dirname(os.path.abspath(__file__))
+# vite's development server
+DEFAULT_ORIGIN = "http://localhost:5173"
+STAGES = ["process", "mask", "transect"]
+MAX_CHUNK_SIZE = 64 * 1024 ** 2
+# bodies that are read into memory: json and multipart jobs with camera configs and cross-sections
+MAX_FORM_SIZE = 8 * 1024 ** 2
+SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+
+
+# Stage functions run in worker processes. They exchange file paths and small summaries only,
+# the velocimetry datasets stay on disk. Progress events go back through a multiprocessing queue.
+
+def _reporter(events, job_id):
+    from common.lib.Progress import ProgressReporter
+
+    callback = None if events is None else lambda event: events.put((job_id, event))
+    return ProgressReporter(callback=callback, keep_events=False)
+
+
+def _stage_process(job_dir, config, events=None, job_id=None):
+    import matplotlib
+    matplotlib.use("Agg")
+    from common.lib.Processing import process
+    from common.lib.Transects import read_cross_section
+
+    coords, crs = [], []
+    if config.get("water_mask") == "geometry" or config.get("converge") is not None:
+        for fn in config.get("cross_sections") or []:
+            xyz, crs_xs = read_cross_section(fn)
+            coords.append(xyz)
+            crs.append(crs_xs)
+    piv_file = os.path.join(job_dir, "piv.nc")
+    piv = process(config["video"], config["cam_config"], config["bbox_coords"], piv_file,
+                  h_a=config.get("h_a", 0.), progress=_reporter(events, job_id), execution=config.get("execution"),
+                  frame_step=config.get("frame_step", 1), water_mask=config.get("water_mask"),
+                  cross_sections=coords, crs=crs, converge=config.get("converge"))
+    result = {"piv_file": piv_file, "time_steps": len(piv.time), "shape": [len(piv.y), len(piv.x)]}
+    if "frames_used" in piv.attrs:
+        result.update(frames_used=int(piv.attrs["frames_used"]), converged=bool(piv.attrs["converged"]))
+    return result
+
+
+def _stage_mask(job_dir, config, events=None, job_id=None):
+    import matplotlib
+    matplotlib.use("Agg")
+    from common.lib.Processing import mask
+
+    masked_file = os.path.join(job_dir, "piv_masked.nc")
+    plot_file = os.path.join(job_dir, "layered_plot.png")
+    ds = mask(config["video"], os.path.join(job_dir, "piv.nc"), masked_file, plot_path=plot_file,
+              progress=_reporter(events, job_id), execution=config.get("execution"))
+    valid = float(ds["v_x"].notnull().mean())
+    return {"masked_file": masked_file, "plot_file": plot_file, "valid_fraction": valid}
+
+
+def _stage_transect(job_dir, config, events=None, job_id=None):
+    from common.lib.Output import open_velocimetry
+    from common.lib.Transects import get_transects, read_cross_section
+
+    cross_sections = config.get("cross_sections") or []
+    if not cross_sections:
+        return {"river_flow": {}}
+    coords, crs = [], []
+    for fn in cross_sections:
+        xyz, crs_xs = read_cross_section(fn)
+        coords.append(xyz)
+        crs.append(crs_xs)
+    names = [os.path.splitext(os.path.basename(fn))[0] for fn in cross_sections]
+    with open_velocimetry(os.path.join(job_dir, "piv_masked.nc")) as ds:
+        ds_q = get_transects(ds.load(), coords, names=names, crs=crs, v_corr=config.get("v_corr", 0.9),
+                             progress=_reporter(events, job_id))
+    transect_file = os.path.join(job_dir, "transects.nc")
+    ds_q.to_netcdf(transect_file)
+    river_flow = ds_q["river_flow"]
+    return {
+        "transect_file": transect_file,
+        "quantiles": river_flow["quantile"].values.tolist(),
+        "river_flow": {str(name): river_flow.sel(transect=name).values.tolist()
+                       for name in river_flow["transect"].values},
+    }
+
+
+STAGE_FUNCTIONS = {"process": _stage_process, "mask": _stage_mask, "transect": _stage_transect}
+
+
+def _profiler(job_dir, config, events, job_id):
+    # config "profile": true for stage timing, "cprofile" to also dump cProfile stats per stage
+    from common.lib.Profiling import Profiler
+
+    if not config.get("profile"):
+        return Profiler(enabled=False)
+
+    def callback(record):
+        if events is not None:
+            events.put((job_id, {"stage": "profile", "status": record["status"], "time": time.time(),
+                                 "profile": record}))
+
+    return Profiler(log_path=os.path.join(job_dir, "profile.jsonl"), callback=callback,
+                    cprofile=config.get("profile") == "cprofile", profile_dir=os.path.join(job_dir, "profiles"),
+                    materialize=bool(config.get("profile_materialize")))
+
+
+def _run_stage(name, job_dir, config, events=None, job_id=None):
+    profiler = _profiler(job_dir, config, events, job_id)
+    with profiler.activate(), profiler.stage(name):
+        result = STAGE_FUNCTIONS[name](job_dir, config, events, job_id)
+    if profiler.enabled:
+        result["profile"] = profiler.summary()
+    return result
+
+
+class Job:
+    """
+    A pipeline run with per-stage status ("queued", "running", "completed", "failed" or "skipped").
+    """
+
+    def __init__(self, config, job_dir, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.config = config
+        self.job_dir = job_dir
+        self.status = "queued"
+        self.error = None
+        self.created = time.time()
+        self.stages = {name: {"status": "queued", "started": None, "duration": None, "result": None}
+                       for name in STAGES}
+        self.events = []
+        self.progress = {}
+        self._subscribers = set()
+
+    @property
+    def done(self):
+        return self.status in ("completed", "failed")
+
+    def publish(self, event):
+        """
+        Store a progress event and pass it on to all open event streams.
+        """
+        self.events.append(event)
+        self.progress[event["stage"]] = event
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "stages": [dict(name=name, **stage) for name, stage in self.stages.items()],
+            "progress": self.progress,
+        }
+
+
+class JobManager:
+    """
+    Keeps track of jobs and runs their stages in a bounded process pool.
+
+    At most max_workers jobs compute at the same time, others wait in the queue with status "queued".
+    """
+
+    def __init__(self, job_dir=DEFAULT_JOB_DIR, max_workers=2):
+        self.job_dir = job_dir
+        self.max_workers = max_workers
+        self.jobs = {}
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._slots = asyncio.Semaphore(max_workers)
+        self._mp = multiprocessing.Manager()
+        self.events = self._mp.Queue()
+        self._pump = None
+        os.makedirs(job_dir, exist_ok=True)
+        self.uploads = UploadStore(os.path.join(job_dir, "uploads"))
+
+    async def _pump_events(self):
+        # a blocking get on the manager queue, in a thread so the event loop stays free
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await loop.run_in_executor(None, self.events.get)
+            if item is None:
+                break
+            job_id, event = item
+            if job_id in self.jobs:
+                self.jobs[job_id].publish(event)
+
+    def new_job_dir(self, job_id):
+        path = os.path.join(self.job_dir, job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def submit(self, config, job_id=None):
+        job_id = job_id or uuid.uuid4().hex[:12]
+        job = Job(config, self.new_job_dir(job_id), job_id=job_id)
+        self.jobs[job.id] = job
+        loop = asyncio.get_running_loop()
+        if self._pump is None:
+            self._pump = loop.create_task(self._pump_events())
+        loop.create_task(self._run(job))
+        return job
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        status = "completed"
+        async with self._slots:
+            job.status = "running"
+            for name in STAGES:
+                stage = job.stages[name]
+                if status == "failed":
+                    stage["status"] = "skipped"
+                    continue
+                stage["status"] = "running"
+                stage["started"] = time.time()
+                try:
+                    stage["result"] = await loop.run_in_executor(self.executor, _run_stage, name, job.job_dir,
+                                                                 job.config, self.events, job.id)
+                    stage["status"] = "completed"
+                except Exception as e:
+                    stage["status"] = "failed"
+                    status = "failed"
+                    job.error = f"{name}: {e}"
+                stage["duration"] = time.time() - stage["started"]
+        # let pending progress events of the last stage arrive before the closing event. The job is only done
+        # once that event is published, event streams opened before see it arrive, those opened after replay it
+        await asyncio.sleep(0.1)
+        job.publish({"stage": "job", "status": status, "time": time.time(), "error": job.error})
+        job.status = status
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.events.put(None)
+        self._mp.shutdown()
+
+
+def probe_video(path):
+    """
+    Metadata and first frame of a (possibly still incomplete) video file, None if it cannot be decoded yet.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            return None, None
+        ret, img = cap.read()
+        if not ret:
+            return None, None
+        metadata = {
+            "fps": cap.get(cv2.CAP_PROP_FPS),
+            "frame_count": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        }
+        return metadata, img
+    finally:
+        cap.release()
+
+
+def read_frame_jpg(path, index):
+    cap = cv2.VideoCapture(path)
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, img = cap.read()
+    finally:
+        cap.release()
+    return cv2.imencode(".jpg", img)[1].tobytes() if ret else None
+
+
+def data_path(data_root, path):
+    """
+    Absolute path of a file given by a client, relative to data_root, refused (400) outside of it.
+    """
+    root = os.path.realpath(data_root)
+    resolved = os.path.realpath(os.path.join(root, str(path)))
+    if os.path.commonpath([root, resolved]) != root:
+        raise tornado.web.HTTPError(400, reason=f"Path outside the data root: {path}")
+    return resolved
+
+
+def file_sha256(path, block_size=4 * 1024 ** 2):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def safe_extension(filename):
+    """
+    Extension of a client's filename, lower case, or "" if it is not alphanumeric.
+    """
+    ext = os.path.splitext(filename)[1][1:]
+    return f".{ext.lower()}" if ext.isascii() and ext.isalnum() else ""
+
+
+def data_filename(filename):
+    """
+    Name of the data file of an upload: "video" with the extension of the client's filename, so that it never
+    collides with the state file or the preview in the upload directory.
+    """
+    return "video" + safe_extension(filename)
+
+
+class Upload:
+    """
+    State of a resumable upload. Kept in a json file next to the data, so uploads survive a restart.
+    The client's filename is only kept as metadata.
+    """
+
+    def __init__(self, upload_dir, upload_id, filename, size, sha256=None, offset=0, status="uploading",
+                 metadata=None, created=None):
+        self.id = upload_id
+        self.filename = os.path.basename(filename)
+        self.size = int(size)
+        self.sha256 = sha256
+        self.offset = offset
+        self.status = status
+        self.metadata = metadata
+        self.created = created or time.time()
+        self.dir = os.path.join(upload_dir, upload_id)
+        self.path = os.path.join(self.dir, data_filename(self.filename))
+        self.busy = False
+        self.probing = False
+
+    @classmethod
+    def load(cls, upload_dir, upload_id):
+        with open(os.path.join(upload_dir, upload_id, "upload.json")) as fh:
+            upload = cls(upload_dir, **json.load(fh))
+        # bytes after the last confirmed chunk are from an interrupted request
+        with open(upload.path, "r+b") as fh:
+            fh.truncate(upload.offset)
+        return upload
+
+    def save(self):
+        state = {k: getattr(self, k) for k in ("filename", "size", "sha256", "offset", "status", "metadata",
+                                               "created")}
+        state["upload_id"] = self.id
+        tmp = os.path.join(self.dir, "upload.json.tmp")
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp, os.path.join(self.dir, "upload.json"))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "offset": self.offset,
+            "status": self.status,
+            "metadata": self.metadata,
+        }
+
+
+class UploadStore:
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        os.makedirs(upload_dir, exist_ok=True)
+        self.uploads = {}
+        for upload_id in os.listdir(upload_dir):
+            try:
+                self.uploads[upload_id] = Upload.load(upload_dir, upload_id)
+            except (OSError, ValueError, TypeError):
+                continue
+
+    def create(self, filename, size, sha256=None):
+        upload = Upload(self.upload_dir, uuid.uuid4().hex[:12], filename, size, sha256=sha256)
+        os.makedirs(upload.dir, exist_ok=True)
+        open(upload.path, "wb").close()
+        upload.save()
+        self.uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise tornado.web.HTTPError(404, reason=f"Unknown upload {upload_id}")
+        return upload
+
+    async def chunk_written(self, upload):
+        """
+        Probe the partial video until it decodes, and verify the whole file once complete.
+        """
+        loop = asyncio.get_running_loop()
+        if upload.metadata is None and not upload.probing:
+            upload.probing = True
+            try:
+                metadata, img = await loop.run_in_executor(None, probe_video, upload.path)
+                if metadata is not None:
+                    cv2.imwrite(os.path.join(upload.dir, "preview.jpg"), img)
+                    upload.metadata = metadata
+            finally:
+                upload.probing = False
+        if upload.offset == upload.size and upload.status == "uploading":
+            if upload.sha256 and await loop.run_in_executor(None, file_sha256, upload.path) != upload.sha256:
+                upload.status = "corrupt"
+            else:
+                upload.status = "complete"
+        upload.save()
+
+
+class BaseHandler(tornado.web.RequestHandler):
+
+    def initialize(self, manager):
+        self.manager = manager
+
+    def set_default_headers(self):
+        # the dashboard is served from another origin by vite, no other site may call the API
+        self.set_header("Access-Control-Allow-Origin", self.settings.get("allowed_origin", DEFAULT_ORIGIN))
+        self.set_header("Vary", "Origin")
+        self.set_header("Access-Control-Allow-Headers", "Content-Type, Upload-Offset, Upload-Checksum")
+        self.set_header("Access-Control-Allow-Methods", "GET, HEAD, POST, PUT, OPTIONS")
+        self.set_header("Access-Control-Expose-Headers", "Upload-Offset, Upload-Length")
+
+    def options(self, *args):
+        self.set_status(204)
+        self.finish()
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({"error": self._reason})
+
+
+class JobsHandler(BaseHandler):
+
+    def get(self):
+        self.write({"jobs": [job.to_dict() for job in self.manager.jobs.values()]})
+
+    def post(self):
+        job_id = uuid.uuid4().hex[:12]
+        if "video" in self.request.files:
+            raise tornado.web.HTTPError(400, reason="Upload videos with /uploads and submit the job with \"upload\"")
+        try:
+            config = json.loads(self.get_body_argument("config", "{}") if self.request.files
+                                else self.request.body or b"{}")
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, reason="Config is not valid json")
+        if not isinstance(config, dict):
+            raise tornado.web.HTTPError(400, reason="Config must be a json object")
+        # paths given by the client stay within the data root
+        data_root = self.settings.get("data_root", DEFAULT_DATA_ROOT)
+        for key in ("video", "cam_config"):
+            if key in config:
+                config[key] = data_path(data_root, config[key])
+        if config.get("cross_sections"):
+            config["cross_sections"] = [data_path(data_root, fn) for fn in config["cross_sections"]]
+        if self.request.files:
+            config.update(self._files_from_form(self.manager.new_job_dir(job_id)))
+        if "upload" in config:
+            upload = self.manager.uploads.get(config["upload"])
+            if upload.status != "complete":
+                raise tornado.web.HTTPError(409, reason=f"Upload {upload.id} is {upload.status}")
+            config["video"] = upload.path
+        for key in ("video", "cam_config", "bbox_coords"):
+            if key not in config:
+                raise tornado.web.HTTPError(400, reason=f"Missing {key}")
+        for fn in [config["video"], config["cam_config"]] + list(config.get("cross_sections") or []):
+            if not os.path.isfile(fn):
+                raise tornado.web.HTTPError(400, reason=f"File not found: {fn}")
+        if config.get("execution") is not None:
+            from common.lib.Execution import ExecutionSettings
+
+            try:
+                config["execution"] = ExecutionSettings.from_dict(config["execution"]).to_dict()
+            except (TypeError, ValueError) as e:
+                raise tornado.web.HTTPError(400, reason=f"Invalid execution settings: {e}")
+        frame_step = config.get("frame_step", 1)
+        if frame_step != "auto" and not (isinstance(frame_step, int) and frame_step >= 1):
+            raise tornado.web.HTTPError(400, reason="frame_step must be a positive integer or \"auto\"")
+        if config.get("water_mask") not in (None, "geometry", "variance"):
+            raise tornado.web.HTTPError(400, reason="water_mask must be \"geometry\" or \"variance\"")
+        converge = config.get("converge")
+        if converge is not None and not (isinstance(converge, dict) or
+                                         (isinstance(converge, (int, float)) and converge > 0)):
+            raise tornado.web.HTTPError(400, reason="converge must be a positive tolerance or a dict of settings")
+        job = self.manager.submit(config, job_id=job_id)
+        self.set_status(202)
+        self.write(job.to_dict())
+
+    def _files_from_form(self, job_dir):
+        # uploaded camera config and cross-sections, under names of our own in the job directory
+        config = {}
+        cross_sections = []
+        for field, files in self.request.files.items():
+            if field not in ("cam_config", "cross_sections"):
+                raise tornado.web.HTTPError(400, reason=f"Unexpected file {field}")
+            for f in files:
+                if field == "cross_sections":
+                    name = f"cross_section_{len(cross_sections) + 1}"
+                else:
+                    name = field
+                path = os.path.join(job_dir, name + safe_extension(f["filename"]))
+                with open(path, "wb") as fh:
+                    fh.write(f["body"])
+                if field == "cross_sections":
+                    cross_sections.append(path)
+                else:
+                    config[field] = path
+        if cross_sections:
+            config["cross_sections"] = cross_sections
+        return config
+
+
+class JobHandler(BaseHandler):
+
+    def get(self, job_id):
+        job = self.manager.jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, reason=f"Unknown job {job_id}")
+        self.write(job.to_dict())
+
+
+class JobEventsHandler(BaseHandler):
+    """
+    Server-Sent Events stream of the progress events of a job.
+    """
+
+    async def get(self, job_id):
+        job = self.manager.jobs.get(job_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, reason=f"Unknown job {job_id}")
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        queue = job.subscribe()
+        try:
+            for event in list(job.events):
+                self._write_event(event)
+            await self.flush()
+            if job.done:
+                return
+            while True:
+                event = await queue.get()
+                self._write_event(event)
+                await self.flush()
+                if event["stage"] == "job":
+                    break
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            job.unsubscribe(queue)
+
+    def _write_event(self, event):
+        self.write(f"data: {json.dumps(event)}\n\n")
+
+
+class UploadsHandler(BaseHandler):
+
+    def post(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+            filename, size = str(body["filename"]), int(body["size"])
+        except (json.JSONDecodeError, KeyError, ValueError, TypeError):
+            raise tornado.web.HTTPError(400, reason="Expected json with filename and size")
+        if size < 0:
+            raise tornado.web.HTTPError(400, reason="size must not be negative")
+        if os.path.basename(filename) in ("", ".", ".."):
+            raise tornado.web.HTTPError(400, reason="filename must name a file")
+        upload = self.manager.uploads.create(filename, size, sha256=body.get("sha256"))
+        self.set_status(201)
+        self.write(dict(upload.to_dict(), max_chunk_size=MAX_CHUNK_SIZE))
+
+
+@tornado.web.stream_request_body
+class UploadHandler(BaseHandler):
+    """
+    Offset and status of an upload (HEAD, GET), and appending a chunk (PUT). The chunk is written to disk
+    while it arrives and is only confirmed, by moving the offset, once the request is complete and, with an
+    Upload-Checksum header, its checksum matches.
+    """
+
+    def _set_offset_headers(self, upload):
+        self.set_header("Upload-Offset", str(upload.offset))
+        self.set_header("Upload-Length", str(upload.size))
+        self.set_header("Cache-Control", "no-store")
+
+    def write_error(self, status_code, **kwargs):
+        # refused chunks tell the client where to resume
+        upload = self.manager.uploads.uploads.get(self.path_args[0]) if self.path_args else None
+        if upload is None:
+            return super().write_error(status_code, **kwargs)
+        self._set_offset_headers(upload)
+        self.finish({"error": self._reason, "offset": upload.offset})
+
+    def head(self, upload_id):
+        self._set_offset_headers(self.manager.uploads.get(upload_id))
+
+    def get(self, upload_id):
+        upload = self.manager.uploads.get(upload_id)
+        self._set_offset_headers(upload)
+        self.write(upload.to_dict())
+
+    def prepare(self):
+        self.upload = None
+        self.fh = None
+        if self.request.method != "PUT":
+            return
+        self.request.connection.set_max_body_size(MAX_CHUNK_SIZE)
+        upload = self.manager.uploads.get(self.path_args[0])
+        offset = self.request.headers.get("Upload-Offset", "")
+        if not (offset.isascii() and offset.isdigit()):
+            raise tornado.web.HTTPError(400, reason="Upload-Offset must be a non-negative integer")
+        self.checksum = self.request.headers.get("Upload-Checksum")
+        if self.checksum is not None:
+            self.checksum = self.checksum.strip().lower()
+            if not SHA256_HEX.fullmatch(self.checksum):
+                raise tornado.web.HTTPError(400, reason="Upload-Checksum must be a sha256 hex digest")
+        if upload.status != "uploading":
+            raise tornado.web.HTTPError(409, reason=f"Upload is {upload.status}")
+        if upload.busy:
+            raise tornado.web.HTTPError(409, reason="Another chunk of this upload is being received")
+        if int(offset) != upload.offset:
+            raise tornado.web.HTTPError(409, reason=f"Expected Upload-Offset {upload.offset}")
+        # tornado already refuses a malformed Content-Length
+        length = self.request.headers.get("Content-Length")
+        if length is not None and upload.offset + int(length) > upload.size:
+            raise tornado.web.HTTPError(413, reason="Chunk runs past the announced size")
+        upload.busy = True
+        self.upload = upload
+        self.received = 0
+        self.overflow = False
+        self.hasher = hashlib.sha256()
+        self.fh = open(upload.path, "r+b")
+        self.fh.seek(upload.offset)
+
+    def data_received(self, chunk):
+        if self.fh is None:
+            return
+        if self.overflow or self.upload.offset + self.received + len(chunk) > self.upload.size:
+            # chunked transfer without Content-Length, refused once the body is in
+            self.overflow = True
+            return
+        self.fh.write(chunk)
+        self.hasher.update(chunk)
+        self.received += len(chunk)
+
+    async def put(self, upload_id):
+        upload = self.upload
+        if self.overflow:
+            self._rollback()
+            raise tornado.web.HTTPError(413, reason="Chunk runs past the announced size")
+        if self.checksum is not None and self.checksum != self.hasher.hexdigest():
+            self._rollback()
+            raise tornado.web.HTTPError(400, reason="Checksum mismatch, chunk discarded")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.fh.close()
+        self.fh = None
+        upload.offset += self.received
+        upload.busy = False
+        upload.save()
+        await self.manager.uploads.chunk_written(upload)
+        self._set_offset_headers(upload)
+        self.write(upload.to_dict())
+
+    def _rollback(self):
+        if self.fh is not None:
+            self.fh.truncate(self.upload.offset)
+            self.fh.close()
+            self.fh = None
+        if self.upload is not None:
+            self.upload.busy = False
+
+    def on_connection_close(self):
+        # dropped in the middle of a chunk, the client resumes from the last confirmed offset
+        self._rollback()
+
+    def on_finish(self):
+        self._rollback()
+
+
+class UploadFrameHandler(BaseHandler):
+
+    async def get(self, upload_id):
+        upload = self.manager.uploads.get(upload_id)
+        try:
+            index = int(self.get_query_argument("index", "0"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="index must be an integer")
+        jpg = await asyncio.get_running_loop().run_in_executor(None, read_frame_jpg, upload.path, index)
+        if jpg is None:
+            raise tornado.web.HTTPError(404, reason=f"Frame {index} is not available (yet)")
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(jpg)
+
+
+def make_app(manager, data_root=DEFAULT_DATA_ROOT, allowed_origin=DEFAULT_ORIGIN):
+    return tornado.web.Application([
+        (r"/jobs", JobsHandler, {"manager": manager}),
+        (r"/jobs/([0-9a-f]+)", JobHandler, {"manager": manager}),
+        (r"/jobs/([0-9a-f]+)/events", JobEventsHandler, {"manager": manager}),
+        (r"/uploads", UploadsHandler, {"manager": manager}),
+        (r"/uploads/([0-9a-f]+)", UploadHandler, {"manager": manager}),
+        (r"/uploads/([0-9a-f]+)/frame", UploadFrameHandler, {"manager": manager}),
+    ], data_root=data_root, allowed_origin=allowed_origin)
+
+
+async def main(port=8000, max_workers=2, job_dir=DEFAULT_JOB_DIR, data_root=DEFAULT_DATA_ROOT,
+               allowed_origin=DEFAULT_ORIGIN):
+    manager = JobManager(job_dir=job_dir, max_workers=max_workers)
+    app = make_app(manager, data_root=data_root, allowed_origin=allowed_origin)
+    # upload chunks raise the limit per request, see UploadHandler.prepare
+    app.listen(port, max_body_size=MAX_FORM_SIZE)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        manager.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Velocimetry job API")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--job-dir", default=DEFAULT_JOB_DIR)
+    parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT,
+                        help="directory that json jobs may read videos, camera configs and cross-sections from")
+    parser.add_argument("--origin", default=DEFAULT_ORIGIN, help="origin of the dashboard, for CORS")
+    args = parser.parse_args()
+    asyncio.run(main(port=args.port, max_workers=args.workers, job_dir=args.job_dir, data_root=args.data_root,
+                     allowed_origin=args.origin))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pandas as pd
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+from common.lib.MaskSweep import chosen_masks, sweep_masks
+from common.lib.Transects import read_cross_section
+
+# the mask chain of plotnmask.py (whose angle mask is not applied in place, so left out here), with candidate
+# values (lists) for the thresholds to tune
+masks = [
+    ("corr", {"tolerance": [0.1, 0.2, 0.3]}),
+    ("minmax", {"s_min": [0.05, 0.1], "s_max": [2.0, 5.0]}),
+    ("rolling", {"wdw": [3, 5], "tolerance": 0.5}),
+    ("outliers", {"tolerance": [1.0, 2.0]}),
+    ("variance", {}),
+    ("count", {"tolerance": [0.2, 0.33]}),
+    ("window_mean", {"wdw": [1, 2], "tolerance": 0.5, "reduce_time": True}),
+]
+
+ds = xr.open_dataset("computation/ngwerere_piv.nc").load()
+
+# valid fraction and mean speed of every combination (192 here)
+df = sweep_masks(ds, masks)
+
+# river flow of the cross-sections for the combinations that keep most data, the transect chain is the
+# expensive part of a combination
+cross_sections, crs = zip(*[
+    read_cross_section(os.path.join("computation/examples/ngwerere", fn))
+    for fn in ["cross_section1.geojson", "cross_section2.geojson"]
+])
+top = df.sort_values("valid_fraction", ascending=False).head(5)
+q = [
+    sweep_masks(ds, chosen_masks(masks, row), cross_sections=list(cross_sections), names=["xs1", "xs2"], crs=list(crs))
+    for _, row in top.iterrows()
+]
+
+pd.set_option("display.width", 200)
+print(df.sort_values("valid_fraction", ascending=False).head(20).to_string(index=False))
+print(pd.concat(q).to_string(index=False))
+df.to_csv("computation/mask_sweep.csv", index=False)
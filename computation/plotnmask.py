@@ -1,12 +1,17 @@
+import os
+import sys
 import pyorc
 import xarray as xr
 import numpy as np
 import copy
 from matplotlib.colors import Normalize
-import cartopy.io.img_tiles as cimgt
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+from common.lib.Output import load_summary, summarize, write
+from common.lib.TileCache import CachedGoogleTiles
+
 # Load dataset and video
 ds = xr.open_dataset("computation/ngwerere_piv.nc")
 video = pyorc.Video("computation/ngwerere_20191103.mp4", start_frame=0, end_frame=125)
@@ -20,7 +25,7 @@ da_rgb_proj = da_rgb.frames.project()
 p = da_rgb_proj[0].frames.plot()
 
 # Plot masked average velocimetry (basic)
-ds_mean = ds.mean(dim="time", keep_attrs=True)
+ds_mean = load_summary("computation/ngwerere_piv.nc", "mean")
 ds_mean.velocimetry.plot.pcolormesh(ax=p.axes, alpha=0.3, cmap="rainbow", add_colorbar=True, vmax=0.6)
 ds_mean.velocimetry.plot(ax=p.axes, color="w", alpha=0.5)
 
@@ -35,7 +40,7 @@ ds_mask.velocimetry.mask.angle(inplace=True)
 ds_mask.velocimetry.mask.count(inplace=True)
 
 # Mean after masking
-ds_mean_mask = ds_mask.mean(dim="time", keep_attrs=True)
+ds_mean_mask = summarize(ds_mask)["mean"]
 p = da_rgb_proj[0].frames.plot()
 ds_mean_mask.velocimetry.plot(ax=p.axes, alpha=0.4, norm=Normalize(vmax=0.6, clip=False), add_colorbar=True)
 
@@ -51,14 +56,15 @@ ds_mask2.velocimetry.mask.count(inplace=True)
 ds_mask2.velocimetry.mask.window_mean(wdw=2, inplace=True, tolerance=0.5, reduce_time=True)
 
 # Mean after advanced masking
-ds_mean_mask2 = ds_mask2.mean(dim="time", keep_attrs=True)
+summaries_mask2 = summarize(ds_mask2)
+ds_mean_mask2 = summaries_mask2["mean"]
 p = da_rgb_proj[0].frames.plot()
 ds_mean_mask2.velocimetry.plot(ax=p.axes, alpha=0.4, norm=Normalize(vmax=0.6, clip=False), add_colorbar=True)
 
 # Geographical plot with satellite background
 p = da_rgb_proj[0].frames.plot(mode="geographical")
 ds_mean_mask2.velocimetry.plot(ax=p.axes, mode="geographical", alpha=0.4, norm=Normalize(vmax=0.6, clip=False), add_colorbar=True)
-tiles = cimgt.GoogleTiles(style="satellite")
+tiles = CachedGoogleTiles(style="satellite")  # offline, seed with TileCache.seed_tiles
 p.axes.add_image(tiles, 19)
 p.axes.set_extent([
     da_rgb_proj.lon.min() - 0.00005,
@@ -82,9 +88,8 @@ plt.savefig("computation/camera_overlay.png", dpi=150, bbox_inches="tight")
 plt.close()
 print("camera_overlay.png")
 
-# Save masked dataset
-ds_mask2.velocimetry.set_encoding()
-ds_mask2.to_netcdf("computation/ngwerere_masked.nc")
+# Save masked dataset, with its summaries for later plots
+write(ds_mask2, "computation/ngwerere_masked.nc", summaries=summaries_mask2)
 
 # Compute average velocity magnitude
 '''u = ds_mean_mask2['v_x']
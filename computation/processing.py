@@ -6,6 +6,16 @@ import cartopy.crs as ccrs
 import cartopy.io.img_tiles as cimgt
 from dask.diagnostics import ProgressBar
 from matplotlib import patches
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+from common.lib.Profiling import Profiler, materialize
+from common.lib.Output import write
+from common.lib.Prefetch import PrefetchVideo
+
+# set PIPELINE_PROFILE=<file.jsonl> to log time, CPU, memory and frames/s of every stage
+profiler = Profiler.from_env()
 
 cam_config = pyorc.load_camera_config("computation/ngwerere.json")
 video_file = "computation/ngwerere_20191103.mp4"
@@ -18,14 +28,16 @@ stabilize = [
     [900, 0]
 ]
 
-video = pyorc.Video(
-    video_file,
-    camera_config=cam_config,
-    start_frame=0,
-    end_frame=125,
-    stabilize=stabilize,
-    h_a=0.,
-)
+with profiler.stage("stabilize"):
+    video = PrefetchVideo(
+        video_file,
+        camera_config=cam_config,
+        start_frame=0,
+        end_frame=125,
+        stabilize=stabilize,
+        h_a=0.,
+    )
+n_frames = int(video.end_frame - video.start_frame + 1)
 
 # === TEMPORARY PLOT: Show raw frame and stabilization polygon ===
 """
@@ -43,7 +55,8 @@ ax.add_patch(patch)
 """
 
 # Get frames from video
-da = video.get_frames()
+with profiler.stage("decode", frames=n_frames):
+    da = materialize(video.get_frames(), profiler)
 
 # === TEMPORARY PLOT: Show first grayscale frame ===
 """
@@ -51,7 +64,8 @@ da[0].frames.plot(cmap="gray")
 """
 
 # Normalize frames
-da_norm = da.frames.normalize()
+with profiler.stage("normalize", frames=n_frames):
+    da_norm = materialize(da.frames.normalize(), profiler)
 
 # === TEMPORARY PLOT: Show normalized frame with colorbar ===
 """
@@ -61,7 +75,8 @@ plt.colorbar(p)
 
 # Project normalized grayscale frames using camera config
 f = plt.figure(figsize=(16, 9))
-da_norm_proj = da_norm.frames.project(method="numpy")
+with profiler.stage("project", frames=n_frames):
+    da_norm_proj = materialize(da_norm.frames.project(method="numpy"), profiler)
 
 # === TEMPORARY PLOT: View projected normalized grayscale frame ===
 """
@@ -86,5 +101,8 @@ p.axes.set_extent([
 """
 
 # Perform PIV on normalized projected frames and save result
-piv = da_norm_proj.frames.get_piv(engine="numba")
-piv.to_netcdf("computation/ngwerere_piv.nc")
+with profiler.stage("piv", frames=n_frames):
+    piv = materialize(da_norm_proj.frames.get_piv(engine="numba"), profiler)
+with profiler.stage("write", frames=n_frames):
+    # compressed, the summaries are stored with the masked results of plotnmask.py
+    write(piv, "computation/ngwerere_piv.nc", summary=False)
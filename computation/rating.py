@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+from common.lib.Rating import RatingCurve, RatingTable
+from common.lib.Transects import get_transects, read_cross_section
+
+# geometry of the first ngwerere cross-section for levels every mm
+(x, y, z), crs = read_cross_section("computation/examples/ngwerere/cross_section1.geojson")
+table = RatingTable.from_profile((x, y, z), crs=crs)
+print(table)
+
+# one observation: the median river flow of the bundled velocimetry at its water level
+ds = xr.open_dataset("computation/examples/ngwerere/ngwerere_masked.nc").load()
+z_a = ds.velocimetry.camera_config.get_z_a(float(ds.attrs.get("h_a", 0.)))
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    ds_q = get_transects(ds, [(x, y, z)], crs=crs, quantiles=[0.5])
+q = float(ds_q["river_flow"].values.ravel()[0])
+
+rating = RatingCurve(table, method="manning").add(z_a, q)
+print(rating.fit())
+for h in np.arange(z_a - 0.1, z_a + 0.11, 0.05):
+    geometry = table.lookup(h)
+    print(f"h {h:.3f} m  area {geometry['area']:.3f} m2  width {geometry['width']:.2f} m  "
+          f"Q {rating.discharge(h):.4f} m3/s")
+
+start = time.perf_counter()
+for _ in range(1000):
+    rating.discharge(z_a)
+print(f"discharge lookup {(time.perf_counter() - start) * 1e3:.2f} us")
@@ -1,10 +1,17 @@
+import os
+import sys
 import xarray as xr
 import pyorc
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import json
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Modularize"))
+from common.lib.Profiling import Profiler, profiled
+from common.lib.TileCache import camera_config_extent, get_geo_axes
 
+
+@profiled()
 def load_frame(video_file: str, frame_idx: int = 0):
     """
     Load a frame from the video.
@@ -14,6 +21,7 @@ def load_frame(video_file: str, frame_idx: int = 0):
     return frame
 
 
+@profiled()
 def plot_frame(frame, gcps_src=None, corners=None, save_path=None):
     """
     Plot frame with optional GCPs and AOI corners.
@@ -32,6 +40,7 @@ def plot_frame(frame, gcps_src=None, corners=None, save_path=None):
     plt.close("all")
 
 
+@profiled()
 def build_camera_config(frame, gcps, crs=32735, resolution=0.01, window_size=25, corners=None):
     """
     Create a camera configuration using GCPs and optional AOI corners.
@@ -47,11 +56,14 @@ def build_camera_config(frame, gcps, crs=32735, resolution=0.01, window_size=25,
     return cam_config
 
 
-def plot_camera_config(cam_config, frame=None, save_path=None):
+@profiled()
+def plot_camera_config(cam_config, frame=None, save_path=None, offline=True):
     """
     Plot camera configuration in 2D and optionally overlay on frame.
+    Satellite tiles come from the local tile cache, only fetched when offline=False.
     """
-    ax1 = cam_config.plot(tiles="GoogleTiles", tiles_kwargs={"style": "satellite"})
+    ax1 = get_geo_axes(camera_config_extent(cam_config), zoom_level=19, offline=offline, figsize=(13, 8))
+    cam_config.plot(ax=ax1)
 
     if frame is not None:
         f = plt.figure()
@@ -65,6 +77,7 @@ def plot_camera_config(cam_config, frame=None, save_path=None):
     plt.close("all")
 
 
+@profiled()
 def plot_camera_3d(cam_config, save_path=None):
     """
     Plot camera configuration in 3D.
@@ -80,6 +93,7 @@ def plot_camera_3d(cam_config, save_path=None):
     plt.close("all")
 
 
+@profiled()
 def export_camera_config(cam_config, filename="cam_config.json"):
     """
     Export camera configuration to JSON file.
@@ -91,7 +105,6 @@ def export_camera_config(cam_config, filename="cam_config.json"):
 # ================= Example usage =================
 if __name__ == "__main__":
     video_file = "ngwerere_20191103.mp4"
-    frame = load_frame(video_file)
 
     gcps = dict(
         src=[
@@ -116,20 +129,25 @@ if __name__ == "__main__":
         [1600, 834]
     ]
 
-    # Step 1: Plot raw frame
-    plot_frame(frame, gcps_src=gcps["src"], corners=corners, save_path="frame_plot.jpg")
+    # set PIPELINE_PROFILE=<file.jsonl> to log time and memory of every step
+    profiler = Profiler.from_env()
+    with profiler.activate():
+        frame = load_frame(video_file)
+
+        # Step 1: Plot raw frame
+        plot_frame(frame, gcps_src=gcps["src"], corners=corners, save_path="frame_plot.jpg")
 
-    # Step 2: Build camera config
-    cam_config = build_camera_config(frame, gcps=gcps, corners=corners)
+        # Step 2: Build camera config
+        cam_config = build_camera_config(frame, gcps=gcps, corners=corners)
 
-    # Step 3: Plot camera config
-    plot_camera_config(cam_config, frame=frame, save_path="ngwerere_camconfig.jpg")
+        # Step 3: Plot camera config
+        plot_camera_config(cam_config, frame=frame, save_path="ngwerere_camconfig.jpg")
 
-    # Step 4: Plot 3D camera config
-    plot_camera_3d(cam_config, save_path="ngwerere_camconfig_3d.jpg")
+        # Step 4: Plot 3D camera config
+        plot_camera_3d(cam_config, save_path="ngwerere_camconfig_3d.jpg")
 
-    # Step 5: Export config
-    export_camera_config(cam_config, "ngwerere.json")
+        # Step 5: Export config
+        export_camera_config(cam_config, "ngwerere.json")
 
     print("Processing complete. Config saved at ngwerere.json")
 
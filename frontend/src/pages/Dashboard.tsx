@@ -10,6 +10,145 @@ import { Label } from '@/components/ui/label';
 import { Alert, AlertDescription } from '@/components/ui/alert';
 import { Play, Pause, Settings, Download, Zap, Upload, Server, Activity, FileVideo, AlertCircle, CheckCircle, Clock } from 'lucide-react';
 
+const API_URL = 'http://localhost:8000';
+
+// pipeline stages as reported by the progress events of computation/API_Layer.py
+const PIPELINE_STAGES = [
+  { id: 'stabilize', name: 'Stabilization' },
+  { id: 'decode', name: 'Frame Decoding' },
+  { id: 'project', name: 'Orthoprojection' },
+  { id: 'piv', name: 'Velocimetry (PIV)' },
+  { id: 'mask', name: 'Masking' },
+  { id: 'transect', name: 'Transect Sampling' },
+  { id: 'discharge', name: 'Discharge' },
+];
+
+interface StageEvent {
+  stage: string;
+  status: string;
+  time: number;
+  elapsed?: number;
+  frames?: number | null;
+  frames_total?: number | null;
+  fps?: number | null;
+  stats?: { valid_fraction: number; mean: number | null; median: number | null; p95: number | null; max: number | null };
+  error?: string | null;
+  profile?: ProfileRecord;
+  // discharge events, per cross-section
+  transect?: number;
+  quantiles?: number[];
+  river_flow?: number[];
+}
+
+// velocity statistics of one PIV chunk
+interface VelocityPoint {
+  frames: number;
+  mean: number;
+  max: number;
+}
+
+// median of the river flow quantiles of a discharge event
+const medianFlow = (event: StageEvent) => {
+  const index = event.quantiles?.indexOf(0.5) ?? -1;
+  return index >= 0 ? event.river_flow?.[index] ?? null : null;
+};
+
+// stage profile of computation/API_Layer.py jobs submitted with "profile": true
+interface ProfileRecord {
+  stage: string;
+  parent: string | null;
+  status: string;
+  wall: number;
+  cpu: number;
+  cpu_util: number | null;
+  frames: number | null;
+  fps: number | null;
+  rss_mb: number | null;
+  peak_rss_mb: number | null;
+}
+
+interface UploadState {
+  id: string;
+  filename: string;
+  size: number;
+  offset: number;
+  status: string;
+  metadata: { fps: number; frame_count: number; width: number; height: number } | null;
+}
+
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const MAX_RETRIES = 5;
+
+const sha256Hex = async (data: ArrayBuffer) => {
+  const digest = await crypto.subtle.digest('SHA-256', data);
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
+const sleep = (ms: number) => new Promise(resolve => window.setTimeout(resolve, ms));
+
+// resumable upload: chunks with offset and checksum, restarting from the server's offset after a drop
+const uploadVideo = async (file: File, onProgress: (upload: UploadState) => void): Promise<UploadState> => {
+  const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+  let upload: UploadState | null = null;
+  const knownId = localStorage.getItem(key);
+  if (knownId) {
+    const response = await fetch(`${API_URL}/uploads/${knownId}`);
+    if (response.ok) upload = await response.json();
+  }
+  if (!upload || upload.status === 'corrupt') {
+    const response = await fetch(`${API_URL}/uploads`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size }),
+    });
+    if (!response.ok) throw new Error(`Upload could not be created (${response.status})`);
+    upload = await response.json();
+    localStorage.setItem(key, upload!.id);
+  }
+  let state = upload as UploadState;
+  onProgress(state);
+  let retries = 0;
+  while (state.offset < state.size) {
+    const chunk = await file.slice(state.offset, state.offset + CHUNK_SIZE).arrayBuffer();
+    try {
+      const response = await fetch(`${API_URL}/uploads/${state.id}`, {
+        method: 'PUT',
+        headers: { 'Upload-Offset': String(state.offset), 'Upload-Checksum': await sha256Hex(chunk) },
+        body: chunk,
+      });
+      const body = await response.json();
+      if (response.ok) {
+        state = body;
+        retries = 0;
+      } else if (response.status === 409 || response.status === 400) {
+        // offset out of sync or damaged chunk, continue from the confirmed offset
+        state = { ...state, offset: body.offset ?? state.offset };
+        if (++retries > MAX_RETRIES) throw new Error(body.error);
+      } else {
+        throw new Error(body.error ?? `Upload failed (${response.status})`);
+      }
+    } catch (error) {
+      if (++retries > MAX_RETRIES) throw error;
+      await sleep(1000 * 2 ** retries);
+      const response = await fetch(`${API_URL}/uploads/${state.id}`, { method: 'HEAD' });
+      if (response.ok) state = { ...state, offset: Number(response.headers.get('Upload-Offset')) };
+    }
+    onProgress(state);
+  }
+  localStorage.removeItem(key);
+  return state;
+};
+
+interface ProcessRow {
+  id: number;
+  name: string;
+  status: string;
+  progress: number;
+  startTime: string;
+  duration: string;
+  fps: number | null;
+}
+
 const STIVDashboard = () => {
   const [isPlaying, setIsPlaying] = useState(false);
   const [currentFrame, setCurrentFrame] = useState(0);
@@ -20,24 +159,90 @@ const STIVDashboard = () => {
   const [isUploading, setIsUploading] = useState(false);
   const [selectedFile, setSelectedFile] = useState<File | null>(null);
   const [videoUrl, setVideoUrl] = useState<string | null>(null);
-  
-  const velocityData = [
-     { time: 0, velocity: 1.2, x: 245, y: 180 },
-     { time: 1, velocity: 1.8, x: 320, y: 165 },
-     { time: 2, velocity: 2.1, x: 410, y: 155 },
-     { time: 3, velocity: 1.9, x: 490, y: 170 },
-     { time: 4, velocity: 2.3, x: 580, y: 145 },
-  ];
+  const [upload, setUpload] = useState<UploadState | null>(null);
+  const [uploadError, setUploadError] = useState<string | null>(null);
+  const [jobId, setJobId] = useState<string | null>(null);
+  const [jobInput, setJobInput] = useState('');
+  const [jobStatus, setJobStatus] = useState<string | null>(null);
+  const [stageEvents, setStageEvents] = useState<Record<string, StageEvent>>({});
+  const [eventLog, setEventLog] = useState<StageEvent[]>([]);
+  const [profiles, setProfiles] = useState<ProfileRecord[]>([]);
+  // per PIV chunk of the followed job, and the last discharge event per cross-section
+  const [velocityData, setVelocityData] = useState<VelocityPoint[]>([]);
+  const [discharges, setDischarges] = useState<Record<number, StageEvent>>({});
 
-  const processes = [
-     { id: 1, name: 'Video Preprocessing', status: 'completed', progress: 100, startTime: '14:32:15', duration: '2.3s' },
-     { id: 2, name: 'STIV Analysis Engine', status: 'running', progress: 67, startTime: '14:32:18', duration: '5.1s' },
-     { id: 3, name: 'Velocity Calculation', status: 'queued', progress: 0, startTime: '--:--:--', duration: '--' },
-     { id: 4, name: 'Data Export', status: 'queued', progress: 0, startTime: '--:--:--', duration: '--' },
+  const demoProcesses: ProcessRow[] = [
+     { id: 1, name: 'Video Preprocessing', status: 'completed', progress: 100, startTime: '14:32:15', duration: '2.3s', fps: null },
+     { id: 2, name: 'STIV Analysis Engine', status: 'running', progress: 67, startTime: '14:32:18', duration: '5.1s', fps: null },
+     { id: 3, name: 'Velocity Calculation', status: 'queued', progress: 0, startTime: '--:--:--', duration: '--', fps: null },
+     { id: 4, name: 'Data Export', status: 'queued', progress: 0, startTime: '--:--:--', duration: '--', fps: null },
   ];
 
-  const maxVelocity = Math.max(...velocityData.map(d => d.velocity));
-  const avgVelocity = velocityData.reduce((sum, d) => sum + d.velocity, 0) / velocityData.length;
+  // live stage progress of the followed job, the demo list otherwise
+  const processes: ProcessRow[] = jobId ? PIPELINE_STAGES.map((stage, index) => {
+    const event = stageEvents[stage.id];
+    const status = !event ? 'queued' : event.status === 'completed' ? 'completed' : event.status === 'failed' ? 'failed' : 'running';
+    const progress = status === 'completed' ? 100
+      : event?.frames && event?.frames_total ? Math.round((100 * event.frames) / event.frames_total) : 0;
+    const started = event ? event.time - (event.elapsed ?? 0) : null;
+    return {
+      id: index + 1,
+      name: stage.name,
+      status,
+      progress,
+      startTime: started ? new Date(started * 1000).toLocaleTimeString() : '--:--:--',
+      duration: event?.elapsed != null ? `${event.elapsed.toFixed(1)}s` : '--',
+      fps: event?.fps ?? null,
+    };
+  }) : demoProcesses;
+
+  const liveStats = stageEvents['mask']?.stats ?? stageEvents['piv']?.stats;
+  const lastProfile = profiles.length > 0 ? profiles[profiles.length - 1] : null;
+  const peakRss = profiles.reduce((peak, record) => Math.max(peak, record.peak_rss_mb ?? 0), 0);
+
+  useEffect(() => {
+    if (!jobId) return;
+    setStageEvents({});
+    setEventLog([]);
+    setProfiles([]);
+    setVelocityData([]);
+    setDischarges({});
+    setJobStatus('running');
+    const source = new EventSource(`${API_URL}/jobs/${jobId}/events`);
+    source.onmessage = (message) => {
+      const event: StageEvent = JSON.parse(message.data);
+      setEventLog(prev => [event, ...prev].slice(0, 50));
+      if (event.stage === 'job') {
+        setJobStatus(event.status);
+        source.close();
+        return;
+      }
+      if (event.stage === 'profile') {
+        const record = event.profile;
+        if (record) setProfiles(prev => [...prev, record]);
+        return;
+      }
+      if (event.stage === 'piv' && event.status === 'progress' && event.stats?.mean != null) {
+        const point = { frames: event.frames ?? 0, mean: event.stats.mean, max: event.stats.max ?? event.stats.mean };
+        setVelocityData(prev => [...prev, point]);
+      }
+      if (event.stage === 'discharge' && event.river_flow) {
+        setDischarges(prev => ({ ...prev, [event.transect ?? 0]: event }));
+      }
+      setStageEvents(prev => ({ ...prev, [event.stage]: event }));
+    };
+    source.onerror = () => {
+      setJobStatus(prev => (prev === 'running' ? 'disconnected' : prev));
+      source.close();
+    };
+    return () => source.close();
+  }, [jobId]);
+
+  // mean over the cross-sections of their median river flow
+  const flows = Object.values(discharges).map(medianFlow).filter((q): q is number => q != null);
+  const riverFlow = flows.length > 0 ? flows.reduce((sum, q) => sum + q, 0) / flows.length : null;
+  const timelineMax = Math.max(...velocityData.map(d => d.mean), 1e-6);
+  const lastFrames = velocityData.length > 0 ? velocityData[velocityData.length - 1].frames : 0;
 
   useEffect(() => {
     let interval: number;
@@ -49,23 +254,23 @@ const STIVDashboard = () => {
     return () => clearInterval(interval);
   }, [isPlaying]);
 
-  const handleFileUpload = useCallback((file: File | null) => {
+  const handleFileUpload = useCallback(async (file: File | null) => {
     if (!file) return;
     setSelectedFile(file);
     setVideoUrl(URL.createObjectURL(file)); // Create a URL for the video
     setIsUploading(true);
     setUploadProgress(0);
-    
-    const interval = window.setInterval(() => {
-      setUploadProgress(prev => {
-        if (prev >= 100) {
-          clearInterval(interval);
-          setIsUploading(false);
-          return 100;
-        }
-        return prev + 10;
+    setUploadError(null);
+    try {
+      await uploadVideo(file, (state) => {
+        setUpload(state);
+        setUploadProgress(Math.floor((100 * state.offset) / state.size));
       });
-    }, 200);
+    } catch (error) {
+      setUploadError(error instanceof Error ? error.message : String(error));
+    } finally {
+      setIsUploading(false);
+    }
   }, []);
 
   const getStatusIcon = (status: string) => {
@@ -141,21 +346,6 @@ const STIVDashboard = () => {
                         />
                       )}
                       <div className="absolute inset-0">
-                        {velocityData.map((point, index) => (
-                          <div
-                            key={index}
-                            className="absolute w-3 h-3 rounded-full velocity-indicator animate-pulse"
-                            style={{
-                              left: `${point.x}px`,
-                              top: `${point.y}px`,
-                              opacity: 0.8 + (point.velocity / maxVelocity) * 0.2
-                            }}
-                          >
-                            <div className="absolute -top-6 -left-4 text-xs text-cyan-300 font-mono bg-black/60 px-1.5 py-0.5 rounded">
-                              {point.velocity.toFixed(1)}m/s
-                            </div>
-                          </div>
-                        ))}
                         <div className="absolute top-4 left-4 text-cyan-300">
                           <div className="flex items-center gap-2 px-2 py-1 font-mono text-sm rounded bg-black/70">
                             → Flow Direction
@@ -186,18 +376,18 @@ const STIVDashboard = () => {
                   <CardContent className="space-y-4">
                     <div className="grid grid-cols-2 gap-4">
                       <div className="text-center">
-                        <div className="text-3xl font-bold metric-value">{avgVelocity.toFixed(2)}</div>
+                        <div className="text-3xl font-bold metric-value">{liveStats?.mean?.toFixed(2) ?? '--'}</div>
                         <div className="text-xs text-gray-400">Avg Velocity (m/s)</div>
                       </div>
                       <div className="text-center">
-                        <div className="text-3xl font-bold metric-value">{maxVelocity.toFixed(2)}</div>
+                        <div className="text-3xl font-bold metric-value">{liveStats?.max?.toFixed(2) ?? '--'}</div>
                         <div className="text-xs text-gray-400">Max Velocity (m/s)</div>
                       </div>
                     </div>
                     <div className="pt-2 space-y-2">
-                      <div className="flex justify-between text-sm"><span>Flow Rate</span><span className="font-mono text-cyan-300">2.4 m³/s</span></div>
+                      <div className="flex justify-between text-sm"><span>Flow Rate</span><span className="font-mono text-cyan-300">{riverFlow != null ? `${riverFlow.toFixed(2)} m³/s` : '--'}</span></div>
                       <div className="flex justify-between text-sm"><span>Measurement Points</span><span className="font-mono text-cyan-300">{measurementPoints}</span></div>
-                      <div className="flex justify-between text-sm"><span>Processing FPS</span><span className="font-mono text-cyan-300">30</span></div>
+                      <div className="flex justify-between text-sm"><span>Processing FPS</span><span className="font-mono text-cyan-300">{stageEvents['piv']?.fps?.toFixed(1) ?? '--'}</span></div>
                     </div>
                   </CardContent>
                 </Card>
@@ -227,12 +417,12 @@ const STIVDashboard = () => {
                       <div className="absolute inset-4">
                         <div className="flex items-end justify-between h-full gap-2">
                           {velocityData.map((point, index) => (
-                            <div key={index} className="w-full rounded-t-sm velocity-indicator-bg" style={{height: `${(point.velocity / maxVelocity) * 100}%`, minHeight: '4px'}}/>
+                            <div key={index} className="w-full rounded-t-sm velocity-indicator-bg" title={`${point.mean.toFixed(2)} m/s`} style={{height: `${(point.mean / timelineMax) * 100}%`, minHeight: '4px'}}/>
                           ))}
                         </div>
                       </div>
                       <div className="absolute flex justify-between text-xs text-gray-500 bottom-1 left-4 right-4">
-                        <span>0s</span><span>2s</span><span>4s</span>
+                        <span>frame 0</span><span>mean velocity per PIV chunk</span><span>frame {lastFrames}</span>
                       </div>
                     </div>
                   </CardContent>
@@ -248,9 +438,24 @@ const STIVDashboard = () => {
                   <CardTitle className="flex items-center gap-2">
                     <Server className="w-5 h-5" />
                     Backend Process Monitor
+                    {jobStatus && (
+                      <Badge className={`ml-2 text-xs capitalize ${getStatusColor(jobStatus === 'disconnected' ? 'failed' : jobStatus)}`}>
+                        {jobStatus}
+                      </Badge>
+                    )}
                   </CardTitle>
                 </CardHeader>
                 <CardContent>
+                  <div className="flex gap-2 mb-4">
+                    <Input
+                      placeholder="Job ID"
+                      value={jobInput}
+                      onChange={(e) => setJobInput(e.target.value.trim())}
+                    />
+                    <Button variant="outline" onClick={() => setJobId(jobInput || null)} disabled={!jobInput}>
+                      Follow
+                    </Button>
+                  </div>
                   <div className="space-y-4">
                     {processes.map((process) => (
                       <div key={process.id} className="p-4 bg-gray-800 rounded-lg">
@@ -269,7 +474,7 @@ const STIVDashboard = () => {
                         <div className="space-y-2">
                           <Progress value={process.progress} className="h-2" />
                           <div className="flex justify-between text-xs text-gray-500">
-                            <span>{process.progress}% complete</span>
+                            <span>{process.progress}% complete{process.fps ? ` • ${process.fps.toFixed(1)} frames/s` : ''}</span>
                             {process.status === 'running' && (
                               <span className="text-cyan-400">Processing...</span>
                             )}
@@ -286,14 +491,32 @@ const STIVDashboard = () => {
                 <CardContent className="space-y-4">
                   <div className="grid grid-cols-2 gap-4">
                     <div className="text-center">
-                      <div className="text-3xl font-bold metric-value">98%</div>
-                      <div className="text-xs text-gray-400">CPU Usage</div>
+                      <div className="text-3xl font-bold metric-value">
+                        {lastProfile?.cpu_util != null ? `${Math.round(100 * lastProfile.cpu_util)}%` : '98%'}
+                      </div>
+                      <div className="text-xs text-gray-400">CPU Usage{lastProfile ? ` (${lastProfile.stage})` : ''}</div>
                     </div>
                     <div className="text-center">
-                      <div className="text-3xl font-bold metric-value">2.1GB</div>
-                      <div className="text-xs text-gray-400">Memory</div>
+                      <div className="text-3xl font-bold metric-value">
+                        {peakRss > 0 ? `${(peakRss / 1024).toFixed(1)}GB` : '2.1GB'}
+                      </div>
+                      <div className="text-xs text-gray-400">{peakRss > 0 ? 'Peak Memory' : 'Memory'}</div>
                     </div>
                   </div>
+                  {profiles.length > 0 && (
+                    <div className="pt-2 space-y-1 font-mono text-xs">
+                      {profiles.map((record, index) => (
+                        <div key={index} className={`flex justify-between ${record.parent ? 'pl-3 text-gray-400' : 'text-cyan-300'}`}>
+                          <span>{record.stage}</span>
+                          <span>
+                            {record.wall.toFixed(2)}s
+                            {record.fps ? ` • ${record.fps.toFixed(1)} fps` : ''}
+                            {record.peak_rss_mb ? ` • ${Math.round(record.peak_rss_mb)} MB` : ''}
+                          </span>
+                        </div>
+                      ))}
+                    </div>
+                  )}
                   <div className="pt-2 space-y-2">
                     <div className="flex justify-between text-sm"><span>Active Processes</span><span className="font-mono text-cyan-300">4</span></div>
                     <div className="flex justify-between text-sm"><span>Queue Length</span><span className="font-mono text-cyan-300">2</span></div>
@@ -307,11 +530,23 @@ const STIVDashboard = () => {
                 <CardContent>
                   <div className="p-3 space-y-2 overflow-y-auto bg-gray-900 rounded-md max-h-48">
                     <div className="space-y-1 font-mono text-xs">
-                      <div className="text-cyan-400">14:32:20 [INFO] STIV analysis started</div>
-                      <div className="text-gray-500">14:32:19 [DEBUG] Loading video frame 1247</div>
-                      <div className="text-cyan-400">14:32:18 [INFO] Preprocessing complete</div>
-                      <div className="text-gray-500">14:32:17 [DEBUG] Velocity threshold set to 0.5</div>
-                      <div className="text-cyan-400">14:32:15 [INFO] Video upload successful</div>
+                      {eventLog.length > 0 ? eventLog.map((event, index) => (
+                        <div key={index} className={event.status === 'failed' ? 'text-red-400' : event.status === 'progress' ? 'text-gray-500' : 'text-cyan-400'}>
+                          {new Date(event.time * 1000).toLocaleTimeString()} [{event.status.toUpperCase()}] {event.stage}
+                          {event.frames_total ? ` ${event.frames ?? 0}/${event.frames_total} frames` : ''}
+                          {event.fps ? ` @ ${event.fps.toFixed(1)} fps` : ''}
+                          {event.stats?.mean != null ? ` • mean ${event.stats.mean.toFixed(2)} m/s` : ''}
+                          {event.error ? ` • ${event.error}` : ''}
+                        </div>
+                      )) : (
+                        <>
+                          <div className="text-cyan-400">14:32:20 [INFO] STIV analysis started</div>
+                          <div className="text-gray-500">14:32:19 [DEBUG] Loading video frame 1247</div>
+                          <div className="text-cyan-400">14:32:18 [INFO] Preprocessing complete</div>
+                          <div className="text-gray-500">14:32:17 [DEBUG] Velocity threshold set to 0.5</div>
+                          <div className="text-cyan-400">14:32:15 [INFO] Video upload successful</div>
+                        </>
+                      )}
                     </div>
                   </div>
                 </CardContent>
@@ -332,7 +567,7 @@ const STIVDashboard = () => {
                   <Alert>
                      <AlertCircle className="w-4 h-4" />
                      <AlertDescription>
-                       Full upload functionality requires a backend connection.
+                       {uploadError ?? 'Uploads are resumable: select the same file again to continue an interrupted upload.'}
                      </AlertDescription>
                   </Alert>
                   
@@ -370,10 +605,16 @@ const STIVDashboard = () => {
                           </div>
                         )}
                         
-                        {uploadProgress === 100 && !isUploading && (
+                        {upload?.metadata && (
+                          <div className="mt-2 text-sm text-gray-400">
+                            {upload.metadata.width}×{upload.metadata.height} • {upload.metadata.fps.toFixed(1)} fps • {upload.metadata.frame_count} frames
+                          </div>
+                        )}
+
+                        {upload?.status === 'complete' && !isUploading && (
                           <div className="flex items-center gap-2 text-cyan-400">
                             <CheckCircle className="w-4 h-4" />
-                            <span className="text-sm">Upload complete!</span>
+                            <span className="text-sm">Upload complete! Upload ID: {upload.id}</span>
                           </div>
                         )}
                       </div>
@@ -0,0 +1,39 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+import xarray as xr
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "Modularize"))
+
+PIV_FN = os.path.join(ROOT, "computation", "ngwerere_piv.nc")
+NGWERERE = os.path.join(ROOT, "computation", "examples", "ngwerere")
+
+
+def load_benchmarks():
+    spec = importlib.util.spec_from_file_location("bench_pipeline",
+                                                  os.path.join(ROOT, "benchmarks", "bench_pipeline.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def ds_piv():
+    # bundled velocimetry results of the ngwerere example, as stored by pyorc (int16 packed)
+    with xr.open_dataset(PIV_FN) as ds:
+        return ds.load()
+
+
+@pytest.fixture(scope="session")
+def particle_video(tmp_path_factory):
+    """
+    Synthetic particle video in the view of the ngwerere camera, particles moving 3 pixels per frame, with the
+    camera configuration and stabilization area of the example.
+    """
+    bench_pipeline = load_benchmarks()
+    fn = str(tmp_path_factory.mktemp("video") / "particles.mp4")
+    bench_pipeline.write_video(fn, bench_pipeline.particle_frames(12, 1080, 1920))
+    return fn, os.path.join(NGWERERE, "ngwerere.json"), bench_pipeline.STABILIZE
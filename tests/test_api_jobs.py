@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from tornado.testing import AsyncHTTPTestCase
+
+from conftest import NGWERERE, ROOT
+
+sys.path.append(os.path.join(ROOT, "computation"))
+import API_Layer  # noqa: E402
+
+DATA_ROOT = os.path.join(ROOT, "computation")
+ORIGIN = "http://dashboard.example"
+
+
+class Manager:
+    """
+    The parts of JobManager the handlers use, jobs are kept but not run.
+    """
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.jobs = {}
+        self.uploads = API_Layer.UploadStore(os.path.join(job_dir, "uploads"))
+
+    def new_job_dir(self, job_id):
+        path = os.path.join(self.job_dir, job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def submit(self, config, job_id=None):
+        job_id = job_id or uuid.uuid4().hex[:12]
+        job = API_Layer.Job(config, self.new_job_dir(job_id), job_id=job_id)
+        self.jobs[job.id] = job
+        return job
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, body in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + body + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+class JobsTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.manager = Manager(self.job_dir)
+        return API_Layer.make_app(self.manager, data_root=DATA_ROOT, allowed_origin=ORIGIN)
+
+    def get_httpserver_options(self):
+        return {"max_body_size": API_Layer.MAX_FORM_SIZE}
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    def post_job(self, body, headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        response = self.fetch("/jobs", method="POST", body=body, headers=headers, raise_error=False)
+        return response, json.loads(response.body) if response.body else None
+
+    def station(self, **kwargs):
+        # any file works as the video, the job is not run
+        return dict({
+            "video": "examples/ngwerere/ngwerere_piv.nc",
+            "cam_config": "examples/ngwerere/ngwerere.json",
+            "bbox_coords": [[150, 0], [500, 1079], [1750, 1079], [900, 0]],
+        }, **kwargs)
+
+    def test_json_paths_within_data_root(self):
+        response, job = self.post_job(self.station(cross_sections=["examples/ngwerere/cross_section1.geojson"]))
+        assert response.code == 202
+        config = self.manager.jobs[job["id"]].config
+        assert config["cam_config"] == os.path.realpath(os.path.join(NGWERERE, "ngwerere.json"))
+        for outside in ["/etc/passwd", "../README.md", "examples/../../README.md"]:
+            response, body = self.post_job(self.station(cam_config=outside))
+            assert response.code == 400 and "outside the data root" in body["error"]
+            response, _ = self.post_job(self.station(cross_sections=[outside]))
+            assert response.code == 400
+
+    def test_multipart_config_files(self):
+        with open(os.path.join(NGWERERE, "ngwerere.json"), "rb") as fh:
+            cam_config = fh.read()
+        upload = self.manager.uploads.create("clip.mp4", 1)
+        upload.offset, upload.status = 1, "complete"
+        config = {"upload": upload.id, "bbox_coords": [[0, 0], [1, 1], [1, 0]]}
+        files = [("cam_config", "../upload.json", cam_config), ("cross_sections", "a b.geojson", b"{}")]
+        body, headers = multipart({"config": json.dumps(config)}, files)
+        response, job = self.post_job(body, headers)
+        assert response.code == 202
+        config = self.manager.jobs[job["id"]].config
+        assert os.path.basename(config["cam_config"]) == "cam_config.json"
+        assert [os.path.basename(fn) for fn in config["cross_sections"]] == ["cross_section_1.geojson"]
+        assert config["video"] == upload.path
+        # videos go through the resumable upload
+        body, headers = multipart({"config": json.dumps(config)}, [("video", "clip.mp4", b"0" * 16)])
+        response, body = self.post_job(body, headers)
+        assert response.code == 400 and "/uploads" in body["error"]
+
+    def test_body_size_limit(self):
+        body, headers = multipart({}, [("cam_config", "big.json", b"0" * (API_Layer.MAX_FORM_SIZE + 1))])
+        # refused by the server before the body is read into memory
+        response, _ = self.post_job(body, headers)
+        assert response.code == 400 and not self.manager.jobs
+
+    def test_cors_origin(self):
+        response = self.fetch("/jobs", method="OPTIONS", headers={"Origin": "http://elsewhere.example"})
+        assert response.headers["Access-Control-Allow-Origin"] == ORIGIN
+
+    def test_events_of_finished_job(self):
+        job = self.manager.submit({"video": "x"})
+        job.publish({"stage": "piv", "status": "completed", "time": time.time()})
+        job.publish({"stage": "job", "status": "completed", "time": time.time(), "error": None})
+        job.status = "completed"
+        response = self.fetch(f"/jobs/{job.id}/events")
+        events = [json.loads(line[len("data: "):]) for line in response.body.decode().split("\n\n") if line]
+        assert [e["stage"] for e in events] == ["piv", "job"]
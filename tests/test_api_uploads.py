@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from tornado.testing import AsyncHTTPTestCase
+
+from conftest import ROOT
+
+sys.path.append(os.path.join(ROOT, "computation"))
+import API_Layer  # noqa: E402
+
+
+class Manager:
+    def __init__(self, upload_dir):
+        self.uploads = API_Layer.UploadStore(upload_dir)
+
+
+class UploadTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.upload_dir = tempfile.mkdtemp()
+        self.manager = Manager(self.upload_dir)
+        return API_Layer.make_app(self.manager)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+
+    def create(self, filename, size, **kwargs):
+        response = self.fetch("/uploads", method="POST", body=json.dumps(dict(filename=filename, size=size, **kwargs)),
+                              raise_error=False)
+        return response.code, json.loads(response.body)
+
+    def put(self, upload_id, data, offset, checksum=None):
+        headers = {"Upload-Offset": str(offset)}
+        if checksum is not None:
+            headers["Upload-Checksum"] = checksum
+        response = self.fetch(f"/uploads/{upload_id}", method="PUT", body=data, headers=headers, raise_error=False)
+        return response.code, json.loads(response.body) if response.body else None
+
+    def test_resumable_upload(self):
+        data = b"0123456789"
+        code, upload = self.create("clip.MP4", len(data), sha256=hashlib.sha256(data).hexdigest())
+        assert code == 201 and upload["offset"] == 0
+        assert self.put(upload["id"], data[:4], 0, checksum=hashlib.sha256(data[:4]).hexdigest())[0] == 200
+        # a chunk that does not match its checksum is not confirmed
+        code, body = self.put(upload["id"], data[4:], 4, checksum=hashlib.sha256(b"other").hexdigest())
+        assert code == 400 and body["offset"] == 4
+        # nor is a chunk at the wrong offset
+        assert self.put(upload["id"], data[4:], 2)[1]["offset"] == 4
+        assert self.put(upload["id"], data[4:], 4)[0] == 200
+        state = self.manager.uploads.get(upload["id"])
+        assert state.status == "complete" and state.filename == "clip.MP4"
+        with open(state.path, "rb") as fh:
+            assert fh.read() == data
+        # the state survives a restart
+        restarted = API_Layer.UploadStore(self.upload_dir).get(upload["id"])
+        assert (restarted.offset, restarted.status, restarted.path) == (10, "complete", state.path)
+
+    def test_malformed_headers(self):
+        _, upload = self.create("clip.mp4", 4)
+        assert self.put(upload["id"], b"ab", "-1")[0] == 400
+        assert self.put(upload["id"], b"ab", "x")[0] == 400
+        assert self.put(upload["id"], b"ab", 0, checksum="zz")[0] == 400
+        assert self.create("clip.mp4", -1)[0] == 400
+        assert self.create("clip.mp4", None)[0] == 400
+
+    def test_filename_is_metadata(self):
+        for filename, data_file in [("upload.json", "video.json"), ("preview.jpg", "video.jpg"),
+                                    ("../../clip.mp4", "video.mp4"), ("clip", "video"), ("clip.m p4", "video")]:
+            code, upload = self.create(filename, 2)
+            assert code == 201
+            assert self.put(upload["id"], b"ab", 0)[0] == 200
+            state = self.manager.uploads.get(upload["id"])
+            assert os.path.basename(state.path) == data_file
+            with open(os.path.join(state.dir, "upload.json")) as fh:
+                assert json.load(fh)["offset"] == 2
+        for filename in ["", ".", "..", "clips/"]:
+            assert self.create(filename, 2)[0] == 400
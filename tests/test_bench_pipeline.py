@@ -0,0 +1,32 @@
+import json
+
+from conftest import load_benchmarks
+
+bench_pipeline = load_benchmarks()
+
+
+def test_compare_flags_slower_stages():
+    def result(wall, status="ok"):
+        return {"case": "mask", "stage": "mask", "params": {}, "status": status, "wall": wall}
+
+    baseline = {"results": [result(1.0)]}
+    assert bench_pipeline.compare([result(1.1)], baseline, threshold=0.2) == []
+    regressions = bench_pipeline.compare([result(1.5)], baseline, threshold=0.2)
+    assert [r["ratio"] for r in regressions] == [1.5]
+    assert bench_pipeline.compare([result(None, status="skipped")], baseline) == []
+
+
+def test_quick_mask_run(tmp_path):
+    output = tmp_path / "results.json"
+    argv = ["--quick", "--cases", "mask", "--repeat", "1", "--no-memory", "--output", str(output)]
+    assert bench_pipeline.main(argv) == 0
+    with open(output) as f:
+        report = json.load(f)
+    assert report["environment"]["versions"]["pyorc"]
+    stages = {(r["case"], r["stage"]): r for r in report["results"]}
+    assert {("mask_total", "mask"), ("mask", "mask")} <= set(stages)
+    for r in stages.values():
+        assert r["status"] == "ok" and r["wall"] > 0 and r["frames"] == 125
+    # a run compared with itself has no regressions
+    assert bench_pipeline.main(argv[:-2] + ["--output", str(tmp_path / "again.json"), "--compare", str(output),
+                                            "--threshold", "10"]) == 0
@@ -0,0 +1,58 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from common.lib.Convergence import ConvergenceMonitor, mean_bounds
+from common.lib.Transects import read_cross_section
+
+from conftest import NGWERERE
+
+
+def test_few_samples():
+    mean, half_width = mean_bounds([])
+    assert np.isnan(mean) and half_width == np.inf
+    assert mean_bounds([1., np.nan, 3.]) == (2., np.inf)
+
+
+def test_constant_series():
+    assert mean_bounds(np.full(10, 0.4)) == (pytest.approx(0.4), 0.)
+
+
+def test_uncorrelated_series_is_student_t():
+    # alternating series, negative lag-1 autocorrelation so all samples count
+    x = np.array([1., 3.] * 10)
+    mean, half_width = mean_bounds(x, confidence=0.9)
+    n = len(x)
+    expected = stats.t.ppf(0.95, n - 1) * x.std(ddof=1) / np.sqrt(n)
+    assert mean == pytest.approx(2.)
+    assert half_width == pytest.approx(expected)
+
+
+def test_correlated_series_is_wider():
+    rng = np.random.default_rng(1)
+    noise = rng.normal(size=400)
+    x = np.convolve(noise, np.ones(10) / 10, mode="valid")
+    _, half_width = mean_bounds(x)
+    naive = stats.t.ppf(0.975, len(x) - 1) * x.std(ddof=1) / np.sqrt(len(x))
+    assert half_width > 2 * naive
+
+
+def test_monitor_transect_speed(ds_piv):
+    fns = [os.path.join(NGWERERE, fn) for fn in ["cross_section1.geojson", "cross_section2.geojson"]]
+    cross_sections, crs = zip(*[read_cross_section(fn) for fn in fns])
+    monitor = ConvergenceMonitor(cross_sections=list(cross_sections), crs=list(crs), min_frames=50)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        summary = monitor.update(ds_piv.isel(time=slice(0, 25)))
+        assert not summary["converged"]
+        samples = monitor.discharge.transect_samples()
+        for name, ds_points in zip(monitor.names, samples):
+            speed = np.nanmean(np.hypot(ds_points["v_x"].values, ds_points["v_y"].values), axis=1)
+            np.testing.assert_allclose(monitor.transect_speed[name], speed)
+        monitor.update(ds_piv.isel(time=slice(25, 50)))
+    assert sum(len(ds_points.points) for ds_points in samples) == len(monitor.discharge.samples.points)
+    assert monitor.n_time == 50
+    assert all(len(speed) == 50 for speed in monitor.transect_speed.values())
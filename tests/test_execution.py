@@ -0,0 +1,54 @@
+import dask
+import numpy as np
+import pytest
+import xarray as xr
+
+from common.lib.Execution import PYORC_MEMORY_FACTOR, ExecutionSettings
+
+
+def test_settings_round_trip():
+    settings = ExecutionSettings.from_dict({"time_chunk": 8, "scheduler": "threads", "memory_limit": "2GB"})
+    assert settings.memory_limit == 2 * 10**9
+    assert ExecutionSettings.from_dict(settings.to_dict()).to_dict() == settings.to_dict()
+    assert ExecutionSettings.from_dict(settings) is settings
+    assert ExecutionSettings.from_dict(None).to_dict() == ExecutionSettings().to_dict()
+    with pytest.raises(ValueError):
+        ExecutionSettings(scheduler="gpu")
+    with pytest.raises(ValueError):
+        ExecutionSettings(time_chunk=1)
+
+
+def test_compute_applies_the_scheduler():
+    settings = ExecutionSettings(scheduler="synchronous", n_workers=2)
+    assert dask.config.get("scheduler", None) is None
+    with settings.compute():
+        assert dask.config.get("scheduler") == "synchronous"
+        assert dask.config.get("num_workers") == 2
+        # nested calls keep the outer context
+        with settings.compute() as client:
+            assert client is None
+            assert dask.config.get("scheduler") == "synchronous"
+    assert dask.config.get("scheduler", None) is None
+
+
+def test_chunk():
+    da = xr.DataArray(np.zeros((50, 6, 8)), dims=("time", "y", "x"))
+    chunked = ExecutionSettings(time_chunk=20).chunk(da)
+    assert chunked.chunks == ((20, 20, 10), (6,), (8,))
+
+
+def test_piv_kwargs():
+    assert ExecutionSettings().piv_kwargs() == {}
+    # a budget larger than pyorc's share of the memory is not binding
+    assert ExecutionSettings(memory_limit="1PB").piv_kwargs() == {}
+    memory_factor = ExecutionSettings(memory_limit="1MB").piv_kwargs()["memory_factor"]
+    assert memory_factor > PYORC_MEMORY_FACTOR
+
+
+@pytest.mark.parametrize("scheduler", ["threads", "processes"])
+def test_to_netcdf(tmp_path, scheduler):
+    ds = xr.Dataset({"v_x": (("time", "y", "x"), np.random.default_rng(0).random((30, 4, 5)))})
+    path = str(tmp_path / "piv.nc")
+    ExecutionSettings(time_chunk=10, scheduler=scheduler).to_netcdf(ds, path)
+    with xr.open_dataset(path) as written:
+        np.testing.assert_array_equal(written["v_x"], ds["v_x"])
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from common.lib.FrameStep import estimate_displacement, frame_step_schedule, schedule_indices, select_frame_step
+
+
+def moving_texture(shifts, shape=(256, 384), seed=0):
+    """
+    uint8 frames of a smooth random texture, moved shifts[n] pixels in x between frame n and n + 1.
+    """
+    rng = np.random.default_rng(seed)
+    texture = gaussian_filter(rng.random(shape), 2)
+    texture = (texture - texture.min()) / (texture.max() - texture.min()) * 255
+    offsets = np.r_[0, np.cumsum(shifts)].astype(int)
+    return np.stack([np.roll(texture, offset, axis=1) for offset in offsets]).astype(np.uint8)
+
+
+@pytest.mark.parametrize("shift", [4, 8])
+def test_displacement(shift):
+    frames = moving_texture([shift] * 10)
+    assert estimate_displacement(frames) == pytest.approx(shift, rel=0.2)
+    # the same flow over pairs 2 frames apart
+    assert estimate_displacement(frames, step=2) == pytest.approx(shift, rel=0.2)
+
+
+def test_select_frame_step():
+    assert select_frame_step(2., 64) == 8
+    assert select_frame_step(40., 64) == 1
+    assert select_frame_step(0.1, 64, max_step=6) == 6
+    assert select_frame_step(np.nan, 64, max_step=6) == 6
+
+
+def test_schedule():
+    # slow in the first 20 frames, fast in the last 20
+    frames = moving_texture([2] * 20 + [8] * 19)
+    schedule = frame_step_schedule(frames, window_size=96, window_frames=20)
+    assert [(w["start"], w["stop"]) for w in schedule] == [(0, 20), (20, 40)]
+    assert [w["step"] for w in schedule] == [10, 2]
+    idx = schedule_indices(schedule)
+    assert idx[0] == 0 and 20 in idx
+    assert set(np.diff(idx[idx < 20])) == {schedule[0]["step"]}
@@ -0,0 +1,42 @@
+import warnings
+
+import numpy as np
+import pyorc
+import pytest
+
+from common.lib.LiveIngest import FrameRingBuffer, LiveVelocimetry
+
+
+def test_ring_buffer():
+    ring = FrameRingBuffer(4, (2, 3))
+    assert len(ring) == 0 and ring.latest_time is None
+    for n in range(6):
+        ring.push(np.full((2, 3), n, dtype=np.uint8), n * 0.1)
+    frames, times = ring.latest()
+    assert len(ring) == 4 and ring.n_pushed == 6
+    np.testing.assert_allclose(times, [0.2, 0.3, 0.4, 0.5])
+    np.testing.assert_array_equal(frames[:, 0, 0], [2, 3, 4, 5])
+    frames, times = ring.latest(2)
+    np.testing.assert_array_equal(frames[:, 0, 0], [4, 5])
+    assert ring.latest_time == pytest.approx(0.5)
+
+
+def test_replay(particle_video):
+    video_file, cam_config, _ = particle_video
+    cam_config = pyorc.load_camera_config(cam_config)
+    # 12 frames at 25 frames/s, replayed as fast as they are processed
+    live = LiveVelocimetry(video_file, cam_config, window=0.2, interval=0.2, realtime=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        summaries = list(live.run())
+    # the first window waits for the frames that normalize needs, the frames after the last window are published
+    # at the end of the stream
+    assert [s["window"] for s in summaries] == [[0.0, 0.28], [0.16, 0.44]]
+    assert all(s["frames"] == 8 for s in summaries)
+    assert summaries[-1]["frames_read"] == 12 and summaries[-1]["dropped"] == 0
+    assert summaries[-1]["velocity"]["valid_fraction"] > 0
+    # frames are projected as pyorc projects them
+    video = pyorc.Video(video_file, camera_config=cam_config, start_frame=0, end_frame=1)
+    frames = video.get_frames()
+    expected = frames.frames.project(method="numpy").values
+    np.testing.assert_array_equal(np.stack([live.projector.project(img) for img in frames.values]), expected)
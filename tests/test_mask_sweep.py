@@ -0,0 +1,58 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from common.lib.MaskSweep import MaskStatistics, chosen_masks, sweep_masks
+from common.lib.Streaming import DEFAULT_MASKS, apply_masks
+
+CHAINS = [
+    # the chain of Processing.mask
+    DEFAULT_MASKS + [("window_mean", {"wdw": 2, "tolerance": 0.5, "reduce_time": True})],
+    [
+        ("s2n", {"tolerance": 5}),
+        ("corr", {"tolerance": 0.3}),
+        ("minmax", {"s_min": 0.05, "s_max": 2.0}),
+        ("window_nan", {"tolerance": 0.5, "wdw": 1}),
+        ("window_mean", {"tolerance": 0.5, "wdw": 2, "reduce_time": True}),
+        ("outliers", {"tolerance": 2.0, "mode": "and"}),
+        ("count", {"tolerance": 0.5}),
+    ],
+    [("angle", {}), ("rolling", {"wdw": 3}), ("variance", {"tolerance": 1, "mode": "or"})],
+]
+
+
+def pyorc_validity(ds, masks):
+    ds = apply_masks(ds.copy(deep=True), masks)
+    return np.isfinite(ds["v_x"].values)
+
+
+@pytest.mark.parametrize("masks", CHAINS)
+def test_same_validity_as_pyorc(ds_piv, masks):
+    stats = MaskStatistics(ds_piv)
+    valid = stats.valid
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for name, kwargs in masks:
+            valid = stats.apply(valid, name, **kwargs)
+    np.testing.assert_array_equal(valid, pyorc_validity(ds_piv, masks))
+
+
+def test_sweep_rows(ds_piv):
+    masks = [
+        ("corr", {"tolerance": [0.1, 0.4]}),
+        ("minmax", {"s_max": [1.0, 5.0]}),
+        ("rolling", {}),
+        ("count", {"tolerance": [0.2, 0.5]}),
+    ]
+    df = sweep_masks(ds_piv, masks)
+    assert len(df) == 8
+    n_valid = np.isfinite(ds_piv["v_x"].values).sum()
+    for _, row in df.iterrows():
+        valid = pyorc_validity(ds_piv, chosen_masks(masks, row))
+        assert row["valid_fraction"] == pytest.approx(valid.sum() / n_valid)
+
+
+def test_default_chain_follows_processing_mask():
+    # Processing.mask calls the angle mask without inplace=True, so it does not mask anything there
+    assert [name for name, _ in DEFAULT_MASKS] == ["corr", "minmax", "rolling", "outliers", "variance", "count"]
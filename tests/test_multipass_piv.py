@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift
+
+from common.lib.MultiPassPIV import MultiPassPIV, grid_centers, median_test, multipass_piv, window_fraction
+
+
+def texture_pair(d_rows, d_cols, shape=(256, 320), seed=0):
+    """
+    A random particle-like texture and the same texture moved d_rows, d_cols pixels.
+    """
+    rng = np.random.default_rng(seed)
+    frame_a = gaussian_filter(rng.random(shape), 1.5) * 255
+    frame_b = shift(frame_a, (d_rows, d_cols), order=3, mode="wrap")
+    return frame_a.astype(np.float32), frame_b.astype(np.float32)
+
+
+def interior(field, border=2):
+    return field[border:-border, border:-border]
+
+
+def test_grid_centers():
+    # openpiv's get_coordinates((100, 130), 32, 16): windows centered on the image
+    rows, cols = grid_centers((100, 130), 32, 16)
+    np.testing.assert_array_equal(rows, [18., 34., 50., 66., 82.])
+    np.testing.assert_array_equal(cols, [17., 33., 49., 65., 81., 97., 113.])
+
+
+def test_window_fraction():
+    rng = np.random.default_rng(1)
+    mask = rng.random((40, 50)) > 0.7
+    top, left = np.array([-5, 0, 10, 30]), np.array([0, -3, 20, 40])
+    expected = [np.pad(mask, 16)[t + 16:t + 32, l + 16:l + 32].mean() for t, l in zip(top, left)]
+    np.testing.assert_allclose(window_fraction(mask, top, left, 16), expected)
+
+
+@pytest.mark.parametrize("d_rows, d_cols", [(-3.3, 21.7), (0.4, -0.6)])
+def test_displacement(d_rows, d_cols):
+    frame_a, frame_b = texture_pair(d_rows, d_cols)
+    x, y, u, v, _, outlier = multipass_piv(frame_a, frame_b, window_sizes=(64, 32), iterations=(1, 2))
+    assert u.shape == x.shape == y.shape
+    assert outlier.mean() < 0.05
+    for comp, d in [(u, d_cols), (v, d_rows)]:
+        error = np.abs(comp[~outlier] - d)
+        assert np.median(error) < 0.15
+        assert error.max() < 0.4
+
+
+def test_large_shift_needs_coarse_level():
+    frame_a, frame_b = texture_pair(0., 21.7)
+    _, _, u, _, _, _ = multipass_piv(frame_a, frame_b, window_sizes=(32,), iterations=(1,))
+    assert np.nanmedian(np.abs(interior(u) - 21.7)) > 1.
+
+
+def test_spectra_reuse():
+    frames = [texture_pair(0., 2. * n)[1] for n in range(3)]
+    piv = MultiPassPIV()
+    first = piv(frames[0], frames[1], keys=(0, 1))
+    # frame 1 is frame A of the next pair, its spectra are reused
+    reused = piv(frames[1], frames[2], keys=(1, 2))
+    fresh = MultiPassPIV()(frames[1], frames[2])
+    assert piv._cache[0] == 2
+    for a, b in zip(reused, fresh):
+        np.testing.assert_array_equal(a, b)
+    assert np.median(first[0]) == pytest.approx(2., abs=0.1)
+
+
+def test_median_test():
+    u = np.ones((5, 5))
+    v = np.zeros((5, 5))
+    u[2, 2] = 8.
+    v[0, 0] = np.nan
+    outlier, med_u, _ = median_test(u, v)
+    assert outlier[2, 2] and outlier[0, 0]
+    assert outlier.sum() == 2
+    assert med_u[2, 2] == 1.
@@ -0,0 +1,92 @@
+import os
+
+import netCDF4
+import numpy as np
+import pytest
+import xarray as xr
+
+from common.lib.Output import (SummaryAccumulator, load_summary, open_summary, open_velocimetry, summarize,
+                               time_chunk_size, write)
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 25, 200])
+def test_summarize_stored_results(ds_piv, chunk_size):
+    summaries = summarize(ds_piv, quantiles=QUANTILES, chunk_size=chunk_size)
+    expected = ds_piv.mean(dim="time")
+    for name in ds_piv.data_vars:
+        np.testing.assert_allclose(summaries["mean"][name], expected[name], rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(summaries["mean"]["count"], ds_piv["v_x"].count(dim="time"))
+    expected = ds_piv[["v_x", "v_y"]].quantile(QUANTILES, dim="time")
+    for name in ["v_x", "v_y"]:
+        # int16 packed with a scale factor of 0.01, as the histogram bins
+        np.testing.assert_allclose(summaries["quantile"][name], expected[name], atol=1e-9)
+    np.testing.assert_allclose(summaries["median"]["v_x"], ds_piv["v_x"].median(dim="time"), atol=1e-9)
+
+
+def test_quantiles_within_resolution():
+    rng = np.random.default_rng(0)
+    values = rng.normal(0.5, 0.3, size=(60, 4, 5))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    values[:, 0, 0] = np.nan
+    ds = xr.Dataset({"v_x": (("time", "y", "x"), values), "v_y": (("time", "y", "x"), -values)},
+                    coords={"time": np.arange(60.)})
+    resolution = 0.01
+    accumulator = SummaryAccumulator(quantiles=QUANTILES, resolution=resolution)
+    for start in range(0, 60, 13):
+        accumulator.update(ds.isel(time=slice(start, start + 13)))
+    result = accumulator.result()
+    expected = ds.quantile(QUANTILES, dim="time")
+    for name in ["v_x", "v_y"]:
+        np.testing.assert_array_equal(np.isnan(result["quantile"][name]), np.isnan(expected[name]))
+        np.testing.assert_array_less(np.abs(result["quantile"][name] - expected[name]).fillna(0.),
+                                     resolution / 2 + 1e-12)
+    assert int(result["mean"]["count"][0, 0]) == 0
+
+
+def test_outliers_are_clipped(ds_piv):
+    ds = ds_piv.copy(deep=True)
+    ds["v_x"][3, 10, 10] = 60.
+    accumulator = SummaryAccumulator(quantiles=QUANTILES, value_range=(-10., 10.))
+    for start in range(0, len(ds.time), 25):
+        accumulator.update(ds.isel(time=slice(start, start + 25)))
+    # the histogram stops at the range instead of growing to 60 m s-1
+    n_bins = len(accumulator._hist["v_x"])
+    assert n_bins <= 2001 and accumulator._base["v_x"] + n_bins - 1 == 1000
+    result = accumulator.result()
+    expected = ds["v_x"].quantile(QUANTILES, dim="time")
+    np.testing.assert_allclose(result["quantile"]["v_x"], expected.clip(max=10.), atol=1e-9)
+    np.testing.assert_allclose(result["mean"]["v_x"], ds["v_x"].mean(dim="time"), atol=1e-12)
+
+
+def test_mean_only(ds_piv):
+    summaries = summarize(ds_piv, quantiles=[])
+    assert list(summaries) == ["mean"]
+    np.testing.assert_allclose(summaries["mean"]["v_y"], ds_piv["v_y"].mean(dim="time"), atol=1e-12)
+
+
+def test_write_without_summaries(ds_piv, tmp_path):
+    path = str(tmp_path / "piv.nc")
+    write(ds_piv, path, summary=False)
+    assert open_summary(path, "mean") is None
+    np.testing.assert_allclose(load_summary(path, "mean")["v_x"], ds_piv["v_x"].mean(dim="time"), atol=1e-9)
+    write(ds_piv, path)
+    # stored with the int16 packing of the velocities
+    np.testing.assert_allclose(open_summary(path, "quantile")["v_y"],
+                               ds_piv["v_y"].quantile(QUANTILES, dim="time"), atol=0.005 + 1e-9)
+
+
+def test_write_compressed_chunks(ds_piv, tmp_path):
+    path = str(tmp_path / "piv.nc")
+    write(ds_piv, path, time_chunk=10, summary=False)
+    with netCDF4.Dataset(path) as nc:
+        var = nc["v_x"]
+        assert var.dtype == np.int16
+        assert var.filters()["zlib"] and var.filters()["shuffle"]
+        assert var.chunking()[var.dimensions.index("time")] == 10
+    assert os.path.getsize(path) < ds_piv["v_x"].astype(np.float32).nbytes
+    with open_velocimetry(path) as ds:
+        np.testing.assert_allclose(ds["v_x"], ds_piv["v_x"], atol=0.005 + 1e-9)
+    time_chunk = time_chunk_size(ds_piv, target_bytes=100 * 4 * len(ds_piv.y) * len(ds_piv.x))
+    assert time_chunk == min(100, len(ds_piv.time))
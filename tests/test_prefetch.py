@@ -0,0 +1,44 @@
+import time
+
+import numpy as np
+import pyorc
+
+from common.lib.Prefetch import FramePrefetcher, PrefetchVideo
+
+
+def test_frames_are_pyorc_frames(particle_video):
+    video_file, cam_config, stabilize = particle_video
+    kwargs = dict(camera_config=cam_config, start_frame=0, end_frame=11, stabilize=stabilize, chunksize=4)
+    expected = pyorc.Video(video_file, **kwargs).get_frames().values
+    video = PrefetchVideo(video_file, max_chunks=2, **kwargs)
+    # more chunks than the store holds, read twice
+    frames = video.get_frames()
+    np.testing.assert_array_equal(frames.values, expected)
+    np.testing.assert_array_equal(frames.values, expected)
+    video.stop()
+
+
+def test_decoder_stays_bounded(particle_video):
+    video_file, _, _ = particle_video
+    prefetcher = FramePrefetcher(video_file, start_frame=0, end_frame=11, chunksize=2, n_buffers=2)
+    frames = iter(prefetcher)
+    n_start, first = next(frames)
+    time.sleep(0.5)
+    # the chunk being read and one more, plus the frame read ahead
+    assert n_start == 0 and len(first) == 2
+    assert prefetcher.n_read <= 4
+    chunks = [first.copy()] + [chunk.copy() for _, chunk in frames]
+    assert sum(len(chunk) for chunk in chunks) == 12
+    prefetcher.join(timeout=5)
+    assert not prefetcher.is_alive()
+
+
+def test_stop(particle_video):
+    video_file, _, _ = particle_video
+    prefetcher = FramePrefetcher(video_file, chunksize=2, n_buffers=1)
+    frames = iter(prefetcher)
+    next(frames)
+    prefetcher.stop()
+    list(frames)
+    prefetcher.join(timeout=5)
+    assert not prefetcher.is_alive()
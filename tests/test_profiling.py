@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from common.lib.Profiling import PROFILE_ENV, Profiler, get_profiler, profile_stage, profiled
+
+
+@profiled("work")
+def work(n):
+    return sum(range(n))
+
+
+def test_stages(tmp_path):
+    log_path = str(tmp_path / "profile.jsonl")
+    profiler = Profiler(log_path=log_path, cprofile=True, profile_dir=str(tmp_path))
+    with profiler.activate():
+        assert get_profiler() is profiler
+        with profile_stage("piv", frames=10):
+            work(1000)
+        with pytest.raises(ValueError):
+            with profile_stage("mask"):
+                raise ValueError("no data")
+    assert get_profiler() is None
+    records = [json.loads(line) for line in open(log_path)]
+    assert records == profiler.records
+    assert [(r["stage"], r["parent"], r["status"]) for r in records] == [
+        ("work", "piv", "completed"), ("piv", None, "completed"), ("mask", None, "failed")]
+    assert records[1]["frames"] == 10 and records[1]["fps"] > 0
+    assert records[2]["error"] == "no data"
+    # only the outermost stages run under cProfile
+    assert "profile_file" not in records[0]
+    assert (tmp_path / "piv.prof").exists()
+    summary = profiler.summary()
+    assert summary["piv"]["calls"] == 1 and summary["piv"]["frames"] == 10
+
+
+def test_without_profiler():
+    assert work(10) == 45
+    with profile_stage("piv"):
+        pass
+    profiler = Profiler(enabled=False)
+    with profiler.activate():
+        assert get_profiler() is None
+        with profiler.stage("piv"):
+            work(10)
+    assert profiler.records == []
+
+
+def test_from_env(monkeypatch, tmp_path):
+    monkeypatch.delenv(PROFILE_ENV, raising=False)
+    assert not Profiler.from_env().enabled
+    monkeypatch.setenv(PROFILE_ENV, str(tmp_path / "profile.jsonl"))
+    monkeypatch.setenv(PROFILE_ENV + "_MATERIALIZE", "1")
+    profiler = Profiler.from_env()
+    assert profiler.enabled and profiler.materialize and not profiler.cprofile
+    assert profiler.profile_dir == str(tmp_path)
@@ -0,0 +1,69 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from common.lib.Processing import process
+from common.lib.Profiling import Profiler, materialize, materializing
+from common.lib.Progress import ProgressReporter, velocity_stats
+from common.lib.Transects import get_transects, read_cross_section
+
+from conftest import NGWERERE
+
+
+def test_stage_events():
+    progress = ProgressReporter()
+    with progress.stage("piv", frames=10):
+        progress.update("piv", frames=5, frames_total=10)
+    with pytest.raises(RuntimeError):
+        with progress.stage("mask"):
+            raise RuntimeError("no data")
+    assert [(e["stage"], e["status"]) for e in progress.events] == [
+        ("piv", "started"), ("piv", "progress"), ("piv", "completed"), ("mask", "started"), ("mask", "failed")]
+    assert progress.events[2]["frames"] == 10 and progress.events[2]["fps"] > 0
+    assert progress.events[-1]["error"] == "no data"
+
+
+def test_lazy_stages_are_not_materialized():
+    da = xr.DataArray(np.arange(4.), dims="time").chunk(2)
+    assert not materializing()
+    assert materialize(da).chunks is not None
+    with Profiler(materialize=True).activate():
+        assert materializing()
+        assert materialize(da).chunks is None
+
+
+def test_velocity_stats():
+    ds = xr.Dataset({"v_x": ("time", [3., np.nan, 0.]), "v_y": ("time", [4., 1., 0.])})
+    stats = velocity_stats(ds)
+    assert stats["valid_fraction"] == pytest.approx(2 / 3)
+    assert (stats["mean"], stats["max"]) == (2.5, 5.)
+
+
+def test_discharge_events(ds_piv):
+    cross_sections, crs = zip(*[read_cross_section(os.path.join(NGWERERE, fn))
+                                for fn in ["cross_section1.geojson", "cross_section2.geojson"]])
+    progress = ProgressReporter()
+    ds_q = get_transects(ds_piv, list(cross_sections), crs=list(crs), progress=progress)
+    events = [e for e in progress.events if e["stage"] == "discharge" and e["status"] == "progress"]
+    assert [e["transect"] for e in events] == [0, 1]
+    for e in events:
+        median = e["river_flow"][e["quantiles"].index(0.5)]
+        assert median == pytest.approx(float(ds_q["river_flow"].isel(transect=e["transect"]).sel(quantile=0.5)))
+
+
+def test_process_reports_throughput_of_computing_stages(particle_video, tmp_path):
+    video_file, cam_config, stabilize = particle_video
+    progress = ProgressReporter()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        process(video_file, cam_config, stabilize, str(tmp_path / "piv.nc"), progress=progress)
+    completed = {e["stage"]: e for e in progress.events if e["status"] == "completed"}
+    # decode and project only build the graph, PIV computes their frames
+    for stage in ["decode", "project"]:
+        assert completed[stage]["frames"] is None and completed[stage]["fps"] is None
+    assert completed["piv"]["frames"] == 12 and completed["piv"]["fps"] > 0
+    piv_progress = [e for e in progress.events if e["stage"] == "piv" and e["status"] == "progress"]
+    assert piv_progress[-1]["stats"]["valid_fraction"] > 0
@@ -0,0 +1,47 @@
+import numpy as np
+
+from common.lib.Rating import RatingTable, wetted_geometry
+
+
+def test_rectangular_section():
+    # 4 m wide, 2 m deep, bed at 1 m
+    s = np.array([0., 0., 4., 4.])
+    z = np.array([3., 1., 1., 3.])
+    levels = np.array([1., 1.5, 2., 3.])
+    area, perimeter, width = wetted_geometry(s, z, levels)
+    h = levels - 1.
+    # a dry bed at the level itself
+    np.testing.assert_allclose(area, 4. * h)
+    np.testing.assert_allclose(perimeter, np.where(h > 0, 4. + 2 * h, 0.))
+    np.testing.assert_allclose(width, np.where(h > 0, 4., 0.))
+
+
+def test_v_section():
+    # banks with a slope of 1:2 (vertical:horizontal) up to 2 m above the lowest point
+    s = np.array([0., 4., 8.])
+    z = np.array([2., 0., 2.])
+    levels = np.array([-0.5, 0., 0.5, 1., 2.])
+    area, perimeter, width = wetted_geometry(s, z, levels)
+    h = np.maximum(levels, 0.)
+    np.testing.assert_allclose(area, 2 * h ** 2)
+    np.testing.assert_allclose(perimeter, 2 * h * np.sqrt(5.))
+    np.testing.assert_allclose(width, 4 * h)
+
+
+def test_walls_above_banks():
+    s = np.array([0., 4., 8.])
+    z = np.array([2., 0., 2.])
+    area, perimeter, width = wetted_geometry(s, z, [3.])
+    np.testing.assert_allclose(area, 8. + 8.)
+    np.testing.assert_allclose(perimeter, 4 * np.sqrt(5.) + 2.)
+    np.testing.assert_allclose(width, 8.)
+
+
+def test_table_lookup_interpolates():
+    profile = (np.zeros(3), np.array([0., 4., 8.]), np.array([2., 0., 2.]))
+    table = RatingTable.from_profile(profile, step=0.01)
+    assert table.bed_level == 0.
+    geometry = table.lookup([0.505, 1.5])
+    np.testing.assert_allclose(geometry["area"], 2 * np.array([0.505, 1.5]) ** 2, rtol=1e-3)
+    np.testing.assert_allclose(geometry["hydraulic_radius"], geometry["area"] / geometry["perimeter"])
+    assert np.isnan(table.lookup(2.5)["area"])
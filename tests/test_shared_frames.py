@@ -0,0 +1,70 @@
+import os
+import pickle
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import xarray as xr
+
+from common.lib.MultiPassPIV import MultiPassPIV
+from common.lib.SharedFrames import SharedFrames, map_pairs
+
+from conftest import ROOT
+from test_frame_step import moving_texture
+
+
+def test_pickle_attaches_to_the_same_memory():
+    frames = np.arange(2 * 3 * 4, dtype=np.float32).reshape(2, 3, 4)
+    with SharedFrames.from_array(frames) as shared:
+        attached = pickle.loads(pickle.dumps(shared))
+        assert attached.name == shared.name and not attached.owner
+        np.testing.assert_array_equal(attached.array, frames)
+        shared[1] = 0
+        assert (attached[1] == 0).all()
+        attached.close()
+
+
+def test_memmap(tmp_path):
+    path = str(tmp_path / "frames.dat")
+    frames = xr.DataArray(np.ones((3, 4, 5), dtype=np.uint8), dims=("time", "y", "x"),
+                          coords={"time": [0., 0.1, 0.2]}, attrs={"h_a": 0.}, name="frames").chunk({"time": 2})
+    with SharedFrames.from_array(frames, path=path, dtype=np.float32) as shared:
+        da = shared.as_dataarray()
+        assert da.dtype == np.float32 and da.dims == frames.dims and da.attrs == frames.attrs
+        np.testing.assert_array_equal(da["time"], frames["time"])
+        assert os.path.isfile(path)
+    assert not os.path.exists(path)
+
+
+def test_map_pairs():
+    frames = moving_texture([4] * 4, shape=(128, 160)).astype(np.float32)
+    piv = MultiPassPIV()
+    expected = [piv(frames[n], frames[n + 1]) for n in range(len(frames) - 1)]
+    with SharedFrames.from_array(frames) as shared:
+        results = map_pairs(MultiPassPIV(), shared, n_workers=2, chunksize=2, keys=True)
+    assert len(results) == len(expected)
+    for result, exp in zip(results, expected):
+        for a, b in zip(result, exp):
+            np.testing.assert_array_equal(a, b)
+
+
+def test_no_resource_tracker_warnings(tmp_path):
+    script = textwrap.dedent("""
+        import numpy as np
+        from common.lib.SharedFrames import SharedFrames, map_pairs
+
+        def difference(a, b):
+            return float((b - a).sum())
+
+        if __name__ == "__main__":
+            with SharedFrames.from_array(np.arange(24, dtype=np.float32).reshape(4, 2, 3)) as shared:
+                assert map_pairs(difference, shared, n_workers=2) == [36.0, 36.0, 36.0]
+    """)
+    # a script file, so that the workers can import difference from the main module
+    script_fn = tmp_path / "map_pairs.py"
+    script_fn.write_text(script)
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "Modularize"))
+    proc = subprocess.run([sys.executable, str(script_fn)], env=env, capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    assert "resource_tracker" not in proc.stderr and "leaked" not in proc.stderr
@@ -0,0 +1,36 @@
+import os
+import shutil
+
+import numpy as np
+
+from common.lib.Stabilization import SIDECAR_SUFFIX, CachedVideo, StabilizationCache, video_hash
+
+
+def test_transforms_are_reused(particle_video, tmp_path):
+    video_file, _, stabilize = particle_video
+    cache_dir = str(tmp_path / "cache")
+    video = CachedVideo(video_file, start_frame=0, stabilize=stabilize, cache_dir=cache_dir)
+    assert not video.stabilization_cached
+    assert os.listdir(cache_dir) == [video_hash(video_file) + SIDECAR_SUFFIX]
+    # a copy of the video under another name has the same contents
+    copy = str(tmp_path / "copy.mp4")
+    shutil.copy(video_file, copy)
+    reopened = CachedVideo(copy, start_frame=0, stabilize=stabilize, cache_dir=cache_dir)
+    assert reopened.stabilization_cached
+    np.testing.assert_array_equal(np.array(reopened.ms), np.array(video.ms))
+    np.testing.assert_array_equal(reopened.get_frame(5), video.get_frame(5))
+    # another polygon, or another frame range, has its own transforms
+    shifted = (np.array(stabilize) + 10).tolist()
+    assert not CachedVideo(copy, start_frame=0, stabilize=shifted, cache_dir=cache_dir).stabilization_cached
+    assert not CachedVideo(copy, start_frame=2, stabilize=stabilize, cache_dir=cache_dir).stabilization_cached
+
+
+def test_sidecar_of_other_contents_is_discarded(tmp_path):
+    fn = str(tmp_path / "video.mp4")
+    with open(fn, "wb") as f:
+        f.write(b"first")
+    StabilizationCache(fn).put("ms", np.zeros((3, 2, 3)))
+    assert "ms" in StabilizationCache(fn)
+    with open(fn, "wb") as f:
+        f.write(b"second contents")
+    assert StabilizationCache(fn).get("ms") is None
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import xarray as xr
+from scipy.ndimage import map_coordinates
+
+from common.lib.STIV import (SpaceTimeSampler, frames_to_memmap, get_sampler, get_stiv, orientation_fft,
+                             orientation_gst)
+
+RESOLUTION = 0.05
+DT = 0.04
+
+
+def shifted_pattern(u, n_t=128, n_y=20, n_x=128, seed=0):
+    """
+    Frames (time, y, x) of a smooth random texture that moves u cells per frame in the x direction, on a
+    projected grid as from frames.project() (y downward in rows, upward in coordinates).
+    """
+    rng = np.random.default_rng(seed)
+    k = np.arange(2, 8)
+    amplitude, phase = rng.random((n_y, len(k))), rng.random((n_y, len(k))) * 2 * np.pi
+    col = np.arange(n_x)
+    t = np.arange(n_t)
+    arg = 2 * np.pi * k[None, None, None, :] * (col[None, None, :, None] - u * t[:, None, None, None]) / 80.
+    frames = (amplitude[None, :, None, :] * np.sin(arg + phase[None, :, None, :])).sum(axis=-1)
+    x = (col + 0.5) * RESOLUTION
+    y = (np.arange(n_y)[::-1] + 0.5) * RESOLUTION
+    xs, ys = np.meshgrid(x, y)
+    return xr.DataArray(
+        frames.astype(np.float32),
+        dims=("time", "y", "x"),
+        coords={"time": t * DT, "y": y, "x": x, "xs": (("y", "x"), xs), "ys": (("y", "x"), ys)},
+    )
+
+
+@pytest.mark.parametrize("orientation", [orientation_gst, orientation_fft])
+@pytest.mark.parametrize("u", [-1.5, 0.5, 1.0])
+def test_streak_velocity(orientation, u):
+    # the finite differences of the gradient structure tensor underestimate streaks steeper than about
+    # 1.5 samples per frame
+    da = shifted_pattern(u)
+    # space-time images along the rows
+    sti = np.moveaxis(da.values, 1, 0)
+    velocity, coherence, _ = orientation(sti)
+    np.testing.assert_allclose(velocity, u, rtol=0.1)
+    assert np.all(coherence > 0.8)
+
+
+@pytest.mark.parametrize("engine", ["gst", "fft"])
+def test_velocity_along_lines(engine):
+    u = 1.0
+    da = shifted_pattern(u)
+    y = da["ys"].values[:, 0]
+    lines = [((1.0, yi), (5.0, yi)) for yi in y[5:15:3]]
+    reversed_lines = [(end, start) for start, end in lines]
+    ds = get_stiv(da, lines + reversed_lines, window=64, engine=engine)
+    assert ds.sizes["time"] == 2
+    expected = u * RESOLUTION / DT
+    n = len(lines)
+    np.testing.assert_allclose(ds["v_x"].values[:, :n], expected, rtol=0.1)
+    np.testing.assert_allclose(ds["v_x"].values[:, n:], expected, rtol=0.1)
+    np.testing.assert_allclose(ds["v_y"].values, 0., atol=1e-6)
+
+
+def test_sampler_is_bilinear(tmp_path):
+    rng = np.random.default_rng(2)
+    frames = rng.random((10, 20, 30)).astype(np.float32)
+    rows = rng.uniform(-1, 20, (3, 15))
+    cols = rng.uniform(-1, 30, (3, 15))
+    sti = SpaceTimeSampler(frames.shape[1:], rows, cols).sample_batches(frames, batch_size=4)
+    inside = (rows >= 0) & (rows <= 19) & (cols >= 0) & (cols <= 29)
+    expected = np.stack([map_coordinates(frame, [rows, cols], order=1) for frame in frames])
+    sti_t = sti.transpose(1, 0, 2)
+    np.testing.assert_allclose(sti_t[:, inside], expected[:, inside], rtol=1e-5)
+    assert np.isnan(sti_t[:, ~inside]).all()
+    memmap = frames_to_memmap(xr.DataArray(frames, dims=("time", "y", "x")), str(tmp_path / "frames.npy"))
+    np.testing.assert_array_equal(SpaceTimeSampler(frames.shape[1:], rows, cols).sample(memmap), sti)
+
+
+def test_sampler_cache():
+    da = shifted_pattern(1.0, n_t=4)
+    lines = [[[0.5, 0.5], [5.5, 0.5]]]
+    item = get_sampler(da, lines)
+    assert get_sampler(da.copy(), lines) is item
+    assert get_sampler(da, [[[0.5, 0.4], [5.5, 0.4]]]) is not item
@@ -0,0 +1,53 @@
+import os
+import warnings
+
+import dask
+import numpy as np
+import pytest
+
+from common.lib.Processing import process_stream
+from common.lib.Streaming import StreamingDischarge
+from common.lib.Transects import crs_list, get_transects, read_cross_section
+
+from conftest import NGWERERE
+
+CROSS_SECTIONS = [os.path.join(NGWERERE, fn) for fn in ["cross_section1.geojson", "cross_section2.geojson"]]
+
+
+def test_crs_list():
+    assert crs_list(32735, 2) == [32735, 32735]
+    assert crs_list([4326, 32735], 2) == [4326, 32735]
+    with pytest.raises(ValueError):
+        crs_list([4326], 2)
+
+
+def test_streaming_discharge_follows_get_transects(ds_piv):
+    cross_sections, crs = zip(*[read_cross_section(fn) for fn in CROSS_SECTIONS])
+    resolution = 0.001
+    discharge = StreamingDischarge(list(cross_sections), crs=list(crs), masks=[], resolution=resolution)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for start in range(0, len(ds_piv.time), 25):
+            discharge.update(ds_piv.isel(time=slice(start, start + 25)))
+        streamed = discharge.transects
+        expected = get_transects(ds_piv, list(cross_sections), crs=list(crs))
+    for name in ["v_x", "v_y"]:
+        difference = np.abs(streamed[name].values - expected[name].values)
+        assert np.nanmax(difference) <= resolution / 2 + 1e-9
+    np.testing.assert_allclose(streamed["river_flow"], expected["river_flow"], atol=1e-3)
+
+
+def test_process_stream_leaves_no_dask_settings(particle_video):
+    video_file, cam_config, stabilize = particle_video
+    cross_sections, crs = zip(*[read_cross_section(fn) for fn in CROSS_SECTIONS])
+    stream = process_stream(video_file, cam_config, stabilize, list(cross_sections), crs=list(crs), chunk_size=4,
+                            execution={"scheduler": "synchronous"})
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        summaries = []
+        for summary in stream:
+            # the scheduler is only set while a chunk computes
+            assert dask.config.get("scheduler", None) is None
+            summaries.append(summary)
+    assert len(summaries) == 3
+    assert (summaries[-1]["chunks"], summaries[-1]["time_steps"]) == (3, 11)
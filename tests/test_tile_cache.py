@@ -0,0 +1,20 @@
+import os
+
+import numpy as np
+import pyorc
+
+from common.lib.TileCache import camera_config_extent
+
+from conftest import NGWERERE
+
+
+def test_extent_includes_lens_position():
+    cam_config = pyorc.load_camera_config(os.path.join(NGWERERE, "ngwerere.json"))
+    extent = camera_config_extent(cam_config, buffer=0.)
+    dst = np.array(cam_config.gcps["dst"])
+    # a camera 200 m east of the GCPs
+    cam_config.lens_position = [dst[:, 0].max() + 200., dst[:, 1].mean(), 10.]
+    with_lens = camera_config_extent(cam_config, buffer=0.)
+    assert with_lens[1] > extent[1]
+    assert with_lens[0] == extent[0]
+    assert with_lens[2] <= extent[2] and with_lens[3] >= extent[3]
@@ -0,0 +1,61 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+import yaml
+from pyproj import Transformer
+
+from common.lib.Transects import get_transects, get_transects_from_recipe, read_cross_section
+
+from conftest import NGWERERE
+
+CROSS_SECTIONS = [os.path.join(NGWERERE, fn) for fn in ["cross_section1.geojson", "cross_section2.geojson"]]
+
+
+@pytest.fixture(autouse=True)
+def no_warnings():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+def pyorc_chain(ds, xyz, crs, v_corr=0.9, fill_method="zeros", **kwargs):
+    ds_points = ds.velocimetry.get_transect(*xyz, crs=crs, **kwargs)
+    ds_points.transect.get_q(v_corr=v_corr, fill_method=fill_method)
+    ds_points.transect.get_river_flow()
+    return ds_points
+
+
+def assert_follows(ds_q, name, ds_points):
+    ds_t = ds_q.sel(transect=name).isel(points=slice(0, len(ds_points.points)))
+    for var in ["v_eff", "q", "river_flow"]:
+        np.testing.assert_allclose(ds_t[var], ds_points[var], atol=1e-9)
+
+
+def test_transects_follow_pyorc(ds_piv):
+    cross_sections, crs = zip(*[read_cross_section(fn) for fn in CROSS_SECTIONS])
+    ds_q = get_transects(ds_piv, list(cross_sections), names=["a", "b"], crs=list(crs))
+    assert list(ds_q["transect"].values) == ["a", "b"]
+    for name, xyz, crs_xs in zip(["a", "b"], cross_sections, crs):
+        assert_follows(ds_q, name, pyorc_chain(ds_piv, xyz, crs_xs))
+
+
+def test_crs_per_cross_section(ds_piv):
+    (xyz_1, crs_1), (xyz_2, crs_2) = [read_cross_section(fn) for fn in CROSS_SECTIONS]
+    # the second cross-section in lon-lat
+    lon, lat = Transformer.from_crs(crs_2, 4326, always_xy=True).transform(xyz_2[0], xyz_2[1])
+    ds_q = get_transects(ds_piv, [xyz_1, (lon, lat, xyz_2[2])], crs=[crs_1, 4326])
+    expected = get_transects(ds_piv, [xyz_1, xyz_2], crs=[crs_1, crs_2])
+    np.testing.assert_allclose(ds_q["river_flow"], expected["river_flow"], rtol=1e-6)
+
+
+def test_recipe(ds_piv):
+    with open(os.path.join(NGWERERE, "ngwerere.yml")) as f:
+        recipe = yaml.safe_load(f)["transect"]
+    # shapefiles are relative to a directory next to the examples
+    ds_q = get_transects_from_recipe(ds_piv, recipe, base_dir=os.path.dirname(NGWERERE))
+    for name in ["transect_1", "transect_2"]:
+        xyz, crs = read_cross_section(os.path.join(os.path.dirname(NGWERERE), recipe[name]["shapefile"]))
+        assert_follows(ds_q, name, pyorc_chain(ds_piv, xyz, crs, **recipe[name]["get_transect"],
+                                               **recipe[name]["get_q"]))
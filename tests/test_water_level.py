@@ -0,0 +1,87 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pyorc
+import pytest
+
+from common.lib.Stabilization import CachedVideo
+from common.lib.WaterLevel import (LevelScorer, _as_gray_stack, candidate_levels, detect_water_level,
+                                   detect_water_levels, sample_frames)
+
+from conftest import NGWERERE
+
+
+@pytest.fixture(scope="module")
+def cross_section():
+    cam_config = pyorc.load_camera_config(os.path.join(NGWERERE, "ngwerere.json"))
+    return pyorc.CrossSection(camera_config=cam_config,
+                              cross_section=gpd.read_file(os.path.join(NGWERERE, "cross_section1.geojson")))
+
+
+@pytest.fixture(scope="module")
+def img(cross_section):
+    rng = np.random.default_rng(0)
+    height, width = cross_section.camera_config.height, cross_section.camera_config.width
+    img = rng.integers(0, 256, (height, width)).astype(np.uint8)
+    img[:, :width // 2] //= 3
+    return img
+
+
+class QuadraticScorer(LevelScorer):
+    # best candidate at l_true, to follow the search without projecting polygons
+    l_true = None
+
+    def score(self, imgs, l_values):
+        return np.tile((np.asarray(l_values) - self.l_true) ** 2, (len(imgs), 1))
+
+
+def test_gray_stack():
+    rgb = np.zeros((4, 5, 3), dtype=np.uint8)
+    rgb[..., 0] = 30
+    assert _as_gray_stack(rgb).shape == (1, 4, 5)
+    assert (_as_gray_stack(rgb) == 10).all()
+    assert _as_gray_stack(np.zeros((2, 4, 5, 3))).shape == (2, 4, 5)
+    assert _as_gray_stack(np.zeros((4, 5))).shape == (1, 4, 5)
+    assert _as_gray_stack(np.zeros((6, 4, 5))).shape == (6, 4, 5)
+
+
+def test_scores_follow_pyorc(cross_section, img):
+    scorer = LevelScorer(cross_section)
+    l_values = np.linspace(scorer.l_min, scorer.l_max, 8)
+    expected = [cross_section.get_histogram_score(x=[l], img=img) for l in l_values]
+    np.testing.assert_allclose(scorer.score(np.stack([img, img]), l_values), [expected, expected])
+
+
+def test_levels_follow_pyorc_s2n(cross_section, img):
+    h, _ = cross_section.detect_water_level_s2n(img)
+    result = detect_water_levels(cross_section, img)
+    assert result["h"] == pytest.approx(h)
+    l_values, z_values = candidate_levels(cross_section, *cross_section.get_line_of_interest())
+    assert (np.diff(l_values) >= 0).all()
+    np.testing.assert_allclose(z_values, cross_section.interp_z(l_values))
+
+
+def test_coarse_to_fine(cross_section, img):
+    scorer = QuadraticScorer(cross_section)
+    scorer.l_true = scorer.l_min + 0.37 * (scorer.l_max - scorer.l_min)
+    h_true = scorer.camera_config.z_to_h(cross_section.interp_z(scorer.l_true))
+    h = detect_water_level(cross_section, img, scorer=scorer, tolerance=0.005)
+    assert h == pytest.approx(h_true, abs=0.01)
+    h = detect_water_level(cross_section, img, scorer=scorer, tolerance=0.005, h_prev=h_true, search_radius=0.3)
+    assert h == pytest.approx(h_true, abs=0.01)
+    # a window around a previous level that misses the optimum falls back to the full range
+    h_prev = scorer.camera_config.z_to_h(cross_section.interp_z(scorer.l_max))
+    h = detect_water_level(cross_section, img, scorer=scorer, tolerance=0.005, h_prev=h_prev, search_radius=0.1)
+    assert h == pytest.approx(h_true, abs=0.01)
+
+
+def test_sample_frames(particle_video):
+    video_file, _, stabilize = particle_video
+    frames = sample_frames(video_file, n_frames=3)
+    assert frames.shape == (3, 1080, 1920) and frames.dtype == np.uint8
+    rotated = sample_frames(video_file, n_frames=3, rotation=90)
+    assert rotated.shape == (3, 1920, 1080)
+    stabilized = sample_frames(video_file, n_frames=3, stabilize=stabilize)
+    video = CachedVideo(video_file, start_frame=0, stabilize=stabilize)
+    np.testing.assert_array_equal(stabilized[-1], video.get_frame(video.end_frame - video.start_frame))
@@ -0,0 +1,54 @@
+import ffpiv
+import numpy as np
+import xarray as xr
+
+from common.lib.MultiPassPIV import MultiPassPIV
+from common.lib.WaterMask import mask_frames, mask_velocimetry, variance_mask, window_mask
+
+from test_frame_step import moving_texture
+
+WINDOW_SIZE = (32, 32)
+OVERLAP = (16, 16)
+
+
+def as_frames(frames):
+    ny, nx = frames.shape[1:]
+    return xr.DataArray(frames.astype(np.float32), dims=("time", "y", "x"),
+                        coords={"y": np.arange(ny)[::-1] * 0.1, "x": np.arange(nx) * 0.1})
+
+
+def test_masked_frames_keep_water_vectors():
+    frames = as_frames(moving_texture([3] * 4, shape=(160, 192)))
+    roi = np.zeros((160, 192), dtype=bool)
+    roi[40:90, 30:100] = True
+    masked, windows = mask_frames(frames, roi, window_size=WINDOW_SIZE, overlap=OVERLAP)
+    np.testing.assert_array_equal(windows, window_mask(roi, WINDOW_SIZE, OVERLAP))
+    assert 0 < windows.sum() < windows.size
+    u, v = ffpiv.piv_stack(frames.values, window_size=WINDOW_SIZE, overlap=OVERLAP, engine="numpy")
+    u_masked, v_masked = ffpiv.piv_stack(masked.values, window_size=WINDOW_SIZE, overlap=OVERLAP, engine="numpy")
+    np.testing.assert_array_equal(u_masked[:, windows], u[:, windows])
+    np.testing.assert_array_equal(v_masked[:, windows], v[:, windows])
+    ds = xr.Dataset({"v_x": (("time", "y", "x"), u_masked)})
+    assert np.isnan(mask_velocimetry(ds, windows)["v_x"].values[:, ~windows]).all()
+
+
+def test_variance_mask():
+    moving = moving_texture([3] * 19, shape=(160, 192))
+    still = moving_texture([0] * 19, shape=(160, 192), seed=1)
+    frames = still.copy()
+    frames[:, 50:110] = moving[:, 50:110]
+    mask = variance_mask(frames)
+    water = np.zeros(mask.shape, dtype=bool)
+    water[50:110] = True
+    assert (mask & water).sum() / (mask | water).sum() > 0.8
+
+
+def test_multipass_mask():
+    frame_a, frame_b = moving_texture([5], shape=(256, 320)).astype(np.float32)
+    mask = np.zeros(frame_a.shape, dtype=bool)
+    mask[:, 100:220] = True
+    piv = MultiPassPIV(mask=mask)
+    u, v, _, outlier = piv(frame_a, frame_b)
+    windows = piv.window_mask(frame_a.shape)
+    assert np.isnan(u[~windows]).all() and outlier[~windows].all()
+    assert np.abs(np.median(u[windows]) - 5.) < 0.1